@@ -6,21 +6,53 @@
 #
 
 
+import time
+START_TIME = time.perf_counter()
+
 import sqlite3
-import matplotlib.pyplot as plt
 import math
+import datetime
+import os
+import sys
+import json
+import re
+import bisect
+import difflib
+import argparse
+import shlex
+import csv
+import itertools
+import threading
+from collections import OrderedDict
+
+# numpy (columnar engine) and matplotlib (plots) are only imported when they are needed,
+# see import_numpy and the plot functions
+np = None
+
+DEFAULT_DATABASE = 'CTA2_L_daily_ridership.db'
 
 ##################################################################
 #
 # print_stats
 #
-# Given a connection to the CTA database, executes various
-# SQL queries to retrieve and output basic stats.
+# Given a connection to the CTA database, outputs basic stats. They are
+# read from the one-row GeneralStats table when it is available, and
+# otherwise computed with various SQL queries.
 #
 def print_stats(dbConn):
-    dbCursor = dbConn.cursor()
+    dbCursor = query_cursor(dbConn)
 
     print("General Statistics:")
+    row = read_general_stats(dbConn)
+    if row is not None:
+        num_stations, num_stops, num_ride_entries, min_date, max_date, total_riders = row
+        print("  # of stations:", f"{num_stations:,}")
+        print("  # of stops:", f"{num_stops:,}")
+        print("  # of ride entries:", f"{num_ride_entries:,}")
+        print("  date range:", min_date, "-", max_date)
+        print("  Total ridership:", f"{total_riders:,}")
+        return
+
     # data for number of stations
     dbCursor.execute("Select count(*) From Stations;")
     row = dbCursor.fetchone();
@@ -46,42 +78,1267 @@ def print_stats(dbConn):
     row = dbCursor.fetchone();
     print("  Total ridership:", f"{row[0]:,}")
 
+##################################################################
+#
+# General statistics
+#
+# GeneralStats keeps the five numbers of the print_stats header in a single
+# row, so startup reads them without scanning Ridership. Triggers keep the
+# counts and the ridership total up to date as rows are loaded or removed.
+# The date range only grows on insert; deleting the first or last day marks
+# it stale, and the next read recomputes the row. Data_Version goes up with
+# every row written to those tables; database_stamp uses it to tell whether
+# files and cached results made from the database are still current.
+#
+GENERAL_STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS GeneralStats (
+    Id INTEGER PRIMARY KEY CHECK (Id = 1),
+    Num_Stations INTEGER NOT NULL,
+    Num_Stops INTEGER NOT NULL,
+    Num_Ride_Entries INTEGER NOT NULL,
+    Min_Ride_Date TEXT,
+    Max_Ride_Date TEXT,
+    Total_Riders INTEGER NOT NULL,
+    Dates_Stale INTEGER NOT NULL DEFAULT 0,
+    Computed_At TEXT NOT NULL,
+    Data_Version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS Ridership_stats_insert AFTER INSERT ON Ridership
+BEGIN
+    UPDATE GeneralStats SET Num_Ride_Entries = Num_Ride_Entries + 1, Data_Version = Data_Version + 1,
+        Total_Riders = Total_Riders + COALESCE(NEW.Num_Riders, 0),
+        Min_Ride_Date = CASE WHEN Min_Ride_Date IS NULL OR NEW.Ride_Date < Min_Ride_Date THEN NEW.Ride_Date ELSE Min_Ride_Date END,
+        Max_Ride_Date = CASE WHEN Max_Ride_Date IS NULL OR NEW.Ride_Date > Max_Ride_Date THEN NEW.Ride_Date ELSE Max_Ride_Date END;
+END;
+CREATE TRIGGER IF NOT EXISTS Ridership_stats_update AFTER UPDATE OF Station_ID, Ride_Date, Type_of_Day, Num_Riders ON Ridership
+BEGIN
+    UPDATE GeneralStats SET Data_Version = Data_Version + 1,
+        Total_Riders = Total_Riders - COALESCE(OLD.Num_Riders, 0) + COALESCE(NEW.Num_Riders, 0),
+        Dates_Stale = Dates_Stale OR (NEW.Ride_Date IS NOT OLD.Ride_Date AND OLD.Ride_Date IN (Min_Ride_Date, Max_Ride_Date)),
+        Min_Ride_Date = CASE WHEN Min_Ride_Date IS NULL OR NEW.Ride_Date < Min_Ride_Date THEN NEW.Ride_Date ELSE Min_Ride_Date END,
+        Max_Ride_Date = CASE WHEN Max_Ride_Date IS NULL OR NEW.Ride_Date > Max_Ride_Date THEN NEW.Ride_Date ELSE Max_Ride_Date END;
+END;
+CREATE TRIGGER IF NOT EXISTS Ridership_stats_delete AFTER DELETE ON Ridership
+BEGIN
+    UPDATE GeneralStats SET Num_Ride_Entries = Num_Ride_Entries - 1, Data_Version = Data_Version + 1,
+        Total_Riders = Total_Riders - COALESCE(OLD.Num_Riders, 0),
+        Dates_Stale = Dates_Stale OR OLD.Ride_Date IN (Min_Ride_Date, Max_Ride_Date);
+END;
+CREATE TRIGGER IF NOT EXISTS Stations_stats_insert AFTER INSERT ON Stations
+BEGIN
+    UPDATE GeneralStats SET Num_Stations = Num_Stations + 1, Data_Version = Data_Version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS Stations_stats_update AFTER UPDATE ON Stations
+BEGIN
+    UPDATE GeneralStats SET Data_Version = Data_Version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS Stations_stats_delete AFTER DELETE ON Stations
+BEGIN
+    UPDATE GeneralStats SET Num_Stations = Num_Stations - 1, Data_Version = Data_Version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS Stops_stats_insert AFTER INSERT ON Stops
+BEGIN
+    UPDATE GeneralStats SET Num_Stops = Num_Stops + 1, Data_Version = Data_Version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS Stops_stats_update AFTER UPDATE ON Stops
+BEGIN
+    UPDATE GeneralStats SET Data_Version = Data_Version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS Stops_stats_delete AFTER DELETE ON Stops
+BEGIN
+    UPDATE GeneralStats SET Num_Stops = Num_Stops - 1, Data_Version = Data_Version + 1;
+END;
+"""
+
+GENERAL_STATS_RECOMPUTE = """
+INSERT OR REPLACE INTO GeneralStats
+SELECT 1, (SELECT count(*) FROM Stations), (SELECT count(*) FROM Stops), count(*),
+       MIN(Ride_Date), MAX(Ride_Date), COALESCE(SUM(Num_Riders), 0), 0, datetime('now'),
+       COALESCE((SELECT Data_Version FROM GeneralStats WHERE Id = 1), 0)
+FROM Ridership;
+"""
+
+# Creates GeneralStats and its triggers and fills it the first time; returns True if it was created
+def create_general_stats(dbConn):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'GeneralStats'")
+    if dbCursor.fetchone()[0] > 0:
+        add_data_version(dbConn)
+        return False
+    try:
+        dbCursor.executescript("BEGIN IMMEDIATE;" + ridership_schema(dbConn, GENERAL_STATS_SCHEMA) + GENERAL_STATS_RECOMPUTE + "COMMIT;")
+    except sqlite3.Error:
+        dbConn.rollback()
+        raise
+    return True
+
+# Adds Data_Version to a GeneralStats table made before it existed, with triggers that count the writes
+def add_data_version(dbConn):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT COUNT(*) FROM pragma_table_info('GeneralStats') WHERE name = 'Data_Version'")
+    if dbCursor.fetchone()[0] > 0:
+        return
+    drop_triggers = "".join(f"DROP TRIGGER IF EXISTS {name};"
+                            for name in re.findall(r"CREATE TRIGGER IF NOT EXISTS (\w+)", GENERAL_STATS_SCHEMA))
+    try:
+        dbCursor.executescript("BEGIN IMMEDIATE; ALTER TABLE GeneralStats ADD COLUMN Data_Version INTEGER NOT NULL DEFAULT 0;" +
+                               drop_triggers + ridership_schema(dbConn, GENERAL_STATS_SCHEMA) + "COMMIT;")
+    except sqlite3.Error:
+        dbConn.rollback()
+        raise
+
+# Recomputes the GeneralStats row with full scans (the write lock keeps the triggers out meanwhile)
+def recompute_general_stats(dbConn):
+    dbCursor = dbConn.cursor()
+    try:
+        dbCursor.executescript("BEGIN IMMEDIATE;" + GENERAL_STATS_RECOMPUTE + "COMMIT;")
+    except sqlite3.Error:
+        dbConn.rollback()
+        raise
+
+# Recomputes the statistics on a thread with its own connection; returns the started thread
+def recompute_general_stats_in_background(db_path):
+    def recompute():
+        statsConn = sqlite3.connect(db_path, timeout=30)
+        try:
+            recompute_general_stats(statsConn)
+        except sqlite3.Error as err:
+            print("**Could not recompute general statistics:", err)
+        finally:
+            statsConn.close()
+
+    thread = threading.Thread(target=recompute, name="recompute-stats")
+    thread.start()
+    return thread
+
+# The print_stats values (stations, stops, ride entries, first date, last date, total riders),
+# or None when GeneralStats is not available
+def read_general_stats(dbConn):
+    dbCursor = query_cursor(dbConn)
+    dbCursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'GeneralStats'")
+    if dbCursor.fetchone()[0] == 0:
+        return None
+    dbCursor.execute("SELECT Dates_Stale FROM GeneralStats WHERE Id = 1")
+    row = dbCursor.fetchone()
+    if row is None:
+        return None
+    if row[0]:
+        try:
+            recompute_general_stats(dbConn)
+        except sqlite3.Error:
+            return None
+    dbCursor.execute("""SELECT Num_Stations, Num_Stops, Num_Ride_Entries, strftime('%Y-%m-%d', Min_Ride_Date),
+                     strftime('%Y-%m-%d', Max_Ride_Date), Total_Riders FROM GeneralStats WHERE Id = 1""")
+    return dbCursor.fetchone()
+
+##################################################################
+#
+# Date columns
+#
+# Ride_Date is stored as text, so a filter like strftime('%Y', Ride_Date) = ?
+# has to evaluate strftime on every row. migrate_date_columns adds integer
+# Ride_Day (days since 1970-01-01), Ride_Year and Ride_Month columns with an
+# index on (Station_ID, Ride_Day), so a year or month becomes a range on the index.
+#
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+DATE_COLUMNS_MIGRATION = """
+ALTER TABLE Ridership ADD COLUMN Ride_Day INTEGER;
+ALTER TABLE Ridership ADD COLUMN Ride_Year INTEGER;
+ALTER TABLE Ridership ADD COLUMN Ride_Month INTEGER;
+UPDATE Ridership SET Ride_Day = CAST(julianday(date(Ride_Date)) - 2440587.5 AS INTEGER),
+                     Ride_Year = CAST(strftime('%Y', Ride_Date) AS INTEGER),
+                     Ride_Month = CAST(strftime('%m', Ride_Date) AS INTEGER);
+CREATE INDEX IF NOT EXISTS Ridership_Station_Day ON Ridership (Station_ID, Ride_Day);
+CREATE TRIGGER IF NOT EXISTS Ridership_date_insert AFTER INSERT ON Ridership WHEN NEW.Ride_Day IS NULL
+BEGIN
+    UPDATE Ridership SET Ride_Day = CAST(julianday(date(NEW.Ride_Date)) - 2440587.5 AS INTEGER),
+                         Ride_Year = CAST(strftime('%Y', NEW.Ride_Date) AS INTEGER),
+                         Ride_Month = CAST(strftime('%m', NEW.Ride_Date) AS INTEGER)
+    WHERE rowid = NEW.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS Ridership_date_update AFTER UPDATE OF Ride_Date ON Ridership
+BEGIN
+    UPDATE Ridership SET Ride_Day = CAST(julianday(date(NEW.Ride_Date)) - 2440587.5 AS INTEGER),
+                         Ride_Year = CAST(strftime('%Y', NEW.Ride_Date) AS INTEGER),
+                         Ride_Month = CAST(strftime('%m', NEW.Ride_Date) AS INTEGER)
+    WHERE rowid = NEW.rowid;
+END;
+"""
+
+# Days since 1970-01-01, the value stored in Ridership.Ride_Day
+def epoch_day(year, month=1, day=1):
+    return datetime.date(year, month, day).toordinal() - EPOCH_ORDINAL
+
+# Half-open Ride_Day range [start, end) covering the given year; an invalid year gives an empty range
+def year_day_range(year):
+    try:
+        year = int(year)
+        return epoch_day(year), epoch_day(year + 1)
+    except ValueError:
+        return 0, 0
+
+# Adds and backfills the integer date columns once. Returns True if the migration ran.
+def migrate_date_columns(dbConn):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT COUNT(*) FROM pragma_table_info('Ridership') WHERE name = 'Ride_Day'")
+    if dbCursor.fetchone()[0] > 0:
+        return False
+    print("Adding integer date columns to Ridership...")
+    try:
+        dbCursor.executescript("BEGIN;" + DATE_COLUMNS_MIGRATION + "COMMIT;")
+    except sqlite3.Error:
+        dbConn.rollback()
+        raise
+    dbCursor.execute("ANALYZE Ridership")
+    date_query_report(dbConn)
+    return True
+
+# Times the command 8 daily query for a sample of stations in the latest year, once with
+# the old strftime() predicate and once with the Ride_Day range, and prints the comparison
+def date_query_report(dbConn, num_stations=10, repeat=3):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT MAX(Ride_Year) FROM Ridership")
+    year = dbCursor.fetchone()[0]
+    if year is None:
+        return
+    dbCursor.execute("SELECT Station_Name FROM Stations ORDER BY Station_ID LIMIT ?", (num_stations,))
+    station_names = [row[0] for row in dbCursor.fetchall()]
+    start_day, end_day = year_day_range(year)
+
+    strftime_query = """SELECT strfTime('%Y-%m-%d',Ride_Date) AS num_date,SUM(Num_Riders) FROM Ridership JOIN Stations
+                        ON Ridership.Station_ID = Stations.Station_ID
+                        WHERE Stations.Station_Name LIKE ?
+                        AND strftime('%Y', Ridership.Ride_Date) = ? GROUP BY num_date ORDER BY num_date ASC;"""
+    range_query = """SELECT date(Ride_Day * 86400, 'unixepoch') AS num_date,SUM(Num_Riders) FROM Ridership JOIN Stations
+                     ON Ridership.Station_ID = Stations.Station_ID
+                     WHERE Stations.Station_Name LIKE ?
+                     AND Ridership.Ride_Day >= ? AND Ridership.Ride_Day < ? GROUP BY Ride_Day ORDER BY Ride_Day ASC;"""
+    timings = []
+    for query, params in ((strftime_query, lambda name: (name, str(year))),
+                          (range_query, lambda name: (name, start_day, end_day))):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for name in station_names:
+                dbCursor.execute(query, params(name))
+                dbCursor.fetchall()
+        timings.append((time.perf_counter() - start) * 1000 / (repeat * len(station_names)))
+
+    print(f"Daily query timing for {len(station_names)} stations in {year}:")
+    print(f"  strftime() predicate: {timings[0]:.2f} ms/query")
+    print(f"  Ride_Day range: {timings[1]:.2f} ms/query", f"({timings[0] / max(timings[1], 1e-9):.1f}x faster)")
+
+##################################################################
+#
+# Ridership rollups
+#
+# RidershipRollup keeps SUM(Num_Riders) for every station, year, month
+# and Type_of_Day next to the Ridership table. Triggers on Ridership
+# record which (station, year, month) groups changed in RollupDirty, so
+# refresh_rollups only recomputes those groups instead of the whole table.
+#
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS RidershipRollup (
+    Station_ID INTEGER NOT NULL,
+    Year INTEGER NOT NULL,
+    Month INTEGER NOT NULL,
+    Type_of_Day TEXT NOT NULL,
+    Num_Riders INTEGER NOT NULL,
+    PRIMARY KEY (Station_ID, Year, Month, Type_of_Day)
+);
+CREATE TABLE IF NOT EXISTS RollupDirty (
+    Station_ID INTEGER NOT NULL,
+    Year INTEGER NOT NULL,
+    Month INTEGER NOT NULL,
+    PRIMARY KEY (Station_ID, Year, Month)
+);
+CREATE TRIGGER IF NOT EXISTS Ridership_rollup_insert AFTER INSERT ON Ridership
+BEGIN
+    INSERT OR IGNORE INTO RollupDirty VALUES (NEW.Station_ID,
+        CAST(strftime('%Y', NEW.Ride_Date) AS INTEGER), CAST(strftime('%m', NEW.Ride_Date) AS INTEGER));
+END;
+CREATE TRIGGER IF NOT EXISTS Ridership_rollup_update AFTER UPDATE OF Station_ID, Ride_Date, Type_of_Day, Num_Riders ON Ridership
+BEGIN
+    INSERT OR IGNORE INTO RollupDirty VALUES (OLD.Station_ID,
+        CAST(strftime('%Y', OLD.Ride_Date) AS INTEGER), CAST(strftime('%m', OLD.Ride_Date) AS INTEGER));
+    INSERT OR IGNORE INTO RollupDirty VALUES (NEW.Station_ID,
+        CAST(strftime('%Y', NEW.Ride_Date) AS INTEGER), CAST(strftime('%m', NEW.Ride_Date) AS INTEGER));
+END;
+CREATE TRIGGER IF NOT EXISTS Ridership_rollup_delete AFTER DELETE ON Ridership
+BEGIN
+    INSERT OR IGNORE INTO RollupDirty VALUES (OLD.Station_ID,
+        CAST(strftime('%Y', OLD.Ride_Date) AS INTEGER), CAST(strftime('%m', OLD.Ride_Date) AS INTEGER));
+END;
+"""
+
+ROLLUP_FULL_BUILD = """
+DELETE FROM RidershipRollup;
+DELETE FROM RollupDirty;
+INSERT INTO RidershipRollup
+SELECT Station_ID, Ride_Year, Ride_Month, Type_of_Day, SUM(Num_Riders)
+FROM Ridership GROUP BY 1, 2, 3, 4;
+"""
+
+# Builds the rollup tables the first time, afterwards only recomputes the (station, year, month)
+# groups that the triggers marked as dirty. Returns the number of groups that were recomputed.
+def refresh_rollups(dbConn):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'RidershipRollup'")
+    if dbCursor.fetchone()[0] == 0:
+        # schema, triggers and the first full scan go in one transaction so an interrupted
+        # build never leaves behind an empty rollup that looks current
+        try:
+            dbCursor.executescript("BEGIN;" + ridership_schema(dbConn, ROLLUP_SCHEMA) + ROLLUP_FULL_BUILD + "COMMIT;")
+        except sqlite3.Error:
+            dbConn.rollback()
+            raise
+        dbCursor.execute("SELECT COUNT(*) FROM (SELECT DISTINCT Station_ID, Year, Month FROM RidershipRollup)")
+        return dbCursor.fetchone()[0]
+
+    dbCursor.execute("SELECT COUNT(*) FROM RollupDirty")
+    num_dirty = dbCursor.fetchone()[0]
+    if num_dirty == 0:
+        return 0
+    with dbConn:
+        dbCursor.execute("""DELETE FROM RidershipRollup
+                         WHERE (Station_ID, Year, Month) IN (SELECT Station_ID, Year, Month FROM RollupDirty)""")
+        # the Ride_Day range keeps the lookup on the (Station_ID, Ride_Day) index instead of a full scan;
+        # CROSS JOIN makes RollupDirty the outer loop, which the planner does not pick on its own
+        dbCursor.execute("""INSERT INTO RidershipRollup
+                         SELECT Ridership.Station_ID, RollupDirty.Year, RollupDirty.Month, Ridership.Type_of_Day,
+                                SUM(Ridership.Num_Riders)
+                         FROM RollupDirty CROSS JOIN Ridership ON Ridership.Station_ID = RollupDirty.Station_ID
+                         AND Ridership.Ride_Day >= julianday(printf('%04d-%02d-01', RollupDirty.Year, RollupDirty.Month)) - 2440587.5
+                         AND Ridership.Ride_Day < julianday(printf('%04d-%02d-01', RollupDirty.Year + (RollupDirty.Month = 12),
+                                                                   RollupDirty.Month % 12 + 1)) - 2440587.5
+                         GROUP BY 1, 2, 3, 4""")
+        dbCursor.execute("DELETE FROM RollupDirty")
+    return num_dirty
+
+# The rollups can answer a query when they exist and no Ridership change is waiting to be folded in
+def rollups_current(dbConn):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('RidershipRollup', 'RollupDirty')")
+    if dbCursor.fetchone()[0] < 2:
+        return False
+    dbCursor.execute("SELECT EXISTS (SELECT 1 FROM RollupDirty)")
+    return dbCursor.fetchone()[0] == 0
+
+##################################################################
+#
+# Columnar engine
+#
+# Optional (--columnar, needs numpy). Ridership is loaded once into four
+# arrays sorted by (Station_ID, Ride_Day) and saved as .npy files in a
+# "<database>.columns" directory, so later runs only memory-map them.
+# Commands 2, 3, 6, 7 and 8 then aggregate slices of these arrays with
+# bincount instead of querying Ridership. The arrays are loaded again when
+# the database stamp (see database_stamp) moves, so writes by another
+# process show up in the next command.
+#
+COLUMNAR_COLUMNS = ("station_id", "ride_day", "day_type", "riders")
+DAY_TYPES = ("W", "A", "U")
+
+columnar_engines = {}
+
+# Imports numpy on first use; returns None when it is not installed
+def import_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
+
+# File name of the main database of a connection ('' for an in-memory database)
+def database_path(dbConn):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("PRAGMA database_list")
+    for _, name, path in dbCursor.fetchall():
+        if name == "main":
+            return path
+    return ""
+
+# Stamp of the database contents that files and cached results made from it are tagged with: the
+# GeneralStats Data_Version (moved by every write to Ridership, Stations and Stops) and the size and
+# mtime of the database file and of its -wal file. In WAL mode a commit only reaches the database
+# file at the next checkpoint, and two commits can fall within one mtime tick, so the file alone
+# cannot tell every version apart; the files cover writes to the other tables.
+def database_stamp(dbConn):
+    dbCursor = dbConn.cursor()
+    try:
+        row = dbCursor.execute("SELECT Data_Version FROM GeneralStats WHERE Id = 1").fetchone()
+    except sqlite3.Error:
+        row = None
+    stamp = {"data_version": row[0] if row else None}
+    db_path = database_path(dbConn)
+    for prefix, path in (("", db_path), ("wal_", db_path + "-wal")):
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            file_stat = None
+        # an empty -wal file holds no commits and is deleted when the last connection closes
+        if file_stat is None or file_stat.st_size == 0:
+            stamp[prefix + "mtime_ns"], stamp[prefix + "size"] = 0, 0
+        else:
+            stamp[prefix + "mtime_ns"], stamp[prefix + "size"] = file_stat.st_mtime_ns, file_stat.st_size
+    return stamp
+
+# Keeps the files made from the database in directory current. meta.json holds the database stamp
+# they were made for and {name: file name} as returned by build(dbConn, directory); when the stamp
+# does not match, build is called again. Returns {name: file name}.
+def derived_files(dbConn, directory, build):
+    meta_path = os.path.join(directory, "meta.json")
+    stamp = database_stamp(dbConn)
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        meta = {}
+    if {name: meta.get(name) for name in stamp} != stamp or not isinstance(meta.get("files"), dict):
+        os.makedirs(directory, exist_ok=True)
+        # the stamp is written last, so an interrupted build is redone next time
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        meta = dict(stamp, files=build(dbConn, directory))
+        with open(meta_path, "w") as meta_file:
+            json.dump(meta, meta_file)
+    return meta["files"]
+
+# Reads Ridership into numpy arrays in (Station_ID, Ride_Day) order, in batches of rows
+def build_columnar(dbConn, batch_size=100000):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT COUNT(*) FROM Ridership")
+    num_rows = dbCursor.fetchone()[0]
+    columns = {"station_id": np.empty(num_rows, np.int32), "ride_day": np.empty(num_rows, np.int32),
+               "day_type": np.empty(num_rows, np.int8), "riders": np.empty(num_rows, np.int64)}
+    day_codes = {day_type: code for code, day_type in enumerate(DAY_TYPES)}
+
+    dbCursor.execute("SELECT Station_ID, Ride_Day, Type_of_Day, Num_Riders FROM Ridership ORDER BY Station_ID, Ride_Day")
+    pos = 0
+    while True:
+        rows = dbCursor.fetchmany(batch_size)
+        if not rows:
+            break
+        station_ids, ride_days, day_types, riders = zip(*rows)
+        end = pos + len(rows)
+        columns["station_id"][pos:end] = station_ids
+        columns["ride_day"][pos:end] = ride_days
+        columns["day_type"][pos:end] = [day_codes.get(day_type, len(DAY_TYPES)) for day_type in day_types]
+        columns["riders"][pos:end] = [num_riders or 0 for num_riders in riders]
+        pos = end
+    return columns
+
+# Saves the arrays as .npy files in directory; returns {column: file name}. Each file is written
+# under a temporary name and then renamed, so arrays still mapped from the old file stay readable.
+def save_columnar(dbConn, directory):
+    columns = build_columnar(dbConn)
+    for name in COLUMNAR_COLUMNS:
+        path = os.path.join(directory, name + ".npy")
+        np.save(path + ".tmp.npy", columns[name])
+        os.replace(path + ".tmp.npy", path)
+    return {name: name + ".npy" for name in COLUMNAR_COLUMNS}
+
+# Loads the arrays, rebuilding the .npy files when the database changed since they were saved
+def load_columnar(dbConn):
+    db_path = database_path(dbConn)
+    if not db_path:
+        columns = build_columnar(dbConn)
+    else:
+        directory = db_path + ".columns"
+        files = derived_files(dbConn, directory, save_columnar)
+        columns = {name: np.load(os.path.join(directory, files[name]), mmap_mode="r") for name in COLUMNAR_COLUMNS}
+
+    # rows of each station are contiguous, so a station is just a [start, end) slice
+    station_id = columns["station_id"]
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(station_id)) + 1, [len(station_id)])) if len(station_id) else np.zeros(1, np.int64)
+    columns["station_rows"] = {int(station_id[start]): (int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])}
+    return columns
+
+# Turns on the columnar engine for this connection. Returns {"engine", "stamp", "lock"}, which
+# can be given to other connections to the same database (see run_server), or None without numpy.
+def enable_columnar(dbConn):
+    if import_numpy() is None:
+        print("**numpy is not installed, the columnar engine is not available")
+        return None
+    start = time.perf_counter()
+    # the stamp is read first, so a write during the load makes the next command load again
+    stamp = database_stamp(dbConn)
+    columnar = {"engine": load_columnar(dbConn), "stamp": stamp, "lock": threading.Lock()}
+    columnar_engines[dbConn] = columnar
+    print(f"Columnar engine ready ({len(columnar['engine']['riders']):,} rows in {time.perf_counter() - start:.2f} s)")
+    return columnar
+
+# The columnar engine of this connection, loaded again when the database changed since it was
+# loaded, or None when queries go to SQLite
+def get_columnar(dbConn):
+    columnar = columnar_engines.get(dbConn)
+    if columnar is None:
+        return None
+    if database_stamp(dbConn) != columnar["stamp"]:
+        with columnar["lock"]:
+            stamp = database_stamp(dbConn)
+            if stamp != columnar["stamp"]:
+                columnar["engine"] = load_columnar(dbConn)
+                columnar["stamp"] = stamp
+    return columnar["engine"]
+
+# Sums riders per distinct key, returned as (sorted keys, integer sums)
+def columnar_group_sum(keys, riders):
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=riders, minlength=len(unique_keys))
+    return unique_keys, sums.round().astype(np.int64)
+
+# Ride_Day values and riders of one station, optionally restricted to one year
+def columnar_station_slice(engine, station_id, year=None):
+    start, end = engine["station_rows"].get(station_id, (0, 0))
+    ride_day = engine["ride_day"][start:end]
+    riders = engine["riders"][start:end]
+    if year is not None:
+        start_day, end_day = year_day_range(year)
+        first, last = np.searchsorted(ride_day, [start_day, end_day])
+        ride_day, riders = ride_day[first:last], riders[first:last]
+    return ride_day, riders
+
+# (total, weekday, saturday, sunday/holiday) riders of a station, or None without data
+def columnar_day_type_totals(engine, station_id):
+    start, end = engine["station_rows"].get(station_id, (0, 0))
+    if start == end:
+        return None
+    totals = np.bincount(engine["day_type"][start:end], weights=engine["riders"][start:end], minlength=len(DAY_TYPES) + 1)
+    totals = [int(round(total)) for total in totals]
+    return sum(totals), totals[0], totals[1], totals[2]
+
+# Same rows as the command 3 query: (station name, weekday riders), busiest first
+def columnar_weekday_ridership(engine, catalog):
+    weekday = engine["day_type"] == 0
+    station_ids, sums = columnar_group_sum(engine["station_id"][weekday], engine["riders"][weekday])
+    return totals_by_station_name(catalog, zip(station_ids.tolist(), sums.tolist()))
+
+# Same rows as the command 6 query: (year, riders)
+def columnar_yearly(engine, station_id):
+    ride_day, riders = columnar_station_slice(engine, station_id)
+    years = ride_day.astype("datetime64[D]").astype("datetime64[Y]").astype(np.int64) + 1970
+    years, sums = columnar_group_sum(years, riders)
+    return [(f"{year:04d}", total) for year, total in zip(years.tolist(), sums.tolist())]
+
+# Same rows as the command 7 query: (mm/yyyy, riders)
+def columnar_monthly(engine, station_id, year):
+    ride_day, riders = columnar_station_slice(engine, station_id, year)
+    months = ride_day.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64) % 12 + 1
+    months, sums = columnar_group_sum(months, riders)
+    return [(f"{month:02d}/{int(year):04d}", total) for month, total in zip(months.tolist(), sums.tolist())]
+
+# Riders of a station on each day of the year with data for command 8, as {Ride_Day: riders}
+def columnar_daily(engine, station_id, year):
+    ride_day, riders = columnar_station_slice(engine, station_id, year)
+    days, sums = columnar_group_sum(ride_day, riders)
+    return dict(zip(days.tolist(), sums.tolist()))
+
+##################################################################
+#
+# Year shards
+#
+# Optional (--shards). Ridership is copied into one SQLite file per year
+# in a "<database>.shards" directory. When the database changes (same stamp
+# as the column store, also checked before each command), the row count and
+# checksum of each year are compared with the ones stored in its file and
+# only the years that differ are copied again. Full-history aggregations - commands 3 and 6 -
+# run on every shard at once in a process pool and the partial sums are
+# merged; commands 7 and 8 ask only the shard of their year. Each shard holds Station_ID, Ride_Day,
+# Ride_Month, Type_of_Day and Num_Riders in (Station_ID, Ride_Day) order,
+# with an index on those two columns. The workers have their own
+# connections, so the query monitor times shard queries in this process
+# (from submitting them to having all rows) and lists them as
+# "[N year shards] SQL" with the plan of one shard.
+#
+SHARD_SCHEMA = """CREATE TABLE shard.Ridership (
+    Station_ID INTEGER NOT NULL,
+    Ride_Day INTEGER NOT NULL,
+    Ride_Month INTEGER NOT NULL,
+    Type_of_Day TEXT,
+    Num_Riders INTEGER
+)"""
+
+SHARD_FILL = """INSERT INTO shard.Ridership
+SELECT Station_ID, Ride_Day, Ride_Month, Type_of_Day, Num_Riders FROM main.Ridership
+WHERE Ride_Day >= ? AND Ride_Day < ? ORDER BY Station_ID, Ride_Day"""
+
+# (year, rows, checksum) of every year of Ridership in one grouped pass; each row adds a value mixing
+# its station, day, day type and riders, so moving riders from one row to another changes the sum
+SHARD_CHECKSUMS = """SELECT Ride_Year, COUNT(*),
+       SUM((Station_ID * 1000003 + Ride_Day) % 2147483647
+           * (COALESCE(Num_Riders, -1) * 131 + unicode(COALESCE(Type_of_Day, '?'))) % 2147483647)
+FROM Ridership GROUP BY Ride_Year"""
+
+shard_sets = {}
+
+# (rows, checksum) stored in a shard file, or None when it is missing or unreadable
+def shard_checksum(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        shardConn = shard_connection(path)
+        try:
+            return shardConn.execute("SELECT Num_Rows, Checksum FROM ShardChecksum").fetchone()
+        finally:
+            shardConn.close()
+    except sqlite3.Error:
+        return None
+
+# Copies each year of Ridership whose rows differ from its file in directory; returns {year: file name}
+def build_shards(dbConn, directory):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute(SHARD_CHECKSUMS)
+    checksums = {year: (num_rows, checksum) for year, num_rows, checksum in dbCursor.fetchall() if year is not None}
+    shard_files = {}
+    for year, checksum in sorted(checksums.items()):
+        file_name = f"ridership_{year}.db"
+        shard_files[year] = file_name
+        path = os.path.join(directory, file_name)
+        if shard_checksum(path) == checksum:
+            continue
+        if os.path.exists(path):
+            os.remove(path)
+        dbCursor.execute("ATTACH DATABASE ? AS shard", (path,))
+        try:
+            with dbConn:
+                dbCursor.execute(SHARD_SCHEMA)
+                dbCursor.execute(SHARD_FILL, year_day_range(year))
+                dbCursor.execute("CREATE INDEX shard.Shard_Station_Day ON Ridership (Station_ID, Ride_Day)")
+                dbCursor.execute("CREATE TABLE shard.ShardChecksum (Num_Rows INTEGER, Checksum INTEGER)")
+                dbCursor.execute("INSERT INTO shard.ShardChecksum VALUES (?, ?)", checksum)
+        finally:
+            dbCursor.execute("DETACH DATABASE shard")
+
+    # files of years that no longer have rows
+    for file_name in os.listdir(directory):
+        if re.fullmatch(r"ridership_-?\d+\.db", file_name) and file_name not in shard_files.values():
+            os.remove(os.path.join(directory, file_name))
+    return shard_files
+
+# Opens the shards of the database, rebuilding them when the database changed since they were made
+def load_shards(dbConn):
+    directory = database_path(dbConn) + ".shards"
+    shard_files = derived_files(dbConn, directory, build_shards)
+    return {int(year): os.path.join(directory, file_name) for year, file_name in sorted(shard_files.items(), key=lambda item: int(item[0]))}
+
+# Turns on the year shards for this connection; queries fan out over at most max_workers processes
+def enable_shards(dbConn, max_workers=None):
+    if not database_path(dbConn):
+        print("**Year shards need a database file")
+        return None
+    start = time.perf_counter()
+    # the stamp is read first, so a write during the load makes the next command load again
+    stamp = database_stamp(dbConn)
+    shards = {"paths": load_shards(dbConn), "stamp": stamp, "max_workers": max_workers or os.cpu_count() or 1,
+              "executor": None, "connection": dbConn}
+    shard_sets[dbConn] = shards
+    print(f"Year shards ready ({len(shards['paths'])} years in {time.perf_counter() - start:.2f} s)")
+    return shards
+
+# The year shards of this connection, brought up to date when the database changed since they were
+# loaded, or None when queries go to the main database
+def get_shards(dbConn):
+    shards = shard_sets.get(dbConn)
+    if shards is not None:
+        stamp = database_stamp(dbConn)
+        if stamp != shards["stamp"]:
+            shards["paths"] = load_shards(dbConn)
+            shards["stamp"] = stamp
+    return shards
+
+# Shuts down the worker processes of the connection's shards
+def close_shards(dbConn):
+    shards = shard_sets.pop(dbConn, None)
+    if shards is not None and shards["executor"] is not None:
+        shards["executor"].shutdown()
+
+# Read-only connection to one shard file
+def shard_connection(shard_path):
+    import urllib.parse
+    return sqlite3.connect(f"file:{urllib.parse.quote(shard_path)}?mode=ro", uri=True)
+
+# Runs one query against one shard file and returns all its rows (the task the worker processes run)
+def run_shard_query(shard_path, sql, params=()):
+    shardConn = shard_connection(shard_path)
+    try:
+        return shardConn.execute(sql, params).fetchall()
+    finally:
+        shardConn.close()
+
+# Pool of max_workers processes to run task in. Worker processes find task by module name,
+# so when this file was loaded under another name (e.g. with runpy) threads are used instead;
+# SQLite releases the GIL while it runs a query, so they still run in parallel.
+def worker_pool(task, max_workers):
+    import concurrent.futures
+    module = sys.modules.get(task.__module__)
+    if getattr(module, task.__name__, None) is task:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+# Worker pool of the shards, started on the first fan-out
+def shard_executor(shards):
+    if shards["executor"] is None:
+        shards["executor"] = worker_pool(run_shard_query, shards["max_workers"])
+    return shards["executor"]
+
+# Adds a query that ran on the shards to the query monitor of the connection (if it is monitored),
+# with the time it took in this process and the plan it has on the shard at shard_path
+def record_shard_query(shards, shard_path, num_shards, sql, params, seconds, num_rows):
+    monitor = query_monitors.get(shards["connection"])
+    if monitor is None:
+        return
+    label = f"[{num_shards} year shard{'s' if num_shards != 1 else ''}] {sql}"
+    if label not in monitor["plans"]:
+        shardConn = shard_connection(shard_path)
+        try:
+            monitor["plans"][label] = [row[-1] for row in shardConn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.Error:
+            monitor["plans"][label] = []
+        finally:
+            shardConn.close()
+    record_statement(shards["connection"], {"sql": label, "params": params, "execute": seconds, "fetch": 0.0, "rows": num_rows})
+
+# Runs the query on every shard in parallel; returns [(year, rows)] in year order
+def shard_fan_out(shards, sql, params=()):
+    start = time.perf_counter()
+    years = list(shards["paths"])
+    paths = [shards["paths"][year] for year in years]
+    results = list(shard_executor(shards).map(run_shard_query, paths, itertools.repeat(sql), itertools.repeat(params)))
+    if paths:
+        record_shard_query(shards, paths[0], len(paths), sql, params, time.perf_counter() - start,
+                           sum(len(rows) for rows in results))
+    return list(zip(years, results))
+
+# Runs the query on one shard in this process; returns all its rows
+def shard_query(shards, shard_path, sql, params=()):
+    start = time.perf_counter()
+    rows = run_shard_query(shard_path, sql, params)
+    record_shard_query(shards, shard_path, 1, sql, params, time.perf_counter() - start, len(rows))
+    return rows
+
+# The shard file of a year ('' when there is no data for it)
+def shard_for_year(shards, year):
+    try:
+        return shards["paths"].get(int(year), "")
+    except ValueError:
+        return ""
+
+# Same result as get_weekday_ridership, from the per-shard sums of each station
+def sharded_weekday_ridership(shards, catalog):
+    totals = {}
+    for _, rows in shard_fan_out(shards, "SELECT Station_ID, SUM(Num_Riders) FROM Ridership WHERE Type_of_Day = 'W' GROUP BY Station_ID"):
+        for station_id, riders in rows:
+            totals[station_id] = totals.get(station_id, 0) + riders
+    return totals_by_station_name(catalog, sorted(totals.items()))
+
+# Same rows as the command 6 query: (yyyy, riders), one shard per year
+def sharded_yearly(shards, station_id):
+    return [(f"{year:04d}", rows[0][0]) for year, rows
+            in shard_fan_out(shards, "SELECT SUM(Num_Riders) FROM Ridership WHERE Station_ID = ?", (station_id,))
+            if rows[0][0] is not None]
+
+# Same rows as the command 7 query, from the one shard of the year
+def sharded_monthly(shards, station_id, ride_date):
+    shard_path = shard_for_year(shards, ride_date)
+    if not shard_path:
+        return []
+    return shard_query(shards, shard_path, """SELECT printf('%02d/%04d', Ride_Month, ?), SUM(Num_Riders) FROM Ridership
+                           WHERE Station_ID = ? GROUP BY Ride_Month ORDER BY Ride_Month ASC""", (int(ride_date), station_id))
+
+# (Station_ID, Ride_Day, riders) of the stations in one year, from the one shard of the year
+def sharded_daily(shards, station_ids, year_compare):
+    shard_path = shard_for_year(shards, year_compare)
+    if not shard_path:
+        return []
+    return shard_query(shards, shard_path, f"""SELECT Station_ID, Ride_Day, SUM(Num_Riders) FROM Ridership
+                           WHERE Station_ID IN ({', '.join('?' * len(station_ids))})
+                           GROUP BY Station_ID, Ride_Day""", tuple(station_ids))
+
+##################################################################
+#
+# Query monitor
+#
+# With --monitor every query a command runs goes through a MonitoredCursor
+# (see query_cursor), which records the execute and fetch time and the
+# number of rows of each statement. The EXPLAIN QUERY PLAN of each distinct
+# statement is captured the first time it runs, and plans that scan the
+# whole Ridership table are flagged. Statements that take at least slow_ms
+# are appended to the slow-query log. Each command run is timed with the
+# wall clock from begin_monitored_command to end_monitored_command, leaving
+# out the time spent waiting for the user (see wait_for_user), for the
+# latency histograms of the "stats" command; the time its statements took
+# is kept next to it, so work outside SQLite (the column store, the shard
+# workers, cache hits, formatting) shows as the difference.
+#
+FULL_SCAN_PATTERN = re.compile(r"^SCAN (TABLE )?Ridership(Data)?\b")
+PLANNED_STATEMENTS = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+# upper bounds (ms) of the histogram buckets; the last bucket is open-ended
+LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
+
+query_monitors = {}
+
+# Turns on query monitoring for this connection
+def enable_query_monitor(dbConn, slow_ms=100.0, slow_log=None):
+    query_monitors[dbConn] = {"slow_ms": slow_ms, "slow_log": slow_log, "statements": {}, "plans": {},
+                              "commands": {}, "command": None, "command_start": 0.0, "command_seconds": 0.0,
+                              "user_seconds": 0.0, "num_slow": 0, "pending": set()}
+
+# Cursor for a command's queries: a MonitoredCursor when the connection is monitored
+def query_cursor(dbConn):
+    if dbConn in query_monitors:
+        return dbConn.cursor(MonitoredCursor)
+    return dbConn.cursor()
+
+class MonitoredCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        self.finish_statement()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.statement = {"sql": sql, "params": params, "execute": time.perf_counter() - start, "fetch": 0.0, "rows": 0}
+            monitor = query_monitors.get(self.connection)
+            if monitor is not None:
+                monitor["pending"].add(self)
+
+    def fetch(self, fetch_function, *args):
+        start = time.perf_counter()
+        rows = fetch_function(*args)
+        statement = getattr(self, "statement", None)
+        if statement is not None:
+            statement["fetch"] += time.perf_counter() - start
+            return rows, statement
+        return rows, None
+
+    def fetchone(self):
+        row, statement = self.fetch(super().fetchone)
+        if statement is not None:
+            if row is None:
+                self.finish_statement()
+            else:
+                statement["rows"] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows, statement = self.fetch(super().fetchmany, self.arraysize if size is None else size)
+        if statement is not None:
+            statement["rows"] += len(rows)
+            if not rows:
+                self.finish_statement()
+        return rows
+
+    def fetchall(self):
+        rows, statement = self.fetch(super().fetchall)
+        if statement is not None:
+            statement["rows"] += len(rows)
+            self.finish_statement()
+        return rows
+
+    def close(self):
+        self.finish_statement()
+        super().close()
+
+    # Hands the statement that just completed to the monitor
+    def finish_statement(self):
+        statement = getattr(self, "statement", None)
+        self.statement = None
+        monitor = query_monitors.get(self.connection)
+        if monitor is not None:
+            monitor["pending"].discard(self)
+        if statement is not None:
+            record_statement(self.connection, statement)
+
+# EXPLAIN QUERY PLAN details of a statement, computed once per SQL text
+def query_plan(dbConn, monitor, sql, params):
+    if sql not in monitor["plans"]:
+        plan = []
+        if sql.lstrip().split(None, 1)[0].upper() in PLANNED_STATEMENTS:
+            try:
+                plan = [row[-1] for row in dbConn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            except sqlite3.Error:
+                pass
+        monitor["plans"][sql] = plan
+    return monitor["plans"][sql]
+
+def record_statement(dbConn, statement):
+    monitor = query_monitors.get(dbConn)
+    if monitor is None:
+        return
+    sql = " ".join(statement["sql"].split())
+    plan = query_plan(dbConn, monitor, statement["sql"], statement["params"])
+    full_scan = any(FULL_SCAN_PATTERN.match(detail) for detail in plan)
+    seconds = statement["execute"] + statement["fetch"]
+    monitor["command_seconds"] += seconds
+
+    totals = monitor["statements"].setdefault(sql, {"count": 0, "execute": 0.0, "fetch": 0.0, "rows": 0, "max": 0.0,
+                                                    "plan": plan, "full_scan": full_scan})
+    totals["count"] += 1
+    totals["execute"] += statement["execute"]
+    totals["fetch"] += statement["fetch"]
+    totals["rows"] += statement["rows"]
+    totals["max"] = max(totals["max"], seconds)
+
+    if seconds * 1000 >= monitor["slow_ms"]:
+        monitor["num_slow"] += 1
+        if monitor["slow_log"]:
+            with open(monitor["slow_log"], "a", encoding="utf-8") as log:
+                log.write(f"{datetime.datetime.now().isoformat(timespec='seconds')} command={monitor['command']}"
+                          f" time={seconds * 1000:.1f}ms (execute {statement['execute'] * 1000:.1f}, fetch {statement['fetch'] * 1000:.1f})"
+                          f" rows={statement['rows']}{' FULL SCAN Ridership' if full_scan else ''}"
+                          f" sql={sql!r} params={list(statement['params'])!r} plan={' | '.join(plan)!r}\n")
+
+# Records the statements whose rows were not read to the end under the current command (if any)
+def flush_monitored_statements(monitor):
+    for cursor in list(monitor["pending"]):
+        cursor.finish_statement()
+
+# Marks the start and end of a command run; its time and its query time go into that command's histogram.
+# Statements still pending from before (e.g. the startup statistics) are recorded without a command.
+def begin_monitored_command(dbConn, command):
+    monitor = query_monitors.get(dbConn)
+    if monitor is not None:
+        monitor["command"] = None
+        flush_monitored_statements(monitor)
+        monitor["command"] = command
+        monitor["command_seconds"] = 0.0
+        monitor["user_seconds"] = 0.0
+        monitor["command_start"] = time.perf_counter()
+
+# Records the statements whose rows were not read to the end, then the command's (time, query time)
+def end_monitored_command(dbConn):
+    monitor = query_monitors.get(dbConn)
+    if monitor is None:
+        return
+    flush_monitored_statements(monitor)
+    if monitor["command"] is not None:
+        seconds = time.perf_counter() - monitor["command_start"] - monitor["user_seconds"]
+        monitor["commands"].setdefault(monitor["command"], []).append((seconds, monitor["command_seconds"]))
+        monitor["command"] = None
+
+# Runs function (a prompt or a plot window) and leaves the time it takes out of the command's time
+def wait_for_user(dbConn, function, *args):
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        monitor = query_monitors.get(dbConn)
+        if monitor is not None:
+            monitor["user_seconds"] += time.perf_counter() - start
+
+# (sorted milliseconds, p50, p99) of a list of durations in seconds
+def latency_percentiles(runs):
+    runs_ms = sorted(seconds * 1000 for seconds in runs)
+    return runs_ms, runs_ms[(len(runs_ms) - 1) // 2], runs_ms[min(math.ceil(len(runs_ms) * 0.99), len(runs_ms)) - 1]
+
+# Prints the per-command latency histograms and the statements that took the most time
+def print_query_monitor_stats(dbConn, num_statements=10):
+    monitor = query_monitors.get(dbConn)
+    if monitor is None:
+        print("**Query monitoring is off, start with --monitor...")
+        return
+    print("Time per command (wall clock without waiting for input; SQL = execute + fetch of its statements)")
+    if not monitor["commands"]:
+        print("  No commands run yet")
+    for command, runs in sorted(monitor["commands"].items()):
+        runs_ms, p50, p99 = latency_percentiles(seconds for seconds, _ in runs)
+        sql_ms, sql_p50, sql_p99 = latency_percentiles(sql_seconds for _, sql_seconds in runs)
+        print(f"  Command {command}: {len(runs_ms)} runs, p50 {p50:.1f} ms, p99 {p99:.1f} ms, max {runs_ms[-1]:.1f} ms;",
+              f"SQL p50 {sql_p50:.1f} ms, p99 {sql_p99:.1f} ms, max {sql_ms[-1]:.1f} ms")
+        lower = 0
+        for upper in LATENCY_BUCKETS_MS + (None,):
+            count = sum(1 for ms in runs_ms if ms >= lower and (upper is None or ms < upper))
+            label = f"{lower}-{upper} ms" if upper is not None else f">= {lower} ms"
+            if count:
+                print(f"    {label:>12} | {'#' * min(count, 50)} {count}")
+            lower = upper
+
+    statements = sorted(monitor["statements"].items(), key=lambda item: item[1]["execute"] + item[1]["fetch"], reverse=True)
+    print(f"\nStatements by total time (top {num_statements})")
+    for sql, totals in statements[:num_statements]:
+        total_ms = (totals["execute"] + totals["fetch"]) * 1000
+        print(f"  {totals['count']:>5} x, {total_ms:,.1f} ms total (fetch {totals['fetch'] * 1000:,.1f}),",
+              f"max {totals['max'] * 1000:.1f} ms, {totals['rows']:,} rows{'  ** FULL SCAN Ridership **' if totals['full_scan'] else ''}")
+        print(f"        {sql[:120]}{'...' if len(sql) > 120 else ''}")
+        for detail in totals["plan"]:
+            print(f"          {detail}")
+    log_note = f", logged to {monitor['slow_log']}" if monitor["slow_log"] else ""
+    print(f"\nSlow queries (>= {monitor['slow_ms']:g} ms): {monitor['num_slow']}{log_note}")
+
+##################################################################
+#
+# Query result cache
+#
+# cached_query runs a SELECT and keeps its rows in an LRU cache keyed by the
+# SQL text (whitespace collapsed) and the parameters. Entries expire after
+# ttl seconds, and the whole cache is dropped as soon as the database
+# changes: PRAGMA data_version moves when another connection commits and
+# total_changes when this connection writes. With a cache file the rows are
+# also kept in a sidecar SQLite database, tagged with the database_stamp
+# they were computed for. Rows with another stamp are deleted when they are
+# looked up, rows stored before this process last dropped its cache are not
+# used, and the file keeps at most max_entries rows (the oldest go first).
+#
+QUERY_CACHE_SCHEMA = """CREATE TABLE IF NOT EXISTS QueryCache (
+    Cache_Key TEXT PRIMARY KEY,
+    Db_Stamp TEXT NOT NULL,
+    Stored_At REAL NOT NULL,
+    Result TEXT NOT NULL
+)"""
+
+query_caches = {}
+
+# Turns on the result cache for this connection
+def enable_query_cache(dbConn, max_entries=256, ttl=None, cache_file=None):
+    cache = {"entries": OrderedDict(), "max_entries": max_entries, "ttl": ttl, "version": None,
+             "db_path": database_path(dbConn), "sidecar": None, "sidecar_stamp": None, "invalidated_at": 0.0,
+             "hits": 0, "sidecar_hits": 0, "misses": 0, "invalidations": 0}
+    if cache_file and cache["db_path"]:
+        sidecar = sqlite3.connect(cache_file)
+        sidecar.execute(QUERY_CACHE_SCHEMA)
+        cache["sidecar"] = sidecar
+    query_caches[dbConn] = cache
+    return cache
+
+# (PRAGMA data_version, total_changes) of a connection; changes after every commit to the
+# database, whether it came from this connection or from another one
+def connection_version(dbConn):
+    return dbConn.execute("PRAGMA data_version").fetchone()[0], dbConn.total_changes
+
+# Runs a query and returns all its rows, through the result cache when the connection has one
+def cached_query(dbConn, sql, params=()):
+    dbCursor = query_cursor(dbConn)
+    cache = query_caches.get(dbConn)
+    if cache is None:
+        dbCursor.execute(sql, params)
+        return dbCursor.fetchall()
+
+    version = connection_version(dbConn)
+    if version != cache["version"]:
+        if cache["entries"]:
+            cache["invalidations"] += 1
+        if cache["version"] is not None:
+            cache["invalidated_at"] = time.time()
+        cache["entries"].clear()
+        cache["version"] = version
+
+    key = json.dumps([" ".join(sql.split()), list(params)])
+    now = time.time()
+    entry = cache["entries"].get(key)
+    if entry is not None and (cache["ttl"] is None or now - entry[0] <= cache["ttl"]):
+        cache["entries"].move_to_end(key)
+        cache["hits"] += 1
+        return list(entry[1])
+
+    rows = None
+    stored_at = now
+    sidecar = cache["sidecar"]
+    if sidecar is not None:
+        db_stamp = json.dumps(database_stamp(dbConn), sort_keys=True)
+        if db_stamp != cache["sidecar_stamp"]:
+            with sidecar:
+                sidecar.execute("DELETE FROM QueryCache WHERE Db_Stamp <> ?", (db_stamp,))
+            cache["sidecar_stamp"] = db_stamp
+        row = sidecar.execute("SELECT Stored_At, Result FROM QueryCache WHERE Cache_Key = ? AND Db_Stamp = ?",
+                              (key, db_stamp)).fetchone()
+        if (row is not None and row[0] > cache["invalidated_at"]
+                and (cache["ttl"] is None or now - row[0] <= cache["ttl"])):
+            stored_at = row[0]
+            rows = [tuple(result_row) for result_row in json.loads(row[1])]
+            cache["sidecar_hits"] += 1
+
+    if rows is None:
+        cache["misses"] += 1
+        dbCursor.execute(sql, params)
+        rows = dbCursor.fetchall()
+        if sidecar is not None:
+            with sidecar:
+                sidecar.execute("INSERT OR REPLACE INTO QueryCache VALUES (?, ?, ?, ?)",
+                                (key, db_stamp, stored_at, json.dumps(rows)))
+                sidecar.execute("""DELETE FROM QueryCache WHERE Cache_Key NOT IN
+                                (SELECT Cache_Key FROM QueryCache ORDER BY Stored_At DESC LIMIT ?)""", (cache["max_entries"],))
+
+    cache["entries"][key] = (stored_at, rows)
+    cache["entries"].move_to_end(key)
+    while len(cache["entries"]) > cache["max_entries"]:
+        cache["entries"].popitem(last=False)
+    return list(rows)
+
+# Hit/miss counters of the connection's result cache (None without a cache)
+def query_cache_stats(dbConn):
+    cache = query_caches.get(dbConn)
+    if cache is None:
+        return None
+    stats = {name: cache[name] for name in ("hits", "sidecar_hits", "misses", "invalidations")}
+    stats["entries"] = len(cache["entries"])
+    return stats
+
+# Prints the counters of the result cache
+def print_query_cache_stats(dbConn):
+    stats = query_cache_stats(dbConn)
+    if stats is None:
+        return
+    lookups = stats["hits"] + stats["sidecar_hits"] + stats["misses"]
+    hit_rate = (stats["hits"] + stats["sidecar_hits"]) / lookups * 100 if lookups else 0.0
+    print(f"Query cache: {stats['hits']:,} hits, {stats['sidecar_hits']:,} cache file hits, {stats['misses']:,} misses",
+          f"({hit_rate:.1f}% hit rate), {stats['invalidations']:,} invalidations, {stats['entries']:,} entries")
+
+##################################################################
+#
+# Station catalog
+#
+# The Stations table is small, so it is read into name/ID maps plus a
+# sorted list of lower-case names, and read again only after a commit to
+# the database (see connection_version). Station patterns
+# (SQL LIKE syntax with _ and %) are matched in memory and every command
+# works with the resolved Station_ID from then on.
+#
+station_catalogs = {}
+
+# Reads Stations into the lookup structures
+def build_station_catalog(dbConn):
+    dbCursor = query_cursor(dbConn)
+    dbCursor.execute("SELECT Station_ID, Station_Name FROM Stations ORDER BY Station_Name ASC")
+    stations = dbCursor.fetchall()
+    by_lower = {}
+    for station_id, name in stations:
+        by_lower.setdefault(name.lower(), []).append((station_id, name))
+    return {"by_id": dict(stations), "by_name": {name: station_id for station_id, name in reversed(stations)},
+            "by_lower": by_lower, "lower_names": sorted(by_lower), "stations": stations}
+
+# Returns the catalog for this connection, building it on first use and again when the database changed
+def get_station_catalog(dbConn):
+    version = connection_version(dbConn)
+    catalog = station_catalogs.get(dbConn)
+    if catalog is None or catalog["version"] != version:
+        catalog = dict(build_station_catalog(dbConn), version=version)
+        station_catalogs[dbConn] = catalog
+    return catalog
+
+# Compiles a LIKE pattern into a case-insensitive regular expression
+def like_to_regex(pattern):
+    parts = [".*" if ch == "%" else "." if ch == "_" else re.escape(ch) for ch in pattern]
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+# Stations whose name starts with prefix (ignoring case) as (Station_ID, Station_Name)
+def stations_with_prefix(catalog, prefix):
+    prefix = prefix.lower()
+    lower_names = catalog["lower_names"]
+    matches = []
+    for lower_name in lower_names[bisect.bisect_left(lower_names, prefix):]:
+        if not lower_name.startswith(prefix):
+            break
+        matches.extend(catalog["by_lower"][lower_name])
+    return sorted(matches, key=lambda station: station[1])
+
+# Stations matching a LIKE pattern as (Station_ID, Station_Name), ordered by name like
+# "WHERE Station_Name LIKE ? ORDER BY Station_Name ASC"
+def match_stations(catalog, pattern):
+    wildcards = pattern.count("%") + pattern.count("_")
+    if wildcards == 0:
+        return sorted(catalog["by_lower"].get(pattern.lower(), []), key=lambda station: station[1])
+    if wildcards == 1 and pattern.endswith("%"):
+        return stations_with_prefix(catalog, pattern[:-1])
+    regex = like_to_regex(pattern)
+    return [(station_id, name) for station_id, name in catalog["stations"] if regex.fullmatch(name)]
+
+# Station names that look like the given pattern, for "did you mean" hints
+def suggest_stations(catalog, pattern, num_suggestions=3):
+    cleaned = pattern.replace("%", "").replace("_", " ").strip().lower()
+    if not cleaned:
+        return []
+    close = difflib.get_close_matches(cleaned, catalog["lower_names"], n=num_suggestions, cutoff=0.6)
+    return [catalog["by_lower"][lower_name][0][1] for lower_name in close]
+
+# Prints the suggestions (if any) after a failed station lookup
+def print_suggestions(catalog, pattern):
+    suggestions = suggest_stations(catalog, pattern)
+    if suggestions:
+        print(f"  Did you mean: {', '.join(suggestions)}?")
+
+# Merges (Station_ID, riders) totals per station name, busiest first
+def totals_by_station_name(catalog, station_totals):
+    totals = {}
+    for station_id, total in station_totals:
+        if station_id in catalog["by_id"]:
+            name = catalog["by_id"][station_id]
+            totals[name] = totals.get(name, 0) + total
+    return sorted(totals.items(), key=lambda row: row[1], reverse=True)
+
 # Command 1
 # Find all the station names that matches the user input
 def station_match(dbConn, partialStation_name):
-    dbCursor = dbConn.cursor()
-
-    # Retrieves the station_id and the station name from the database to match the user input
-    dbCursor.execute("SELECT Station_ID, Station_Name FROM Stations WHERE Station_Name LIKE ? ORDER BY Station_Name ASC",
-                     (f"{partialStation_name}",))
-    rows = dbCursor.fetchall()
+    # Matches the user input against the station catalog
+    catalog = get_station_catalog(dbConn)
+    rows = match_stations(catalog, partialStation_name)
     if rows:
         for row in rows:
             print(f"{row[0]} : {row[1]}")
     else:
         print("**No stations found...")
+        print_suggestions(catalog, partialStation_name)
+    return rows
 
 # Command 2
-# Finds the percentages of the riders on weekdays, Saturdays, sundays/holidays
-def get_percentages(dbConn, station_name):
-    dbCursor = dbConn.cursor()
-    dbCursor.execute("SELECT SUM(Num_Riders) FROM Ridership WHERE Station_ID = (SELECT Station_ID FROM Stations WHERE Station_Name = ?)", (station_name,))
-    tot_ridership = dbCursor.fetchone()[0]
-    if tot_ridership is None:
-        print(f"**No data found...")
-        return None, None, None
+# The total and the sum of each day type per station, in one grouped pass over table; {where} can limit the stations
+DAY_TYPE_BREAKDOWN = """SELECT Station_ID, SUM(Num_Riders),
+       SUM(CASE WHEN Type_of_Day = 'W' THEN Num_Riders ELSE 0 END),
+       SUM(CASE WHEN Type_of_Day = 'A' THEN Num_Riders ELSE 0 END),
+       SUM(CASE WHEN Type_of_Day = 'U' THEN Num_Riders ELSE 0 END)
+FROM {table} {where} GROUP BY Station_ID"""
 
-    # retrieves the Ridership total for weekday
-    dbCursor.execute("SELECT SUM(Num_Riders) FROM Ridership WHERE Station_ID = (SELECT Station_ID FROM Stations WHERE Station_Name = ?) AND Type_of_Day = 'W'",(station_name,))
-    weekday_total = dbCursor.fetchone()[0]
+# longer station lists are answered from a scan of every station rather than an IN list
+MAX_STATION_PARAMS = 500
 
-    # retrieves the ridership total for saturday
-    dbCursor.execute("SELECT SUM(Num_Riders) FROM Ridership WHERE Station_ID = (SELECT Station_ID FROM Stations WHERE Station_Name = ?) AND Type_of_Day = 'A'",(station_name,))
-    saturday_total = dbCursor.fetchone()[0]
+# Riders per station as {Station_ID: (total, weekday, saturday, sunday/holiday)} for the given
+# stations (every station when station_ids is None), read in a single grouped pass
+def day_type_breakdown(dbConn, station_ids=None):
+    wanted = None if station_ids is None else {station_id for station_id in station_ids if station_id is not None}
+    if wanted is not None and not wanted:
+        return {}
+    # a list of every station is answered like no list at all, only keeping the stations asked for
+    scan_all = wanted is None or len(wanted) > MAX_STATION_PARAMS or wanted >= set(get_station_catalog(dbConn)["by_id"])
+    engine = get_columnar(dbConn)
+    if engine is not None:
+        breakdown = {station_id: columnar_day_type_totals(engine, station_id)
+                     for station_id in (engine["station_rows"] if wanted is None else wanted)}
+        return {station_id: totals for station_id, totals in breakdown.items() if totals is not None}
+
+    where, params = "", ()
+    if not scan_all:
+        where, params = f"WHERE Station_ID IN ({', '.join('?' * len(wanted))})", tuple(sorted(wanted))
+    shards = get_shards(dbConn)
+    if shards is not None:
+        sql = DAY_TYPE_BREAKDOWN.format(table="Ridership", where=where)
+        rows = [row for _, shard_rows in shard_fan_out(shards, sql, params) for row in shard_rows]
+    else:
+        table = "RidershipRollup" if rollups_current(dbConn) else "Ridership"
+        rows = cached_query(dbConn, DAY_TYPE_BREAKDOWN.format(table=table, where=where), params)
 
-    # retrieves the ridership total for sunday/holiday
-    dbCursor.execute("SELECT SUM(Num_Riders) FROM Ridership WHERE Station_ID = (SELECT Station_ID FROM Stations WHERE Station_Name = ?) AND Type_of_Day = 'U'",(station_name,))
-    sunday_total = dbCursor.fetchone()[0]
+    # the shards return one row per station and year, which are added up here
+    breakdown = {}
+    for station_id, *totals in rows:
+        if wanted is None or station_id in wanted:
+            previous = breakdown.get(station_id, (0, 0, 0, 0))
+            breakdown[station_id] = tuple(before + (total or 0) for before, total in zip(previous, totals))
+    return breakdown
+
+# Riders of a station (exact name) as (total, weekday, saturday, sunday/holiday), or None without data
+def day_type_totals(dbConn, station_name):
+    station_id = get_station_catalog(dbConn)["by_name"].get(station_name)
+    return day_type_breakdown(dbConn, [station_id]).get(station_id)
+
+# Finds the percentages of the riders on weekdays, Saturdays, sundays/holidays
+def get_percentages(dbConn, station_name):
+    totals = day_type_totals(dbConn, station_name)
+    if totals is None:
+        print(f"**No data found...")
+        return None
+    tot_ridership, weekday_total, saturday_total, sunday_total = totals
 
     # Outputs the data for the valid user input station
     if tot_ridership  > 0:
@@ -95,16 +1352,66 @@ def get_percentages(dbConn, station_name):
         print("  Total ridership:", f"{tot_ridership:,}")
     else:
         print("**No data found...")
+    return totals
+
+# Prints that a station name matches nothing, with suggestions
+def print_station_not_found(catalog, station_name):
+    print("**No station found...")
+    print_suggestions(catalog, station_name)
+
+# Station IDs of exact station names, and of every station a name with wildcards (_ and %) matches.
+# A name that matches nothing is passed to not_found(catalog, name), which prints it by default
+# (the server raises an ApiError instead), and then None is returned.
+def stations_for_names(catalog, station_names, not_found=print_station_not_found):
+    station_ids = []
+    for station_name in station_names:
+        if station_name in catalog["by_name"]:
+            station_ids.append(catalog["by_name"][station_name])
+            continue
+        rows = match_stations(catalog, station_name) if "%" in station_name or "_" in station_name else []
+        if not rows:
+            not_found(catalog, station_name)
+            return None
+        station_ids.extend(station_id for station_id, _ in rows)
+    return list(dict.fromkeys(station_ids))
+
+# Command 2 for many stations at once: prints the day-type split of every station the names match
+# (e.g. "%" for all of them), read in one pass; returns {Station_ID: totals}
+def get_percentages_bulk(dbConn, *station_names):
+    catalog = get_station_catalog(dbConn)
+    station_ids = stations_for_names(catalog, station_names)
+    if station_ids is None:
+        return None
+    breakdown = {station_id: totals for station_id, totals in day_type_breakdown(dbConn, station_ids).items() if totals[0] > 0}
+    if not breakdown:
+        print("**No data found...")
+        return None
+    print(f"Percentage of ridership for {len(breakdown)} stations:")
+    for station_id, (tot_ridership, weekday_total, saturday_total, sunday_total) in sorted(
+            breakdown.items(), key=lambda item: catalog["by_id"].get(item[0], "")):
+        print(f"  {catalog['by_id'].get(station_id, station_id)} :",
+              f"weekday {weekday_total:,} ({weekday_total / tot_ridership * 100:.2f}%),",
+              f"saturday {saturday_total:,} ({saturday_total / tot_ridership * 100:.2f}%),",
+              f"sunday/holiday {sunday_total:,} ({sunday_total / tot_ridership * 100:.2f}%), total {tot_ridership:,}")
+    return breakdown
 
 # Command 3
 # Outputs the data for the total ridership on weekdays for each station with station names
 def get_weekday_ridership(dbConn):
-    dbCursor = dbConn.cursor()
-    dbCursor.execute("""SELECT Stations.Station_Name, SUM(Ridership.Num_Riders) AS tot_riders FROM Ridership
-    INNER JOIN Stations ON Ridership.Station_ID = Stations.Station_ID WHERE Ridership.Type_of_Day = 'W'
-    GROUP BY Stations.Station_Name
-    ORDER BY tot_riders DESC""")
-    return dbCursor.fetchall()
+    catalog = get_station_catalog(dbConn)
+    engine = get_columnar(dbConn)
+    if engine is not None:
+        return columnar_weekday_ridership(engine, catalog)
+    shards = get_shards(dbConn)
+    if shards is not None:
+        return sharded_weekday_ridership(shards, catalog)
+    if rollups_current(dbConn):
+        rows = cached_query(dbConn, """SELECT Station_ID, SUM(Num_Riders) FROM RidershipRollup WHERE Type_of_Day = 'W'
+        GROUP BY Station_ID""")
+    else:
+        rows = cached_query(dbConn, """SELECT Station_ID, SUM(Num_Riders) FROM Ridership WHERE Type_of_Day = 'W'
+        GROUP BY Station_ID""")
+    return totals_by_station_name(catalog, rows)
 
 # helper function for command 3 that displays the info
 def display_info(weekday_totals):
@@ -118,48 +1425,50 @@ def display_info(weekday_totals):
         print("No data found for weekday ridership.")
 
 # Command 4
-# Outputs all the stops for the user inputted line color in that direction
-def stops_for_lineColor_Direction(dbConn):
-    dbCursor = dbConn.cursor()
-    line_input = input("\nEnter a line color (e.g. Red or Yellow): ")
-    line_input = line_input.upper()
-    dbCursor.execute("""SELECT Stop_Name,ADA FROM Stops JOIN StopDetails ON 
-                     Stops.Stop_ID = StopDetails.Stop_ID JOIN Lines ON
-                     StopDetails.Line_ID = Lines.Line_ID WHERE UPPER(Lines.Color) = ?
-                     GROUP BY Stop_Name ORDER BY Stop_Name ASC;""",(line_input,))
-    num_rows = dbCursor.fetchall();
-    if num_rows:
-        line_direction = input("Enter a direction (N/S/W/E): ")
-        line_direction = line_direction.upper()
-        dbCursor.execute("""SELECT Stop_Name, ADA FROM Stops JOIN StopDetails ON
-                             Stops.Stop_ID = StopDetails.Stop_ID JOIN Lines ON
-                             StopDetails.Line_ID = Lines.Line_ID WHERE UPPER(Lines.Color) = ? AND UPPER(Stops.Direction) = ?\
-                             GROUP BY Stop_Name ORDER BY Stop_Name ASC;""", (line_input,line_direction))
-        num_rows = dbCursor.fetchall();
-        if num_rows:
-            for row in num_rows:
-                if(row[1]==1):
-                    print(row[0],": direction = ",line_direction," (handicap accessible)")
-                else:
-                    print(row[0], ": direction = ", line_direction," (not handicap accessible)")
-        else:
-            print("**That line does not run in the direction chosen...")
+# Stops of a line color as (Stop_Name, ADA), optionally only those in one direction
+def line_stops(dbConn, line_color, line_direction=None):
+    if line_direction is None:
+        return cached_query(dbConn, """SELECT Stop_Name,ADA FROM Stops JOIN StopDetails ON 
+                         Stops.Stop_ID = StopDetails.Stop_ID JOIN Lines ON
+                         StopDetails.Line_ID = Lines.Line_ID WHERE UPPER(Lines.Color) = ?
+                         GROUP BY Stop_Name ORDER BY Stop_Name ASC;""",(line_color.upper(),))
     else:
+        return cached_query(dbConn, """SELECT Stop_Name, ADA FROM Stops JOIN StopDetails ON
+                         Stops.Stop_ID = StopDetails.Stop_ID JOIN Lines ON
+                         StopDetails.Line_ID = Lines.Line_ID WHERE UPPER(Lines.Color) = ? AND UPPER(Stops.Direction) = ?
+                         GROUP BY Stop_Name ORDER BY Stop_Name ASC;""", (line_color.upper(),line_direction.upper()))
+
+# Outputs all the stops for the line color in that direction
+def stops_for_lineColor_Direction(dbConn, line_input, line_direction):
+    if not line_stops(dbConn, line_input):
         print("**No such line...")
+        return None
+    line_direction = line_direction.upper()
+    num_rows = line_stops(dbConn, line_input, line_direction)
+    if num_rows:
+        for row in num_rows:
+            if(row[1]==1):
+                print(row[0],": direction = ",line_direction," (handicap accessible)")
+            else:
+                print(row[0], ": direction = ", line_direction," (not handicap accessible)")
+    else:
+        print("**That line does not run in the direction chosen...")
+    return num_rows
 
 # Command 5
-# Outputs the number of stops for each line color, separated by direction
-def num_of_stops_line_color(dbConn):
-    dbCursor = dbConn.cursor()
-    dbCursor.execute("""SELECT Lines.Color, Stops.Direction, COUNT(Stops.Stop_ID) AS num_stops FROM Stops
+# Number of stops per (line color, direction) and the total number of stops
+def stops_by_line_direction(dbConn):
+    tot_stops = cached_query(dbConn, """SELECT Lines.Color, Stops.Direction, COUNT(Stops.Stop_ID) AS num_stops FROM Stops
                     INNER JOIN StopDetails ON Stops.Stop_ID = StopDetails.Stop_ID
                     INNER JOIN Lines ON StopDetails.Line_ID = Lines.Line_ID
                     GROUP BY Lines.Color, Stops.Direction
                     ORDER BY Lines.Color ASC, Stops.Direction ASC
                     """)
-    tot_stops = dbCursor.fetchall()
-    dbCursor.execute("SELECT COUNT(*) FROM Stops")
-    tot_num_stops = dbCursor.fetchone()[0]
+    return tot_stops, cached_query(dbConn, "SELECT COUNT(*) FROM Stops")[0][0]
+
+# Outputs the number of stops for each line color, separated by direction
+def num_of_stops_line_color(dbConn):
+    tot_stops, tot_num_stops = stops_by_line_direction(dbConn)
     if tot_num_stops > 0:
         print("Number of Stops For Each Color By Direction")
         for line_color, line_direction, num_stops in tot_stops:
@@ -167,283 +1476,1652 @@ def num_of_stops_line_color(dbConn):
             print(f"{line_color} going {line_direction} : {num_stops} ({percent:.2f}%)")
     else:
         print("No stops found")
+    return tot_stops
+
+# Resolves station patterns to (Station_ID, Station_Name), each pattern to exactly one station or, with
+# several_per_pattern, to every station it matches; prints why not and returns None when a pattern does not
+def lookup_stations(dbConn, station_names, several_per_pattern=False):
+    catalog = get_station_catalog(dbConn)
+    stations = []
+    for station_name in station_names:
+        rows = match_stations(catalog, station_name)
+        if not rows:
+            print_station_not_found(catalog, station_name)
+            return None
+        if len(rows) > 1 and not several_per_pattern:
+            print("**Multiple stations found...")
+            return None
+        stations.extend(rows)
+    return list(dict.fromkeys(stations))
+
+# Resolves a station pattern to exactly one (Station_ID, Station_Name); prints why not and returns None otherwise
+def lookup_station(dbConn, station_name):
+    stations = lookup_stations(dbConn, [station_name])
+    return stations[0] if stations else None
 
 # Command 6
-# Outputs the total ridership for each year for that station
-def total_ridership_year(dbConn):
-    dbCursor = dbConn.cursor()
-    station_name = input("\nEnter a station name (wildcards _ and %): ")
-    dbCursor.execute("SELECT Station_Name FROM Stations WHERE Station_Name LIKE ?", (station_name,))
-    rows = dbCursor.fetchall()
-    if not rows:
-        print("**No station found...")
-        return
-    elif len(rows) > 1:
-        print("**Multiple stations found...")
-        return
+# Total ridership of a station for each year as (yyyy, riders)
+def yearly_ridership(dbConn, station_id):
+    engine = get_columnar(dbConn)
+    if engine is not None:
+        return columnar_yearly(engine, station_id)
+    shards = get_shards(dbConn)
+    if shards is not None:
+        return sharded_yearly(shards, station_id)
+    if rollups_current(dbConn):
+        return cached_query(dbConn, """SELECT printf('%04d', Year) AS year_ride, SUM(Num_Riders) AS tot_riders FROM RidershipRollup
+                         WHERE Station_ID = ? GROUP BY Year ORDER BY Year ASC""", (station_id,))
     else:
-        station_name = rows[0][0]
-        dbCursor.execute("""SELECT strftime('%Y', Ride_Date) AS year_ride, SUM(Num_Riders) AS tot_riders FROM Ridership
-                         JOIN Stations ON Ridership.Station_ID = Stations.Station_ID WHERE Stations.Station_Name LIKE ? GROUP BY year_ride 
-                         ORDER BY year_ride ASC""", (f"{station_name}",))
-    ridership_data = dbCursor.fetchall()
+        return cached_query(dbConn, """SELECT printf('%04d', Ride_Year) AS year_ride, SUM(Num_Riders) AS tot_riders FROM Ridership
+                         WHERE Station_ID = ? GROUP BY Ride_Year ORDER BY Ride_Year ASC""", (station_id,))
+
+# Outputs the total ridership for each year for the (Station_ID, Station_Name) station
+def total_ridership_year(dbConn, station):
+    station_id, station_name = station
+    ridership_data = yearly_ridership(dbConn, station_id)
     if not ridership_data:
         print("**No ridership data found for the station and year...")
     else:
         print(f"Yearly Ridership at {station_name}")
         for ride_year, tot_ridership in ridership_data:
             print(f"{ride_year} : {tot_ridership:,}")
-    plot_question = input("Plot? (y/n) ")
-    if plot_question.lower() == 'y':
-        plot_data(ridership_data, station_name)
+    return ridership_data
 
-# Plots the data for command 6
-def plot_data(ridership_data, station_name):
+# Draws the chart of command 6 on ax
+def draw_yearly(ax, ridership_data, station_name):
     years = [row[0] for row in ridership_data]
     tot_ridership = [row[1] for row in ridership_data]
-    plt.figure(figsize=(10, 6))
-    plt.plot(years, tot_ridership)
-    plt.title(f"Yearly Ridership at {station_name}")
-    plt.xlabel("Year")
-    plt.ylabel("Number of Riders")
-    plt.grid(True)
-    plt.show()
+    ax.plot(years, tot_ridership)
+    ax.set_title(f"Yearly Ridership at {station_name}")
+    ax.set_xlabel("Year")
+    ax.set_ylabel("Number of Riders")
+    ax.grid(True)
+
+# Plots the data for command 6
+def plot_data(ridership_data, station_name):
+    show_plot(draw_yearly, (ridership_data, station_name), YEARLY_FIGSIZE)
 
 # Command 7
-# Outputs the total ridership for each month in the year based on the user inputted station name and year
-def ridership_each_month(dbConn):
-    dbCursor = dbConn.cursor()
-    station_name = input("\nEnter a station name (wildcards _ and %): ")
-    dbCursor.execute("SELECT Station_Name from Stations where Stations.Station_Name like ?;",(station_name,))
-    num_rows = dbCursor.fetchall();
-    if num_rows:
-        if(len(num_rows)==1):
-            save_station_name = num_rows[0][0]
-            ride_date = input("Enter a year: ")
-            query = ("""SELECT strfTime('%m/%Y',Ride_Date) AS num_date,SUM(Num_Riders) FROM Ridership JOIN Stations
-                             ON Ridership.Station_ID = Stations.Station_ID
-                            WHERE Stations.Station_Name LIKE ? AND strftime('%Y', Ridership.Ride_Date) = ? GROUP BY num_date ORDER BY num_date ASC;""")
-            dbCursor.execute(query, (station_name,ride_date,))
-            num_rows = dbCursor.fetchall();
-            print("Monthly Ridership at ",save_station_name," for ",ride_date)
-            for row in num_rows:
-                print(row[0]," : ",f"{row[1]:,}")
-            plotChoice = input("Plot? (y/n) ")
-            if plotChoice == "y":
-                x=[]
-                y=[]
-                month = 1
-                for row in num_rows:
-                    x.append(month)
-                    y.append(row[1])
-                    month = month+1
-                plt.xlabel("Month")
-                plt.ylabel("Number of Riders")
-                plt.title(f"Monthly Ridership at {save_station_name} ({ride_date})")
-                plt.ioff()
-                plt.plot(x, y)
-                plt.show()
+# Total ridership of a station for each month of a year as (mm/yyyy, riders)
+def monthly_ridership(dbConn, station_id, ride_date):
+    engine = get_columnar(dbConn)
+    if engine is not None:
+        return columnar_monthly(engine, station_id, ride_date)
+    shards = get_shards(dbConn)
+    if shards is not None:
+        return sharded_monthly(shards, station_id, ride_date)
+    if rollups_current(dbConn):
+        return cached_query(dbConn, """SELECT printf('%02d/%04d', Month, Year) AS num_date, SUM(Num_Riders) FROM RidershipRollup
+                         WHERE Station_ID = ? AND Year = ?
+                         GROUP BY Month ORDER BY Month ASC;""", (station_id, ride_date))
+    else:
+        return cached_query(dbConn, """SELECT printf('%02d/%04d', Ride_Month, Ride_Year) AS num_date,SUM(Num_Riders) FROM Ridership
+                         WHERE Station_ID = ? AND Ride_Day >= ? AND Ride_Day < ?
+                         GROUP BY Ride_Month ORDER BY Ride_Month ASC;""", (station_id,) + year_day_range(ride_date))
 
+# Outputs the total ridership for each month in the year for the (Station_ID, Station_Name) station
+def ridership_each_month(dbConn, station, ride_date):
+    station_id, save_station_name = station
+    num_rows = monthly_ridership(dbConn, station_id, ride_date)
+    print("Monthly Ridership at ",save_station_name," for ",ride_date)
+    for row in num_rows:
+        print(row[0]," : ",f"{row[1]:,}")
+    return num_rows
 
-        else:
-            print("**Multiple stations found...")
+# Draws the chart of command 7 on ax
+def draw_monthly(ax, num_rows, save_station_name, ride_date):
+    x=[]
+    y=[]
+    month = 1
+    for row in num_rows:
+        x.append(month)
+        y.append(row[1])
+        month = month+1
+    ax.set_xlabel("Month")
+    ax.set_ylabel("Number of Riders")
+    ax.set_title(f"Monthly Ridership at {save_station_name} ({ride_date})")
+    ax.plot(x, y)
+
+# Plots the data for command 7
+def plot_monthly(num_rows, save_station_name, ride_date):
+    show_plot(draw_monthly, (num_rows, save_station_name, ride_date))
 
+# Command 8
+# Outputs the total ridership for each day of the year for the given (Station_ID, Station_Name) stations
+def tot_ridership_days(dbConn, stations, year_compare):
+    calendar, series = compare_stations_daily(dbConn, [station_id for station_id, _ in stations], year_compare)
+    for station_num, (station_id, station_name) in enumerate(stations, start=1):
+        station_list(station_id, station_name, calendar, series[station_id], station_num)
+    return calendar, series
 
+# Daily rider totals of any number of stations in one year, read in a single grouped scan.
+# Returns the shared calendar (sorted Ride_Day values on which any of the stations has data)
+# and a dict of Station_ID -> riders for each calendar day, with 0 where a station has no row.
+def compare_stations_daily(dbConn, station_ids, year_compare):
+    by_station = {station_id: {} for station_id in station_ids}
+    engine = get_columnar(dbConn)
+    if engine is not None:
+        for station_id in by_station:
+            by_station[station_id] = columnar_daily(engine, station_id, year_compare)
+    elif get_shards(dbConn) is not None:
+        for station_id, ride_day, riders in sharded_daily(get_shards(dbConn), list(by_station), year_compare):
+            by_station[station_id][ride_day] = riders
     else:
-        print("**No station found...")
+        placeholders = ", ".join("?" * len(by_station))
+        rows = cached_query(dbConn, f"""SELECT Station_ID, Ride_Day, SUM(Num_Riders) FROM Ridership
+                            WHERE Station_ID IN ({placeholders}) AND Ride_Day >= ? AND Ride_Day < ?
+                            GROUP BY Station_ID, Ride_Day""", tuple(by_station) + year_day_range(year_compare))
+        for station_id, ride_day, riders in rows:
+            by_station[station_id][ride_day] = riders
+    calendar = sorted(set().union(*by_station.values()))
+    series = {station_id: [days.get(day, 0) for day in calendar] for station_id, days in by_station.items()}
+    return calendar, series
 
+# yyyy-mm-dd of a Ride_Day value
+def day_to_date(ride_day):
+    return datetime.date.fromordinal(ride_day + EPOCH_ORDINAL).isoformat()
 
-# Command 8
-# Outputs the total ridership for the two stations and for each day in the year that is provided by the user
-def tot_ridership_days(dbConn):
-    dbCursor = dbConn.cursor()
-    year_compare = input("\nYear to compare against? ")
-    station_1 = input("\nEnter station 1 (wildcards _ and %): ")
-    dbCursor.execute("SELECT Station_Name FROM Stations WHERE Stations.Station_Name LIKE ?;", (station_1,))
-    num_rows = dbCursor.fetchall()
-    if num_rows:
-        if (len(num_rows) == 1):
-            station_2 = input("\nEnter station 2 (wildcards _ and %): ")
-            dbCursor.execute("SELECT Station_Name FROM Stations WHERE Stations.Station_Name LIKE ?;", (station_2,))
-            num_rows_2 = dbCursor.fetchall()
-            if num_rows_2:
-                if(len(num_rows_2)==1):
-                    station_list(num_rows[0][0],year_compare,1,dbConn)
-                    station_list(num_rows_2[0][0],year_compare,2,dbConn)
-                    plot_question = input("\nPlot? (y/n) ")
-                    if plot_question == "y":
-                        x = []
-                        y = []
-                        query1 = ("""SELECT strfTime('%Y-%m-%d',Ride_Date) AS num_date,SUM(Num_Riders) FROM Ridership JOIN Stations 
-                                            ON Ridership.Station_ID = Stations.Station_ID 
-                                            WHERE Stations.Station_Name LIKE ? 
-                                            AND strftime('%Y', Ridership.Ride_Date) = ? GROUP BY num_date ORDER BY num_date ASC;""")
-                        dbCursor.execute(query1, (station_1, year_compare,))
-                        station1_data = dbCursor.fetchall()
-                        day = 0
-                        for row in station1_data:
-                            day = day+1
-                            x.append(day)
-                            y.append(row[1])
-                        query2 = ("""SELECT strfTime('%Y-%m-%d',Ride_Date) AS num_date2,SUM(Num_Riders) FROM Ridership JOIN Stations 
-                                            ON Ridership.Station_ID = Stations.Station_ID 
-                                            WHERE Stations.Station_Name LIKE ? 
-                                            AND strftime('%Y', Ridership.Ride_Date) = ? GROUP BY num_date2 ORDER BY num_date2 ASC;""")
-                        dbCursor.execute(query2, (station_2, year_compare,))
-                        station2_data = dbCursor.fetchall()
-                        y2 = []
-                        for row in station2_data:
-                            y2.append(row[1])
-
-                        plt.xlabel("Day")
-                        plt.ylabel("Number of Riders")
-                        plt.title(f"Ridership each day of ({year_compare})")
-                        plt.ioff()
-                        plt.plot(x,y,label=num_rows[0][0])
-                        plt.plot(x,y2,label=num_rows_2[0][0])
-                        plt.legend(loc='upper right')
-                        plt.show()
-
-
-
-                else:
-                    print("**Multiple stations found...")
-            else:
-                print("**No station found...")
+# Helper function that lists the rider dates for the first and last 5 days of the calendar for the given station
+def station_list(station_id,station_name,calendar,riders,station_num):
+    print(f"Station {station_num}: {station_id} {station_name}")
+    for day, num_riders in list(zip(calendar, riders))[:5]:
+        print(f"{day_to_date(day)}  {num_riders}")
+    for day, num_riders in list(zip(calendar, riders))[-5:]:
+        print(f"{day_to_date(day)}  {num_riders}")
 
-        else:
-            print("**Multiple stations found...")
+# Draws the daily series of command 8 on ax against the day of the year, each reduced to max_points
+def draw_daily(ax, stations, calendar, series, year_compare, max_points=None):
+    start_day = year_day_range(year_compare)[0]
+    x = [day - start_day + 1 for day in calendar]
+    ax.set_xlabel("Day")
+    ax.set_ylabel("Number of Riders")
+    ax.set_title(f"Ridership each day of ({year_compare})")
+    for station_id, station_name in stations:
+        ax.plot(*lttb(x, series[station_id], max_points or PLOT_MAX_POINTS), label=station_name)
+    ax.legend(loc='upper right')
+
+# Plots the daily series of command 8 against the day of the year
+def plot_daily_comparison(stations, calendar, series, year_compare):
+    show_plot(draw_daily, (stations, calendar, series, year_compare))
+
+##################################################################
+#
+# Stop spatial index
+#
+# The stop coordinates are loaded into a grid of fixed-size cells
+# (keyed by the floor of latitude/longitude divided by the cell size), so a
+# proximity lookup only has to compute exact haversine distances for the
+# stops in the handful of cells that overlap the search circle. When the
+# box around the circle spans more cells than are occupied, every stop is
+# checked directly instead. Like the station catalog, the grid is rebuilt
+# after a commit to the database.
+#
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEG_LAT = 69.0
+GRID_CELL_DEG = 0.01
+
+stop_indexes = {}
+
+# Great-circle distance in miles between two latitude/longitude points
+def haversine_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+# Builds the grid index from every distinct (station name, latitude, longitude) of the stops
+def build_stop_index(dbConn, cell_deg=GRID_CELL_DEG):
+    dbCursor = query_cursor(dbConn)
+    dbCursor.execute("""SELECT DISTINCT Stations.Station_Name, Stops.Latitude, Stops.Longitude FROM Stations
+                     JOIN Stops ON Stations.Station_ID = Stops.Station_ID
+                     WHERE Stops.Latitude IS NOT NULL AND Stops.Longitude IS NOT NULL""")
+    stops = dbCursor.fetchall()
+    cells = {}
+    for name, latitude, longitude in stops:
+        key = (math.floor(latitude / cell_deg), math.floor(longitude / cell_deg))
+        cells.setdefault(key, []).append((name, latitude, longitude))
+    return {"cell_deg": cell_deg, "cells": cells, "stops": stops}
+
+# Returns the index for this connection, building it on first use and again when the database changed
+def get_stop_index(dbConn):
+    version = connection_version(dbConn)
+    stop_index = stop_indexes.get(dbConn)
+    if stop_index is None or stop_index["version"] != version:
+        stop_index = dict(build_stop_index(dbConn), version=version)
+        stop_indexes[dbConn] = stop_index
+    return stop_index
+
+# Cell ranges (lat cells, lon cells) of the box around the search circle, or None when it is cheaper
+# to look at every stop: the box has more cells than there are occupied ones (a large radius, or
+# longitude degrees shrinking near the poles), or the circle reaches a pole or the 180th meridian
+def search_box(stop_index, latitude, longitude, radius_miles):
+    cell_deg = stop_index["cell_deg"]
+    lat_span = radius_miles / MILES_PER_DEG_LAT
+    if abs(latitude) + lat_span >= 90:
+        return None
+    # a degree of longitude shrinks with cos(latitude); use the edge of the circle closest to the pole
+    lon_span = radius_miles / (MILES_PER_DEG_LAT * math.cos(math.radians(abs(latitude) + lat_span)))
+    if abs(longitude) + lon_span >= 180:
+        return None
+    lat_cells = range(math.floor((latitude - lat_span) / cell_deg), math.floor((latitude + lat_span) / cell_deg) + 1)
+    lon_cells = range(math.floor((longitude - lon_span) / cell_deg), math.floor((longitude + lon_span) / cell_deg) + 1)
+    if len(lat_cells) * len(lon_cells) > len(stop_index["cells"]):
+        return None
+    return lat_cells, lon_cells
+
+# All stops within radius_miles of the point as (station name, latitude, longitude, miles),
+# ordered by station name like the original query
+def stations_within(stop_index, latitude, longitude, radius_miles=1.0):
+    box = search_box(stop_index, latitude, longitude, radius_miles)
+    if box is None:
+        candidates = stop_index["stops"]
     else:
-        print("**No station found...")
+        cells = stop_index["cells"]
+        candidates = [stop for lat_cell in box[0] for lon_cell in box[1] for stop in cells.get((lat_cell, lon_cell), ())]
 
-# Helper function that lists the rider dates for the first 5 days for the given stations
-def station_list(station_name,year_compare,station_num,dbConn):
-    dbCursor = dbConn.cursor()
-    dbCursor.execute("SELECT Station_ID FROM Stations WHERE Station_Name like ?;", (station_name,))
-    station_name_ID = dbCursor.fetchall()
-    query1 = ("""SELECT strfTime('%Y-%m-%d',Ride_Date) AS num_date,SUM(Num_Riders) FROM Ridership JOIN Stations 
-                        ON Ridership.Station_ID = Stations.Station_ID 
-                        WHERE Stations.Station_Name LIKE ? 
-                        AND strftime('%Y', Ridership.Ride_Date) = ? GROUP BY num_date ORDER BY num_date ASC limit 5;""")
-    dbCursor.execute(query1, (station_name, year_compare,))
-    station_start_Dates = dbCursor.fetchall()
-    query2 = ("""SELECT strfTime('%Y-%m-%d',Ride_Date) AS num_date2,SUM(Num_Riders) FROM Ridership JOIN Stations 
-                        ON Ridership.Station_ID = Stations.Station_ID 
-                        WHERE Stations.Station_Name LIKE ? 
-                        AND strftime('%Y', Ridership.Ride_Date) = ? GROUP BY num_date2 ORDER BY num_date2 DESC limit 5;""")
-    dbCursor.execute(query2, (station_name, year_compare,))
-    station_end_dates = dbCursor.fetchall()
-    print(f"Station {station_num}: {station_name_ID[0][0]} {station_name}")
-    for row in station_start_Dates:
-        print(f"{row[0]}  {row[1]}")
-    for row in reversed(station_end_dates):
-        print(f"{row[0]}  {row[1]}")
+    found = []
+    for name, stop_lat, stop_lon in candidates:
+        miles = haversine_miles(latitude, longitude, stop_lat, stop_lon)
+        if miles <= radius_miles:
+            found.append((name, stop_lat, stop_lon, miles))
+    found.sort()
+    return found
+
+# The closest stop of each station among the (station name, latitude, longitude, miles) stops, nearest first
+def nearest_stop_per_station(stops):
+    nearest = {}
+    for stop in sorted(stops, key=lambda stop: (stop[3], stop[0], stop[1], stop[2])):
+        nearest.setdefault(stop[0], stop)
+    return list(nearest.values())
+
+# The k stations closest to the point as (station name, latitude, longitude, miles) of their closest
+# stop, nearest first. The search circle doubles until it holds stops of k stations; once its box
+# would cover more cells than are occupied, all distances are computed directly.
+def nearest_stations(stop_index, latitude, longitude, k=1):
+    stops = stop_index["stops"]
+    if k <= 0 or not stops:
+        return []
+    if k < len(stops):
+        radius = stop_index["cell_deg"] * MILES_PER_DEG_LAT
+        while search_box(stop_index, latitude, longitude, radius) is not None:
+            found = nearest_stop_per_station(stations_within(stop_index, latitude, longitude, radius))
+            if len(found) >= k:
+                return found[:k]
+            radius *= 2
+    found = [(name, stop_lat, stop_lon, haversine_miles(latitude, longitude, stop_lat, stop_lon))
+             for name, stop_lat, stop_lon in stops]
+    return nearest_stop_per_station(found)[:k]
 
 # Command 9
-# Outputs all the stations within a one mile square radius based on the set of latitude and longitudes given by the user
+# Outputs all the stations within a one mile radius based on the set of latitude and longitudes given by the user
+LATITUDE_RANGE = (40, 43)
+LONGITUDE_RANGE = (-88, -87)
 
-def stations_in_a_mile_radius(dbConn):
-    try:
-        user_latitude = float(input("\nEnter a latitude: "))
-        if not 40 <= user_latitude <= 43:
-            print("**Latitude entered is out of bounds...")
-            return
-
-        user_longitude = float(input("Enter a longitude: "))
-        if not -88 <= user_longitude <= -87:
-            print("**Longitude entered is out of bounds...")
-            return
-
-        deg_of_lat = 1 / 69
-        deg_of_long = 1 / 51
-
-        upper_lat = round(user_latitude + deg_of_lat, 3)
-        lower_lat = round(user_latitude - deg_of_lat, 3)
-        upper_long = round(user_longitude + deg_of_long, 3)
-        lower_long = round(user_longitude - deg_of_long, 3)
-
-        dbCursor = dbConn.cursor()
-        dbCursor.execute("""
-        SELECT DISTINCT Stations.Station_Name, Stops.Latitude, Stops.Longitude
-        FROM Stations
-        LEFT JOIN Stops ON Stations.Station_ID = Stops.Station_ID
-        WHERE Stops.Latitude BETWEEN ? AND ? AND Stops.Longitude BETWEEN ? AND ? 
-        ORDER BY Stations.Station_Name;
-        """, (lower_lat, upper_lat, lower_long, upper_long))
-        num_stations = dbCursor.fetchall()
-
-        if not num_stations:
-            print("**No stations found...")
-            return
-
-        print("\nList of Stations Within a Mile")
-        for station_name, latitude, longitude in num_stations:
-            print(f"{station_name} : ({latitude}, {longitude})")
-
-        plot_question = input("\nPlot? (y/n) ")
-        if plot_question.lower() == 'y':
-            plot_data2(num_stations)
+# Checks that a point lies in the area command 9 searches; prints why not and returns False otherwise
+def point_in_range(user_latitude, user_longitude):
+    if not LATITUDE_RANGE[0] <= user_latitude <= LATITUDE_RANGE[1]:
+        print("**Latitude entered is out of bounds...")
+        return False
+    if not LONGITUDE_RANGE[0] <= user_longitude <= LONGITUDE_RANGE[1]:
+        print("**Longitude entered is out of bounds...")
+        return False
+    return True
 
+# (latitude, longitude) of two batch parameters; prints why not and returns None when they are not numbers
+def parse_point(user_latitude, user_longitude):
+    try:
+        return float(user_latitude), float(user_longitude)
     except ValueError:
         print("**Invalid input. Please enter a valid number.")
+        return None
 
-# Plots the data for command 9
+# Stops within a mile of the point as (station name, latitude, longitude, miles); prints why not and
+# returns None when the latitude and longitude are not numbers or out of bounds
+def stations_near_point(dbConn, user_latitude, user_longitude):
+    point = parse_point(user_latitude, user_longitude)
+    if point is None or not point_in_range(*point):
+        return None
+    return stations_within(get_stop_index(dbConn), point[0], point[1], 1.0)
 
-def plot_data2(num_stations):
-    image = plt.imread("chicago.png")
+# Prints the stations within a mile of the point and returns them as (station name, latitude, longitude),
+# or None when the point is not valid
+def stations_in_a_mile_radius(dbConn, user_latitude, user_longitude):
+    rows = stations_near_point(dbConn, user_latitude, user_longitude)
+    if rows is None:
+        return None
+    num_stations = [(station_name, latitude, longitude) for station_name, latitude, longitude, _ in rows]
+
+    if not num_stations:
+        print("**No stations found...")
+        return num_stations
+
+    print("\nList of Stations Within a Mile")
+    for station_name, latitude, longitude in num_stations:
+        print(f"{station_name} : ({latitude}, {longitude})")
+    return num_stations
+
+# Draws the stations of command 9 on the map of Chicago on ax
+def draw_radius(ax, num_stations):
     x = [lon for _, _, lon in num_stations]
     y = [lat for _, lat, _ in num_stations]
     station_names = [name for name, _, _ in num_stations]
 
-    xdims = [-87.9277, -87.5569, 41.7012, 42.0868]  # Area covered by the map
-    plt.imshow(image, extent=xdims)
+    ax.imshow(get_basemap(), extent=BASEMAP_EXTENT)
     if num_stations:
-        plt.scatter(x, y, color='blue')
+        ax.scatter(x, y, color='blue')
         for i, name in enumerate(station_names):
-            plt.annotate(name, (x[i], y[i]))
-    plt.xlim([-87.9277, -87.5569])
-    plt.ylim([41.7012, 42.0868])
-    plt.title("Stations Within a Mile Radius")
+            ax.annotate(name, (x[i], y[i]))
+    ax.set_xlim(BASEMAP_EXTENT[:2])
+    ax.set_ylim(BASEMAP_EXTENT[2:])
+    ax.set_title("Stations Within a Mile Radius")
+
+# Plots the data for command 9
+def plot_data2(num_stations):
+    show_plot(draw_radius, (num_stations,))
+
+##################################################################
+#
+# Plotting
+#
+# The draw_* functions above draw a command's chart on a matplotlib Axes.
+# At the prompt show_plot puts it on a new pyplot figure and shows it.
+# render_plot draws it off screen instead, on a bare Figure without
+# pyplot or a display, and saves it as PNG (Agg) or SVG. Batch mode uses
+# it for "6 Jackson > jackson.png", and --plot-all DIR renders the yearly
+# chart of every station from one grouped query across a pool of worker
+# processes. Daily series longer than PLOT_MAX_POINTS are reduced with
+# LTTB (largest triangle three buckets), which keeps the peaks and dips a
+# plain stride would skip. The basemap of command 9 is decoded once per
+# process.
+#
+PLOT_FORMATS = (".png", ".svg")
+PLOT_MAX_POINTS = 200
+YEARLY_FIGSIZE = (10, 6)
+BASEMAP_PATH = "chicago.png"
+BASEMAP_EXTENT = [-87.9277, -87.5569, 41.7012, 42.0868]  # Area covered by the map
+
+basemap_images = {}
+
+# The decoded image of the map, read from path the first time
+def get_basemap(path=BASEMAP_PATH):
+    if path not in basemap_images:
+        import matplotlib.image
+        basemap_images[path] = matplotlib.image.imread(path)
+    return basemap_images[path]
+
+# At most max_points of the points (x, y), picked with largest triangle three buckets: the first and
+# last points are kept, and each bucket in between keeps the point that makes the largest triangle
+# with the point kept before it and the average of the next bucket. Returns (x, y) lists.
+def lttb(x, y, max_points):
+    num_points = len(x)
+    if max_points < 3 or num_points <= max_points:
+        return list(x), list(y)
+    bucket_size = (num_points - 2) / (max_points - 2)
+    kept = [0]
+    for bucket in range(max_points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, num_points)
+        avg_x = sum(x[end:next_end]) / (next_end - end)
+        avg_y = sum(y[end:next_end]) / (next_end - end)
+        prev_x, prev_y = x[kept[-1]], y[kept[-1]]
+        kept.append(max(range(start, end),
+                        key=lambda i: abs((prev_x - avg_x) * (y[i] - prev_y) - (prev_x - x[i]) * (avg_y - prev_y))))
+    kept.append(num_points - 1)
+    return [x[i] for i in kept], [y[i] for i in kept]
+
+# Draws draw(ax, *args) on a new pyplot figure and shows it
+def show_plot(draw, args, figsize=None):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=figsize)
+    draw(ax, *args)
     plt.show()
+    plt.close(fig)
+
+# Draws draw(ax, *args) off screen and saves it to path, as PNG or SVG by its extension; returns path
+def render_plot(path, draw, args, figsize=None):
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize)
+    draw(fig.add_subplot(), *args)
+    fig.savefig(path)
+    return path
+
+# The chart functions take the same parameters as the batch commands and return
+# (draw function, its arguments, figure size), or None after printing why there is no chart
+def chart_yearly(dbConn, station_name):
+    station = lookup_station(dbConn, station_name)
+    if not station:
+        return None
+    return draw_yearly, (yearly_ridership(dbConn, station[0]), station[1]), YEARLY_FIGSIZE
+
+def chart_monthly(dbConn, station_name, ride_date):
+    station = lookup_station(dbConn, station_name)
+    if not station:
+        return None
+    return draw_monthly, (monthly_ridership(dbConn, station[0], ride_date), station[1], ride_date), None
+
+def chart_daily(dbConn, year_compare, *station_names):
+    stations = lookup_stations(dbConn, station_names)
+    if stations is None:
+        return None
+    calendar, series = compare_stations_daily(dbConn, [station_id for station_id, _ in stations], year_compare)
+    return draw_daily, (stations, calendar, series, year_compare), None
+
+def chart_radius(dbConn, user_latitude, user_longitude):
+    rows = stations_near_point(dbConn, user_latitude, user_longitude)
+    if rows is None:
+        return None
+    return draw_radius, ([(station_name, latitude, longitude) for station_name, latitude, longitude, _ in rows],), None
+
+# command -> chart function (same parameters as in BATCH_COMMANDS)
+PLOT_COMMANDS = {
+    '6': chart_yearly,
+    '7': chart_monthly,
+    '8': chart_daily,
+    '9': chart_radius,
+}
+
+# Renders the chart of a command to path; returns False when nothing was written
+def run_plot_export(dbConn, command, params, path):
+    if command not in PLOT_COMMANDS:
+        print(f"**Error, only commands {', '.join(PLOT_COMMANDS)} can be plotted...")
+        return False
+    chart = PLOT_COMMANDS[command](dbConn, *params)
+    if chart is None:
+        return False
+    draw, args, figsize = chart
+    try:
+        render_plot(path, draw, args, figsize)
+    except ImportError:
+        print("**Plotting needs matplotlib (pip install matplotlib)...")
+        return False
+    except OSError as err:
+        print(f"**Error, could not write '{path}': {err}")
+        return False
+    print(f"Plotted to {path}")
+    return True
+
+# Yearly totals of every station as {Station_ID: [(yyyy, riders)]}, read in one grouped scan
+def yearly_ridership_all(dbConn):
+    dbCursor = query_cursor(dbConn)
+    if rollups_current(dbConn):
+        dbCursor.execute("""SELECT Station_ID, printf('%04d', Year), SUM(Num_Riders) FROM RidershipRollup
+                         GROUP BY Station_ID, Year ORDER BY Station_ID, Year""")
+    else:
+        dbCursor.execute("""SELECT Station_ID, printf('%04d', Ride_Year), SUM(Num_Riders) FROM Ridership
+                         GROUP BY Station_ID, Ride_Year ORDER BY Station_ID, Ride_Year""")
+    by_station = {}
+    for station_id, year, riders in dbCursor.fetchall():
+        by_station.setdefault(station_id, []).append((year, riders))
+    return by_station
+
+# Renders the yearly chart of every station into directory as <Station_ID>_<name>.png (or .svg)
+# on max_workers worker processes; returns the number of charts written
+def plot_all_stations(dbConn, directory, plot_format="png", max_workers=None):
+    start = time.perf_counter()
+    catalog = get_station_catalog(dbConn)
+    charts = []
+    for station_id, ridership_data in yearly_ridership_all(dbConn).items():
+        station_name = catalog["by_id"].get(station_id, str(station_id))
+        file_name = f"{station_id}_{re.sub(r'[^A-Za-z0-9]+', '_', station_name).strip('_')}.{plot_format}"
+        charts.append((os.path.join(directory, file_name), (ridership_data, station_name)))
+    queried = time.perf_counter()
+
+    os.makedirs(directory, exist_ok=True)
+    max_workers = max_workers or os.cpu_count() or 1
+    with worker_pool(render_plot, max_workers) as executor:
+        paths = list(executor.map(render_plot, [path for path, _ in charts], itertools.repeat(draw_yearly),
+                                  [args for _, args in charts], itertools.repeat(YEARLY_FIGSIZE),
+                                  chunksize=max(len(charts) // (max_workers * 4), 1)))
+    done = time.perf_counter()
+    print(f"Plotted {len(paths):,} yearly charts to {directory} in {done - start:.2f} s",
+          f"(query {queried - start:.2f} s, {len(paths) / max(done - queried, 1e-9):,.1f} charts/s on {max_workers} workers)")
+    return len(paths)
+
+##################################################################
+#
+# Interactive mode
+#
+# Prompts for a command and its parameters, runs it and offers a plot.
+#
+def ask_plot(prompt="Plot? (y/n) "):
+    return input(prompt).lower() == 'y'
+
+def run_interactive(dbConn):
+    # the prompts and plot windows of a command wait for the user, which is not part of the command's time
+    ask = lambda prompt: wait_for_user(dbConn, input, prompt)
+    while True:
+        end_monitored_command(dbConn)
+        print("\nPlease enter a command (1-9, x to exit): ", end = "")
+        command = input().strip().lower()
+        if command in BATCH_COMMANDS:
+            begin_monitored_command(dbConn, command)
+        if command == 'x':
+            break
+        elif command == 'stats':
+            print_query_monitor_stats(dbConn)
+        elif command == '1':
+            partial_name2 = ask("\nEnter partial station name (wildcards _ and %): ")
+            station_match(dbConn, partial_name2)
+        elif command == '2':
+            station_name = ask("\nEnter the name of the station you would like to analyze: ")
+            get_percentages(dbConn, station_name)
+        elif command == '3':
+            weekday_totals = get_weekday_ridership(dbConn)
+            display_info(weekday_totals)
+        elif command == '4':
+            line_input = ask("\nEnter a line color (e.g. Red or Yellow): ")
+            if line_stops(dbConn, line_input):
+                line_direction = ask("Enter a direction (N/S/W/E): ")
+                stops_for_lineColor_Direction(dbConn, line_input, line_direction)
+            else:
+                print("**No such line...")
+        elif command == '5':
+            num_of_stops_line_color(dbConn)
+        elif command == '6':
+            station = lookup_station(dbConn, ask("\nEnter a station name (wildcards _ and %): "))
+            if station:
+                ridership_data = total_ridership_year(dbConn, station)
+                if wait_for_user(dbConn, ask_plot):
+                    wait_for_user(dbConn, plot_data, ridership_data, station[1])
+        elif command == '7':
+            station = lookup_station(dbConn, ask("\nEnter a station name (wildcards _ and %): "))
+            if station:
+                ride_date = ask("Enter a year: ")
+                num_rows = ridership_each_month(dbConn, station, ride_date)
+                if wait_for_user(dbConn, ask_plot):
+                    wait_for_user(dbConn, plot_monthly, num_rows, station[1], ride_date)
+        elif command == '8':
+            year_compare = ask("\nYear to compare against? ")
+            station_1 = lookup_station(dbConn, ask("\nEnter station 1 (wildcards _ and %): "))
+            if station_1:
+                station_2 = lookup_station(dbConn, ask("\nEnter station 2 (wildcards _ and %): "))
+                if station_2:
+                    stations = [station_1, station_2]
+                    calendar, series = tot_ridership_days(dbConn, stations, year_compare)
+                    if wait_for_user(dbConn, ask_plot, "\nPlot? (y/n) "):
+                        wait_for_user(dbConn, plot_daily_comparison, stations, calendar, series, year_compare)
+        elif command == '9':
+            try:
+                user_latitude = float(ask("\nEnter a latitude: "))
+                if not LATITUDE_RANGE[0] <= user_latitude <= LATITUDE_RANGE[1]:
+                    print("**Latitude entered is out of bounds...")
+                    continue
+                user_longitude = float(ask("Enter a longitude: "))
+            except ValueError:
+                print("**Invalid input. Please enter a valid number.")
+                continue
+            num_stations = stations_in_a_mile_radius(dbConn, user_latitude, user_longitude)
+            if num_stations and wait_for_user(dbConn, ask_plot, "\nPlot? (y/n) "):
+                wait_for_user(dbConn, plot_data2, num_stations)
+        else:
+            print("**Error, unknown command, try again...")
+
+##################################################################
+#
+# Batch mode
+#
+# Each line of the batch input is a command number followed by its
+# parameters, split like a shell command line (quote names with spaces):
+#
+#   1 %Lake
+#   2 "O'Hare Airport"
+#   4 Red N
+#   7 Monroe 2002
+#   8 2002 Jackson "Clark/Lake" UIC%
+#   9 41.88 -87.63
+#   stats
+#
+# A line ending in "> FILE" writes the result to FILE instead (see Export),
+# or its chart when FILE ends in .png or .svg (see Plotting),
+# and "stats" prints the query monitor's histograms (see Query monitor).
+# Blank lines and lines starting with # are skipped. Nothing is plotted.
+#
+# A line fails (and the exit status is 1) when it cannot be run as written,
+# the same cases in which its export writes nothing: a station pattern
+# that matches no station or, where one station is expected, several; an
+# unknown line or direction; a point that is not a number or out of
+# bounds; no data for command 2. The batch_* functions return False then.
+# An empty but valid result (no stations within a mile, no match for
+# command 1) is not a failure.
+#
+def batch_weekday_ridership(dbConn):
+    display_info(get_weekday_ridership(dbConn))
+
+# One exact name prints the percentages like the prompt does, several names or patterns a line per station
+def batch_percentages(dbConn, *station_names):
+    if len(station_names) == 1 and "%" not in station_names[0] and "_" not in station_names[0]:
+        totals = get_percentages(dbConn, station_names[0])
+        if not totals or not totals[0]:
+            return False
+    elif get_percentages_bulk(dbConn, *station_names) is None:
+        return False
+
+def batch_line_stops(dbConn, line_input, line_direction):
+    if not stops_for_lineColor_Direction(dbConn, line_input, line_direction):
+        return False
+
+def batch_yearly(dbConn, station_name):
+    station = lookup_station(dbConn, station_name)
+    if not station:
+        return False
+    total_ridership_year(dbConn, station)
+
+def batch_monthly(dbConn, station_name, ride_date):
+    station = lookup_station(dbConn, station_name)
+    if not station:
+        return False
+    ridership_each_month(dbConn, station, ride_date)
+
+def batch_daily(dbConn, year_compare, *station_names):
+    stations = lookup_stations(dbConn, station_names)
+    if stations is None:
+        return False
+    tot_ridership_days(dbConn, stations, year_compare)
+
+def batch_radius(dbConn, user_latitude, user_longitude):
+    if stations_in_a_mile_radius(dbConn, user_latitude, user_longitude) is None:
+        return False
+
+# command -> (function, minimum number of parameters, maximum number (None = any), usage)
+BATCH_COMMANDS = {
+    '1': (station_match, 1, 1, "1 <station pattern>"),
+    '2': (batch_percentages, 1, None, "2 <station name> [<station name or pattern> ...]"),
+    '3': (batch_weekday_ridership, 0, 0, "3"),
+    '4': (batch_line_stops, 2, 2, "4 <line color> <direction>"),
+    '5': (num_of_stops_line_color, 0, 0, "5"),
+    '6': (batch_yearly, 1, 1, "6 <station pattern>"),
+    '7': (batch_monthly, 2, 2, "7 <station pattern> <year>"),
+    '8': (batch_daily, 2, None, "8 <year> <station pattern> [<station pattern> ...]"),
+    '9': (batch_radius, 2, 2, "9 <latitude> <longitude>"),
+}
+
+# Runs one batch line; returns False when the line failed (see above)
+def run_batch_line(dbConn, line):
+    if not line.strip() or line.lstrip().startswith("#"):
+        return True
+    print(f"\n> {line.strip()}")
+    try:
+        words = shlex.split(line)
+    except ValueError as err:
+        print(f"**Error, could not parse '{line.strip()}': {err}")
+        return False
+    command, params = words[0].lower(), words[1:]
+    if command == 'stats':
+        print_query_monitor_stats(dbConn)
+        return True
+    if command not in BATCH_COMMANDS:
+        print(f"**Error, unknown command '{command}'...")
+        return False
+
+    # "... > FILE" (or "... >FILE") exports the result instead of printing it
+    export_path = None
+    if len(params) >= 2 and params[-2] == '>':
+        export_path, params = params[-1], params[:-2]
+    elif params and params[-1].startswith('>') and len(params[-1]) > 1:
+        export_path, params = params[-1][1:], params[:-1]
+
+    function, min_params, max_params, usage = BATCH_COMMANDS[command]
+    if len(params) < min_params or (max_params is not None and len(params) > max_params):
+        print(f"**Error, usage: {usage} [> FILE]")
+        return False
+    begin_monitored_command(dbConn, command)
+    try:
+        if export_path:
+            return run_export(dbConn, command, params, export_path)
+        if function(dbConn, *params) is False:
+            return False
+    finally:
+        end_monitored_command(dbConn)
+    return True
+
+# Runs every line of a batch file ('-' for stdin) against one connection; returns the number of failed lines.
+# OSError when the file cannot be read.
+def run_batch(dbConn, batch_file):
+    if batch_file == '-':
+        return run_batch_lines(dbConn, sys.stdin)
+    with open(batch_file) as lines:
+        return run_batch_lines(dbConn, lines)
+
+def run_batch_lines(dbConn, lines):
+    failures = 0
+    for line in lines:
+        if line.strip().lower() == 'x':
+            break
+        if not run_batch_line(dbConn, line):
+            failures += 1
+    return failures
+
+##################################################################
+#
+# Export
+#
+# Writes the result of a command to a CSV, JSON Lines or Parquet file
+# (picked by the file extension) instead of printing it. Rows are pulled
+# from SQLite EXPORT_BATCH_SIZE at a time with fetchmany and written as
+# they arrive, so large extracts such as every station's daily ridership
+# over several years run in constant memory. Parquet needs pyarrow.
+#
+# In batch mode, end a command line with "> FILE" to export it:
+#
+#   3 > weekday.csv
+#   8 2001-2004 % > daily.parquet
+#
+# The export of command 8 takes a year or a range of years and includes
+# every station each pattern matches; it lists (station, day) rows that
+# exist in Ridership, without filling in missing days.
+#
+EXPORT_BATCH_SIZE = 10000
+
+# Runs a query and yields its rows in lists of at most batch_size
+def stream_query(dbConn, sql, params=(), batch_size=EXPORT_BATCH_SIZE):
+    dbCursor = query_cursor(dbConn)
+    dbCursor.execute(sql, params)
+    while True:
+        rows = dbCursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+def write_csv(path, columns, batches):
+    num_rows = 0
+    with open(path, "w", newline="", encoding="utf-8") as out:
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows(rows)
+            num_rows += len(rows)
+    return num_rows
+
+def write_jsonl(path, columns, batches):
+    num_rows = 0
+    with open(path, "w", encoding="utf-8") as out:
+        for rows in batches:
+            out.writelines(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+            num_rows += len(rows)
+    return num_rows
+
+# Each batch becomes a row group; the column types are taken from the first batch
+def write_parquet(path, columns, batches):
+    import pyarrow
+    import pyarrow.parquet
+    num_rows = 0
+    writer = None
+    try:
+        for rows in batches:
+            table = pyarrow.Table.from_arrays([pyarrow.array(values) for values in zip(*rows)], names=list(columns))
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            num_rows += len(rows)
+        if writer is None:
+            pyarrow.parquet.write_table(pyarrow.table({name: pyarrow.array([]) for name in columns}), path)
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_rows
+
+# file extension -> writer
+EXPORT_WRITERS = {
+    ".csv": write_csv,
+    ".jsonl": write_jsonl,
+    ".ndjson": write_jsonl,
+    ".parquet": write_parquet,
+}
+
+# Writes (columns, batches) to path; returns the number of rows, or None when nothing was written
+def export_rows(path, columns, batches):
+    writer = EXPORT_WRITERS.get(os.path.splitext(path)[1].lower())
+    if writer is None:
+        print(f"**Error, cannot export to '{path}', use one of: {', '.join(EXPORT_WRITERS)}")
+        return None
+    try:
+        num_rows = writer(path, columns, batches)
+    except ImportError:
+        print("**Parquet export needs pyarrow (pip install pyarrow)...")
+        return None
+    except OSError as err:
+        print(f"**Error, could not write '{path}': {err}")
+        return None
+    print(f"Exported {num_rows:,} rows to {path}")
+    return num_rows
+
+# The export functions take the same parameters as the batch commands and return
+# (columns, batches of rows), or None after printing why there is nothing to export
+def export_stations(dbConn, partialStation_name):
+    rows = match_stations(get_station_catalog(dbConn), partialStation_name)
+    return ("station_id", "station_name"), [rows]
+
+def export_percentages(dbConn, *station_names):
+    catalog = get_station_catalog(dbConn)
+    station_ids = stations_for_names(catalog, station_names)
+    if station_ids is None:
+        return None
+    breakdown = day_type_breakdown(dbConn, station_ids)
+    rows = []
+    for station_id in station_ids:
+        totals = breakdown.get(station_id)
+        if totals and totals[0]:
+            rows.extend((catalog["by_id"].get(station_id), day_type, riders, riders / totals[0] * 100)
+                        for day_type, riders in zip(("Weekday", "Saturday", "Sunday/holiday"), totals[1:]))
+    if not rows:
+        print("**No data found...")
+        return None
+    return ("station_name", "day_type", "riders", "percent"), [rows]
+
+def export_weekday_ridership(dbConn):
+    table = "RidershipRollup" if rollups_current(dbConn) else "Ridership"
+    total_weekday = cached_query(dbConn, f"SELECT SUM(Num_Riders) FROM {table} WHERE Type_of_Day = 'W'")[0][0] or 0
+    batches = stream_query(dbConn, f"""SELECT Station_Name, SUM(Num_Riders) AS riders FROM {table}
+                           JOIN Stations ON {table}.Station_ID = Stations.Station_ID WHERE Type_of_Day = 'W'
+                           GROUP BY Station_Name ORDER BY riders DESC""")
+    return ("station_name", "riders", "percent"), ([(name, riders, riders / (total_weekday or 1) * 100) for name, riders in rows]
+                                                   for rows in batches)
+
+def export_line_stops(dbConn, line_input, line_direction):
+    rows = line_stops(dbConn, line_input, line_direction)
+    if not rows:
+        print("**No such line..." if not line_stops(dbConn, line_input) else "**That line does not run in the direction chosen...")
+        return None
+    return ("stop_name", "direction", "ada"), [[(stop_name, line_direction.upper(), ada) for stop_name, ada in rows]]
+
+def export_stops_per_line(dbConn):
+    tot_stops, tot_num_stops = stops_by_line_direction(dbConn)
+    rows = [(line_color, line_direction, num_stops, num_stops / tot_num_stops * 100)
+            for line_color, line_direction, num_stops in tot_stops]
+    return ("color", "direction", "stops", "percent"), [rows]
+
+def export_yearly(dbConn, station_name):
+    station = lookup_station(dbConn, station_name)
+    if not station:
+        return None
+    rows = [station + tuple(row) for row in yearly_ridership(dbConn, station[0])]
+    return ("station_id", "station_name", "year", "riders"), [rows]
+
+def export_monthly(dbConn, station_name, ride_date):
+    station = lookup_station(dbConn, station_name)
+    if not station:
+        return None
+    rows = [station + tuple(row) for row in monthly_ridership(dbConn, station[0], ride_date)]
+    return ("station_id", "station_name", "month", "riders"), [rows]
+
+# Ride_Day range of "yyyy" or "yyyy-yyyy"
+def years_day_range(years):
+    first, _, last = years.partition("-")
+    return year_day_range(first)[0], year_day_range(last or first)[1]
+
+def export_daily(dbConn, years, *station_names):
+    stations = lookup_stations(dbConn, station_names, several_per_pattern=True)
+    if stations is None:
+        return None
+    catalog = get_station_catalog(dbConn)
+    station_ids = {station_id for station_id, _ in stations}
+
+    if station_ids == set(catalog["by_id"]):
+        station_filter, params = "", ()
+    else:
+        station_filter, params = f"Station_ID IN ({', '.join('?' * len(station_ids))}) AND", tuple(sorted(station_ids))
+    batches = stream_query(dbConn, f"""SELECT Station_ID, Ride_Day, SUM(Num_Riders) FROM Ridership
+                           WHERE {station_filter} Ride_Day >= ? AND Ride_Day < ?
+                           GROUP BY Station_ID, Ride_Day ORDER BY Station_ID, Ride_Day""", params + years_day_range(years))
+    by_id = catalog["by_id"]
+    return ("station_id", "station_name", "date", "riders"), ([(station_id, by_id.get(station_id), day_to_date(ride_day), riders)
+                                                              for station_id, ride_day, riders in rows] for rows in batches)
+
+def export_radius(dbConn, user_latitude, user_longitude):
+    rows = stations_near_point(dbConn, user_latitude, user_longitude)
+    if rows is None:
+        return None
+    return ("station_name", "latitude", "longitude", "miles"), [rows]
+
+# command -> export function (same parameters as in BATCH_COMMANDS)
+EXPORT_COMMANDS = {
+    '1': export_stations,
+    '2': export_percentages,
+    '3': export_weekday_ridership,
+    '4': export_line_stops,
+    '5': export_stops_per_line,
+    '6': export_yearly,
+    '7': export_monthly,
+    '8': export_daily,
+    '9': export_radius,
+}
+
+# Runs an export command and writes its result, or its chart for a .png or .svg path; returns False when nothing was written
+def run_export(dbConn, command, params, path):
+    if os.path.splitext(path)[1].lower() in PLOT_FORMATS:
+        return run_plot_export(dbConn, command, params, path)
+    result = EXPORT_COMMANDS[command](dbConn, *params)
+    if result is None:
+        return False
+    columns, batches = result
+    return export_rows(path, columns, batches) is not None
+
+##################################################################
+#
+# Ingest
+#
+# --ingest FILE ... loads daily ridership CSV files in the format of the
+# city's "L Station Entries - Daily totals" export (station_id,
+# stationname, date, daytype, rides) into Ridership. Rows are parsed as a
+# stream and staged with executemany, INGEST_BATCH_SIZE at a time, in a
+# temporary table keyed on (station, day), so the last row for a station
+# and date wins. One transaction then updates the Ridership rows whose
+# values changed and inserts the new ones, driven from the staged rows
+# through the (Station_ID, Ride_Day) index. The triggers keep GeneralStats
+# current and mark only the touched station/months in RollupDirty, which
+# refresh_rollups then recomputes. The PRAGMAs of INGEST_PRAGMAS are set
+# for the load and restored afterwards.
+#
+INGEST_BATCH_SIZE = 50000
+INGEST_PRAGMAS = (("journal_mode", "WAL"), ("synchronous", "NORMAL"), ("cache_size", "-262144"), ("temp_store", "MEMORY"))
+INGEST_COLUMNS = ("station_id", "stationname", "date", "daytype", "rides")
+
+INGEST_STAGING_SCHEMA = """CREATE TEMP TABLE IF NOT EXISTS IngestRows (
+    Station_ID INTEGER NOT NULL,
+    Ride_Day INTEGER NOT NULL,
+    Station_Name TEXT,
+    Ride_Date TEXT NOT NULL,
+    Ride_Year INTEGER NOT NULL,
+    Ride_Month INTEGER NOT NULL,
+    Type_of_Day TEXT NOT NULL,
+    Num_Riders INTEGER NOT NULL,
+    PRIMARY KEY (Station_ID, Ride_Day)
+) WITHOUT ROWID"""
+
+INGEST_NEW_STATIONS = """INSERT OR IGNORE INTO Stations (Station_ID, Station_Name)
+SELECT Station_ID, MAX(Station_Name) FROM temp.IngestRows WHERE Station_Name <> '' GROUP BY Station_ID"""
+
+# staged rows whose Ridership row has other values, and staged rows that have no Ridership row yet
+INGEST_CHANGED_ROWS = """SELECT i.Station_ID, i.Ride_Day FROM temp.IngestRows AS i CROSS JOIN Ridership AS r
+    ON r.Station_ID = i.Station_ID AND r.Ride_Day = i.Ride_Day
+    WHERE r.Type_of_Day IS NOT i.Type_of_Day OR r.Num_Riders IS NOT i.Num_Riders"""
+INGEST_NEW_ROWS = """FROM temp.IngestRows AS i
+WHERE NOT EXISTS (SELECT 1 FROM Ridership WHERE Ridership.Station_ID = i.Station_ID AND Ridership.Ride_Day = i.Ride_Day)"""
+
+INGEST_UPDATE = f"""UPDATE Ridership SET (Type_of_Day, Num_Riders) = (SELECT i.Type_of_Day, i.Num_Riders FROM temp.IngestRows AS i
+    WHERE i.Station_ID = Ridership.Station_ID AND i.Ride_Day = Ridership.Ride_Day)
+WHERE (Station_ID, Ride_Day) IN ({INGEST_CHANGED_ROWS})"""
+
+INGEST_INSERT = f"""INSERT INTO Ridership (Station_ID, Ride_Date, Type_of_Day, Num_Riders, Ride_Day, Ride_Year, Ride_Month)
+SELECT i.Station_ID, i.Ride_Date, i.Type_of_Day, i.Num_Riders, i.Ride_Day, i.Ride_Year, i.Ride_Month {INGEST_NEW_ROWS}"""
+
+# (Ride_Day, Ride_Date, year, month) of an mm/dd/yyyy or yyyy-mm-dd date; dates repeat, so they are parsed once
+def parse_ingest_date(text, date_suffix, parsed_dates):
+    if text not in parsed_dates:
+        if "/" in text:
+            month, day, year = text.split()[0].split("/")
+        else:
+            year, month, day = text[:10].split("-")
+        date = datetime.date(int(year), int(month), int(day))
+        parsed_dates[text] = (date.toordinal() - EPOCH_ORDINAL, date.isoformat() + date_suffix, date.year, date.month)
+    return parsed_dates[text]
+
+# Reads one CSV file into the staging table; returns (rows read, rows skipped)
+def stage_csv(dbConn, path, date_suffix, batch_size):
+    num_read = num_skipped = 0
+    parsed_dates = {}
+    csv_file = sys.stdin if path == '-' else open(path, newline="", encoding="utf-8-sig")
+    try:
+        reader = csv.reader(csv_file)
+        first_row = next(reader, [])
+        header = [name.strip().lower() for name in first_row]
+        if all(name in header for name in ("station_id", "date", "daytype", "rides")):
+            positions = [header.index(name) if name in header else None for name in INGEST_COLUMNS]
+            first_line = 2
+        else:
+            # no header: the columns are in the order of INGEST_COLUMNS
+            positions = list(range(len(INGEST_COLUMNS)))
+            reader = itertools.chain([first_row], reader)
+            first_line = 1
+        batch = []
+        for line_num, fields in enumerate(reader, start=first_line):
+            if not fields:
+                continue
+            num_read += 1
+            try:
+                station_id, station_name, ride_date, day_type, num_riders = (
+                    fields[position].strip() if position is not None else "" for position in positions)
+                ride_day, ride_date, ride_year, ride_month = parse_ingest_date(ride_date, date_suffix, parsed_dates)
+                day_type = day_type.upper()
+                if day_type not in DAY_TYPES:
+                    raise ValueError(f"unknown day type '{day_type}'")
+                batch.append((int(station_id), ride_day, station_name, ride_date, ride_year, ride_month,
+                               day_type, int(num_riders)))
+            except (ValueError, IndexError) as err:
+                num_skipped += 1
+                if num_skipped <= 5:
+                    print(f"**Skipping {path} line {line_num}: {err or 'missing column'}")
+                continue
+            if len(batch) >= batch_size:
+                dbConn.executemany("INSERT OR REPLACE INTO temp.IngestRows VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                batch = []
+        dbConn.executemany("INSERT OR REPLACE INTO temp.IngestRows VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+    finally:
+        if csv_file is not sys.stdin:
+            csv_file.close()
+    return num_read, num_skipped
+
+# Loads the CSV files ('-' for stdin) into Ridership and refreshes what depends on it; returns the counts
+def ingest_files(dbConn, paths, batch_size=INGEST_BATCH_SIZE):
+    start = time.perf_counter()
+    dbCursor = dbConn.cursor()
+    saved_pragmas = [(name, dbCursor.execute(f"PRAGMA {name}").fetchone()[0]) for name, _ in INGEST_PRAGMAS]
+    for name, value in INGEST_PRAGMAS:
+        dbCursor.execute(f"PRAGMA {name} = {value}")
+
+    # new rows use the time suffix the existing Ride_Date values have (if any)
+    row = dbCursor.execute("SELECT Ride_Date FROM Ridership LIMIT 1").fetchone()
+    date_suffix = row[0][10:] if row and row[0] else ""
+
+    counts = {"read": 0, "skipped": 0}
+    try:
+        dbCursor.execute(INGEST_STAGING_SCHEMA)
+        dbCursor.execute("DELETE FROM temp.IngestRows")
+        with dbConn:
+            for path in paths:
+                num_read, num_skipped = stage_csv(dbConn, path, date_suffix, batch_size)
+                counts["read"] += num_read
+                counts["skipped"] += num_skipped
+        counts["staged"] = dbCursor.execute("SELECT COUNT(*) FROM temp.IngestRows").fetchone()[0]
+        staged = time.perf_counter()
+
+        with dbConn:
+            counts["new_stations"] = dbCursor.execute(INGEST_NEW_STATIONS).rowcount
+            # counted beforehand: rowcount misses the rows a compact Ridership view writes through its triggers
+            counts["updated"] = dbCursor.execute(f"SELECT COUNT(*) FROM ({INGEST_CHANGED_ROWS})").fetchone()[0]
+            counts["inserted"] = dbCursor.execute(f"SELECT COUNT(*) {INGEST_NEW_ROWS}").fetchone()[0]
+            dbCursor.execute(INGEST_UPDATE)
+            dbCursor.execute(INGEST_INSERT)
+        merged = time.perf_counter()
+
+        counts["rollup_groups"] = refresh_rollups(dbConn)
+        dbCursor.execute("PRAGMA optimize")
+    finally:
+        dbCursor.execute("DROP TABLE IF EXISTS temp.IngestRows")
+        for name, value in saved_pragmas:
+            dbCursor.execute(f"PRAGMA {name} = {value}")
+    done = time.perf_counter()
+
+    counts["duplicates"] = counts["read"] - counts["skipped"] - counts["staged"]
+    counts["unchanged"] = counts["staged"] - counts["updated"] - counts["inserted"]
+    counts["seconds"] = done - start
+    print(f"Ingested {counts['read']:,} rows from {len(paths)} file(s): {counts['inserted']:,} inserted, {counts['updated']:,} updated,",
+          f"{counts['unchanged']:,} unchanged, {counts['duplicates']:,} duplicates, {counts['skipped']:,} skipped")
+    if counts["new_stations"]:
+        print(f"  Added {counts['new_stations']:,} new stations")
+    print(f"  Parse and stage {staged - start:.2f} s ({counts['read'] / max(staged - start, 1e-9):,.0f} rows/s),",
+          f"merge {merged - staged:.2f} s, rollups {done - merged:.2f} s ({counts['rollup_groups']:,} station/months)")
+    print(f"  Total {counts['seconds']:.2f} s: {counts['read'] / max(counts['seconds'], 1e-9):,.0f} rows/s")
+    return counts
+
+##################################################################
+#
+# Compact storage
+#
+# --compact rebuilds Ridership once as RidershipData, a WITHOUT ROWID
+# table clustered on its primary key (Station_ID, Ride_Day) that stores
+# the day type as an integer code (the position in DAY_TYPES) and no date
+# text. A station's rows are then stored next to each other in day order,
+# so the station and date range lookups read them straight from the table
+# instead of going through a separate index. Ridership becomes a view
+# with the old columns (Ride_Date, Type_of_Day, Ride_Year and Ride_Month
+# are computed from the integer columns), so every query works unchanged.
+# Writes to the view go through INSTEAD OF triggers, including the
+# GeneralStats and rollup triggers. The rebuild ends with ANALYZE and
+# VACUUM and reports the size and scan speed before and after.
+#
+RIDERSHIP_TRIGGER = re.compile(r"CREATE TRIGGER IF NOT EXISTS Ridership_\w+ AFTER .*? ON Ridership\nBEGIN\n.*?\nEND;", re.DOTALL)
+
+COMPACT_SCHEMA = """
+CREATE TABLE RidershipData (
+    Station_ID INTEGER NOT NULL,
+    Ride_Day INTEGER NOT NULL,
+    Day_Type INTEGER NOT NULL,
+    Num_Riders INTEGER,
+    PRIMARY KEY (Station_ID, Ride_Day)
+) WITHOUT ROWID;
+INSERT INTO RidershipData
+SELECT Station_ID, Ride_Day, instr('{day_types}', Type_of_Day) - 1, Num_Riders FROM Ridership ORDER BY Station_ID, Ride_Day;
+DROP TABLE Ridership;
+CREATE VIEW Ridership AS
+SELECT Station_ID, date(Ride_Day * 86400, 'unixepoch') || '{date_suffix}' AS Ride_Date,
+       CASE Day_Type {day_type_cases} END AS Type_of_Day, Num_Riders, Ride_Day,
+       CAST(strftime('%Y', Ride_Day * 86400, 'unixepoch') AS INTEGER) AS Ride_Year,
+       CAST(strftime('%m', Ride_Day * 86400, 'unixepoch') AS INTEGER) AS Ride_Month
+FROM RidershipData;
+CREATE TRIGGER Ridership_data_insert INSTEAD OF INSERT ON Ridership
+BEGIN
+    SELECT RAISE(ABORT, 'Type_of_Day must be one of {day_types}')
+    WHERE length(NEW.Type_of_Day) IS NOT 1 OR instr('{day_types}', NEW.Type_of_Day) = 0;
+    INSERT INTO RidershipData VALUES (NEW.Station_ID,
+        COALESCE(CAST(julianday(date(NEW.Ride_Date)) - 2440587.5 AS INTEGER), NEW.Ride_Day),
+        instr('{day_types}', NEW.Type_of_Day) - 1, NEW.Num_Riders);
+END;
+CREATE TRIGGER Ridership_data_update INSTEAD OF UPDATE ON Ridership
+BEGIN
+    SELECT RAISE(ABORT, 'Type_of_Day must be one of {day_types}')
+    WHERE length(NEW.Type_of_Day) IS NOT 1 OR instr('{day_types}', NEW.Type_of_Day) = 0;
+    UPDATE RidershipData SET Station_ID = NEW.Station_ID,
+        Ride_Day = CASE WHEN NEW.Ride_Date IS NOT OLD.Ride_Date
+                        THEN CAST(julianday(date(NEW.Ride_Date)) - 2440587.5 AS INTEGER) ELSE NEW.Ride_Day END,
+        Day_Type = instr('{day_types}', NEW.Type_of_Day) - 1, Num_Riders = NEW.Num_Riders
+    WHERE Station_ID = OLD.Station_ID AND Ride_Day = OLD.Ride_Day;
+END;
+CREATE TRIGGER Ridership_data_delete INSTEAD OF DELETE ON Ridership
+BEGIN
+    DELETE FROM RidershipData WHERE Station_ID = OLD.Station_ID AND Ride_Day = OLD.Ride_Day;
+END;
+"""
+
+# True once compact_ridership has turned Ridership into a view over RidershipData
+def ridership_is_compact(dbConn):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'view' AND name = 'Ridership'")
+    return dbCursor.fetchone()[0] > 0
+
+# schema with its AFTER triggers on Ridership made INSTEAD OF triggers when Ridership is the compact view
+def ridership_schema(dbConn, schema):
+    if not ridership_is_compact(dbConn):
+        return schema
+    return RIDERSHIP_TRIGGER.sub(lambda match: match.group(0).replace(" AFTER ", " INSTEAD OF ", 1), schema)
+
+# Database size in bytes
+def database_size(dbConn):
+    dbCursor = dbConn.cursor()
+    return dbCursor.execute("PRAGMA page_count").fetchone()[0] * dbCursor.execute("PRAGMA page_size").fetchone()[0]
+
+# (rows/s of the command 3 full scan, ms per station lookup of one year) over Ridership, best of repeat runs
+def ridership_scan_speed(dbConn, repeat=3):
+    dbCursor = dbConn.cursor()
+    num_rows, last_day = dbCursor.execute("SELECT COUNT(*), MAX(Ride_Day) FROM Ridership").fetchone()
+    station_ids = [row[0] for row in dbCursor.execute("SELECT Station_ID FROM Stations ORDER BY Station_ID")]
+    start_day, end_day = year_day_range(day_to_date(last_day)[:4]) if last_day is not None else (0, 0)
+    scan_seconds = lookup_seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        dbCursor.execute("SELECT Station_ID, SUM(Num_Riders) FROM Ridership WHERE Type_of_Day = 'W' GROUP BY Station_ID").fetchall()
+        scanned = time.perf_counter()
+        for station_id in station_ids:
+            dbCursor.execute("SELECT Ride_Day, Num_Riders FROM Ridership WHERE Station_ID = ? AND Ride_Day >= ? AND Ride_Day < ?",
+                             (station_id, start_day, end_day)).fetchall()
+        done = time.perf_counter()
+        scan_seconds = min(scan_seconds, scanned - start)
+        lookup_seconds = min(lookup_seconds, done - scanned)
+    return num_rows / max(scan_seconds, 1e-9), lookup_seconds * 1000 / max(len(station_ids), 1)
+
+# Rebuilds Ridership in the compact layout, then ANALYZE and VACUUM; returns (bytes before, bytes after),
+# or None when the table cannot be compacted
+def compact_ridership(dbConn):
+    dbCursor = dbConn.cursor()
+    if ridership_is_compact(dbConn):
+        print("Ridership is already compact")
+        return database_size(dbConn), database_size(dbConn)
+    dbCursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('GeneralStats', 'RidershipRollup')")
+    if dbCursor.fetchone()[0] < 2:
+        print("**Cannot compact Ridership without its GeneralStats and rollup tables")
+        return None
+
+    # every value has to survive the integer encoding: one date suffix, known day types, one row per station and day
+    row = dbCursor.execute("SELECT Ride_Date FROM Ridership LIMIT 1").fetchone()
+    date_suffix = row[0][10:] if row and row[0] else ""
+    dbCursor.execute("""SELECT COUNT(*) FROM Ridership WHERE Station_ID IS NULL OR Ride_Day IS NULL
+                     OR Ride_Date IS NOT date(Ride_Date) || ? OR length(Type_of_Day) IS NOT 1 OR instr(?, Type_of_Day) = 0""",
+                     (date_suffix, "".join(DAY_TYPES)))
+    num_bad = dbCursor.fetchone()[0]
+    if num_bad:
+        print(f"**Cannot compact Ridership: {num_bad:,} rows have a date or day type that cannot be encoded")
+        return None
+    dbCursor.execute("SELECT COUNT(*) FROM (SELECT 1 FROM Ridership GROUP BY Station_ID, Ride_Day HAVING COUNT(*) > 1)")
+    num_duplicates = dbCursor.fetchone()[0]
+    if num_duplicates:
+        print(f"**Cannot compact Ridership: {num_duplicates:,} station/days have more than one row")
+        return None
+
+    size_before = database_size(dbConn)
+    scan_before, lookup_before = ridership_scan_speed(dbConn)
+    start = time.perf_counter()
+    day_type_cases = " ".join(f"WHEN {code} THEN '{day_type}'" for code, day_type in enumerate(DAY_TYPES))
+    compact_schema = COMPACT_SCHEMA.format(day_types="".join(DAY_TYPES), day_type_cases=day_type_cases,
+                                           date_suffix=date_suffix.replace("'", "''"))
+    # the view replaces the table and its AFTER triggers, so those come back as INSTEAD OF triggers
+    triggers = "\n".join(trigger.replace(" AFTER ", " INSTEAD OF ", 1)
+                         for trigger in RIDERSHIP_TRIGGER.findall(GENERAL_STATS_SCHEMA + ROLLUP_SCHEMA))
+    try:
+        dbCursor.executescript("BEGIN IMMEDIATE;" + compact_schema + triggers + "\nCOMMIT;")
+    except sqlite3.Error:
+        dbConn.rollback()
+        raise
+    rebuilt = time.perf_counter()
+    dbCursor.execute("ANALYZE")
+    dbCursor.execute("VACUUM")
+    done = time.perf_counter()
+
+    # the connection's column store and shards were made from the old file
+    columnar_engines.pop(dbConn, None)
+    close_shards(dbConn)
+
+    size_after = database_size(dbConn)
+    scan_after, lookup_after = ridership_scan_speed(dbConn)
+    print(f"Compacted Ridership in {done - start:.2f} s (rebuild {rebuilt - start:.2f} s, ANALYZE and VACUUM {done - rebuilt:.2f} s)")
+    print(f"  Database size: {size_before / 2**20:,.1f} MiB -> {size_after / 2**20:,.1f} MiB",
+          f"({100 * (1 - size_after / max(size_before, 1)):.0f}% smaller)")
+    print(f"  Full scan: {scan_before:,.0f} -> {scan_after:,.0f} rows/s")
+    print(f"  Station lookup of one year: {lookup_before:.2f} -> {lookup_after:.2f} ms")
+    return size_before, size_after
+
+##################################################################
+#
+# Server mode
+#
+# --serve runs a local HTTP server that answers commands 1-9 as JSON, so
+# several people and dashboards can share one database. Each request runs
+# on its own thread with a read-only connection (URI mode=ro) taken from
+# a pool; the database is switched to WAL first, so the readers never
+# block each other or a writer. Every pooled connection has its own
+# station catalog, stop index and query cache.
+#
+#   GET /stations?pattern=%Lake                           command 1
+#   GET /percentages?station=Clark/Lake                   command 2
+#   GET /day-types[?station=%Lake&station=Jackson]        command 2, many stations
+#   GET /weekday-ridership                                command 3
+#   GET /line-stops?color=Red&direction=N                 command 4
+#   GET /stops-per-line                                   command 5
+#   GET /yearly?station=Clark/Lake                        command 6
+#   GET /monthly?station=Clark/Lake&year=2002             command 7
+#   GET /daily?year=2002&station=Jackson&station=UIC%     command 8
+#   GET /nearby?lat=41.88&lon=-87.63[&radius=1][&k=3]     command 9
+#
+# Errors come back as {"error": ...} with status 400 (bad parameters),
+# 404 (nothing found) or 500 (database error).
+#
+class ApiError(Exception):
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.payload = dict(error=message, **details)
+
+# Opens pool_size read-only connections to db_path, shareable between threads
+def open_connection_pool(db_path, pool_size):
+    import queue
+    import urllib.parse
+    uri = "file:" + urllib.parse.quote(os.path.abspath(db_path)) + "?mode=ro"
+    pool = queue.Queue()
+    for _ in range(pool_size):
+        pool.put(sqlite3.connect(uri, uri=True, check_same_thread=False))
+    return pool
+
+# Runs function with a connection from the pool (waiting for one if all are busy)
+def with_pooled_connection(pool, function, *args):
+    dbConn = pool.get()
+    try:
+        return function(dbConn, *args)
+    finally:
+        pool.put(dbConn)
+
+# The single value of a query parameter; missing and empty ones are a 400 unless a default is given
+def query_param(query, name, default=None):
+    values = query.get(name)
+    if not values or not values[0].strip():
+        if default is None:
+            raise ApiError(400, f"missing parameter '{name}'")
+        return default
+    return values[0].strip()
+
+# A finite number parameter within [low, high]
+def query_number(query, name, default=None, low=-math.inf, high=math.inf):
+    value = query_param(query, name, default)
+    try:
+        number = float(value)
+    except ValueError:
+        raise ApiError(400, f"parameter '{name}' is not a number")
+    if not math.isfinite(number):
+        raise ApiError(400, f"parameter '{name}' is not a finite number")
+    if not low <= number <= high:
+        raise ApiError(400, f"parameter '{name}' is out of bounds", low=low, high=high)
+    return number
+
+# Same as lookup_station, but reports the problem as an ApiError
+def api_station(dbConn, pattern):
+    catalog = get_station_catalog(dbConn)
+    rows = match_stations(catalog, pattern)
+    if not rows:
+        raise ApiError(404, "no station found", pattern=pattern, suggestions=suggest_stations(catalog, pattern))
+    if len(rows) > 1:
+        raise ApiError(400, "multiple stations found", pattern=pattern, matches=[name for _, name in rows])
+    return rows[0]
+
+def api_stations(dbConn, query):
+    pattern = query_param(query, "pattern")
+    catalog = get_station_catalog(dbConn)
+    rows = match_stations(catalog, pattern)
+    if not rows:
+        raise ApiError(404, "no stations found", pattern=pattern, suggestions=suggest_stations(catalog, pattern))
+    return [{"station_id": station_id, "station_name": name} for station_id, name in rows]
+
+def api_percentages(dbConn, query):
+    station_name = query_param(query, "station")
+    totals = day_type_totals(dbConn, station_name)
+    if totals is None or not totals[0]:
+        raise ApiError(404, "no data found", station=station_name)
+    tot_ridership, weekday_total, saturday_total, sunday_total = totals
+    return {"station_name": station_name, "total": tot_ridership,
+            "weekday": weekday_total, "weekday_percent": weekday_total / tot_ridership * 100,
+            "saturday": saturday_total, "saturday_percent": saturday_total / tot_ridership * 100,
+            "sunday_holiday": sunday_total, "sunday_holiday_percent": sunday_total / tot_ridership * 100}
+
+def raise_station_not_found(catalog, pattern):
+    raise ApiError(404, "no station found", pattern=pattern, suggestions=suggest_stations(catalog, pattern))
+
+# Command 2 for the stations the names or patterns match, or for every station without a station parameter
+def api_day_types(dbConn, query):
+    catalog = get_station_catalog(dbConn)
+    patterns = [pattern.strip() for pattern in query.get("station", []) if pattern.strip()]
+    station_ids = stations_for_names(catalog, patterns, raise_station_not_found) if patterns else None
+    breakdown = day_type_breakdown(dbConn, station_ids)
+    return [{"station_id": station_id, "station_name": catalog["by_id"].get(station_id), "total": tot_ridership,
+             "weekday": weekday_total, "saturday": saturday_total, "sunday_holiday": sunday_total}
+            for station_id, (tot_ridership, weekday_total, saturday_total, sunday_total) in sorted(breakdown.items())]
+
+def api_weekday_ridership(dbConn, query):
+    weekday_totals = get_weekday_ridership(dbConn)
+    total_weekday = sum(riders for _, riders in weekday_totals)
+    return [{"station_name": name, "riders": riders, "percent": riders / total_weekday * 100 if total_weekday else 0.0}
+            for name, riders in weekday_totals]
+
+def api_line_stops(dbConn, query):
+    line_color = query_param(query, "color")
+    if not line_stops(dbConn, line_color):
+        raise ApiError(404, "no such line", color=line_color)
+    line_direction = query_param(query, "direction", "")
+    rows = line_stops(dbConn, line_color, line_direction or None)
+    if not rows:
+        raise ApiError(404, "that line does not run in the direction chosen", color=line_color, direction=line_direction)
+    return [{"stop_name": stop_name, "ada": bool(ada)} for stop_name, ada in rows]
+
+def api_stops_per_line(dbConn, query):
+    tot_stops, tot_num_stops = stops_by_line_direction(dbConn)
+    return {"total_stops": tot_num_stops,
+            "lines": [{"color": line_color, "direction": line_direction, "stops": num_stops,
+                       "percent": num_stops / tot_num_stops * 100 if tot_num_stops else 0.0}
+                      for line_color, line_direction, num_stops in tot_stops]}
+
+def api_yearly(dbConn, query):
+    station_id, station_name = api_station(dbConn, query_param(query, "station"))
+    return {"station_id": station_id, "station_name": station_name,
+            "years": [{"year": year, "riders": riders} for year, riders in yearly_ridership(dbConn, station_id)]}
+
+def api_monthly(dbConn, query):
+    station_id, station_name = api_station(dbConn, query_param(query, "station"))
+    ride_date = query_param(query, "year")
+    return {"station_id": station_id, "station_name": station_name, "year": ride_date,
+            "months": [{"month": month, "riders": riders}
+                       for month, riders in monthly_ridership(dbConn, station_id, ride_date)]}
+
+def api_daily(dbConn, query):
+    year_compare = query_param(query, "year")
+    stations = [api_station(dbConn, pattern) for pattern in query.get("station", []) if pattern.strip()]
+    if not stations:
+        raise ApiError(400, "missing parameter 'station'")
+    calendar, series = compare_stations_daily(dbConn, [station_id for station_id, _ in stations], year_compare)
+    return {"year": year_compare, "dates": [day_to_date(day) for day in calendar],
+            "stations": [{"station_id": station_id, "station_name": station_name, "riders": series[station_id]}
+                         for station_id, station_name in stations]}
+
+# the largest radius and k a request may ask for
+API_MAX_RADIUS_MILES = 100.0
+API_MAX_K = 100
+
+def api_nearby(dbConn, query):
+    latitude = query_number(query, "lat", low=LATITUDE_RANGE[0], high=LATITUDE_RANGE[1])
+    longitude = query_number(query, "lon", low=LONGITUDE_RANGE[0], high=LONGITUDE_RANGE[1])
+    stop_index = get_stop_index(dbConn)
+    if "k" in query:
+        found = nearest_stations(stop_index, latitude, longitude, int(query_number(query, "k", low=1, high=API_MAX_K)))
+    else:
+        found = stations_within(stop_index, latitude, longitude,
+                                query_number(query, "radius", "1.0", low=0, high=API_MAX_RADIUS_MILES))
+    return [{"station_name": name, "latitude": stop_lat, "longitude": stop_lon, "miles": miles}
+            for name, stop_lat, stop_lon, miles in found]
+
+# path -> (function, command number)
+API_ROUTES = {
+    "/stations": (api_stations, 1),
+    "/percentages": (api_percentages, 2),
+    "/day-types": (api_day_types, 2),
+    "/weekday-ridership": (api_weekday_ridership, 3),
+    "/line-stops": (api_line_stops, 4),
+    "/stops-per-line": (api_stops_per_line, 5),
+    "/yearly": (api_yearly, 6),
+    "/monthly": (api_monthly, 7),
+    "/daily": (api_daily, 8),
+    "/nearby": (api_nearby, 9),
+}
+
+# Answers one GET request as (status, JSON-ready payload)
+def handle_api_request(pool, path):
+    import urllib.parse
+    url = urllib.parse.urlsplit(path)
+    if url.path in ("", "/"):
+        return 200, {"commands": {route: command for route, (_, command) in API_ROUTES.items()}}
+    if url.path not in API_ROUTES:
+        return 404, {"error": f"unknown path '{url.path}'"}
+    function, _ = API_ROUTES[url.path]
+    try:
+        return 200, with_pooled_connection(pool, function, urllib.parse.parse_qs(url.query))
+    except ApiError as err:
+        return err.status, err.payload
+    except sqlite3.Error as err:
+        return 500, {"error": f"database error: {err}"}
+    except Exception as err:
+        # a bug must not leave the client without a response
+        print(f"**Error answering {path}: {err!r}", file=sys.stderr)
+        return 500, {"error": f"internal error: {type(err).__name__}"}
+
+# Serves the API until interrupted; returns the exit status for main
+def run_server(db_path, host, port, pool_size, cache_size=0, cache_ttl=None, columnar=False):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # WAL is a property of the database file, so it is set once from a writable connection
+    try:
+        dbConn = open_database(db_path)
+    except sqlite3.Error as err:
+        print("**Could not add date columns to Ridership:", err)
+        return 1
+    try:
+        dbConn.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.Error as err:
+        print("**Could not switch the database to WAL:", err)
+    dbConn.close()
+
+    pool = open_connection_pool(db_path, pool_size)
+    connections = list(pool.queue)
+    # the arrays are read-only, so every pooled connection answers from (and reloads) the one engine
+    shared_columnar = enable_columnar(connections[0]) if columnar else None
+    for dbConn in connections:
+        if cache_size > 0:
+            enable_query_cache(dbConn, cache_size, cache_ttl)
+        if shared_columnar is not None:
+            columnar_engines[dbConn] = shared_columnar
+        get_station_catalog(dbConn)
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, payload = handle_api_request(pool, self.path)
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    # the default listen backlog of 5 makes bursts of clients wait for a TCP retry
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    server = Server((host, port), RequestHandler)
+    print(f"Serving {db_path} on http://{host}:{server.server_port}/ with {pool_size} read-only connections (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping server")
+    finally:
+        server.server_close()
+        for dbConn in connections:
+            dbConn.close()
+    return 0
 
 ##################################################################
 #
 # main
 #
-print('** Welcome to CTA L analysis app **')
-print()
-
-dbConn = sqlite3.connect('CTA2_L_daily_ridership.db')
-
-print_stats(dbConn)
-while True:
-    print("\nPlease enter a command (1-9, x to exit): ", end = "")
-    command = input().strip().lower()
-    if command == 'x':
-        break
-    elif command == '1':
-        partial_name2 = input("\nEnter partial station name (wildcards _ and %): ")
-        station_match(dbConn, partial_name2)
-    elif command == '2':
-        station_name = input("\nEnter the name of the station you would like to analyze: ")
-        get_percentages(dbConn, station_name)
-    elif command == '3':
-        weekday_totals = get_weekday_ridership(dbConn)
-        display_info(weekday_totals)
-    elif command == '4':
-        stops_for_lineColor_Direction(dbConn)
-    elif command == '5':
-        num_of_stops_line_color(dbConn)
-    elif command == '6':
-        total_ridership_year(dbConn)
-    elif command == '7':
-        ridership_each_month(dbConn)
-    elif command == '8':
-        tot_ridership_days(dbConn)
-    elif command == '9':
-        stations_in_a_mile_radius(dbConn)
+# Opens the database and brings the derived tables up to date (date columns, rollups).
+# sqlite3.Error when the date columns cannot be added.
+def open_database(db_path=DEFAULT_DATABASE):
+    dbConn = sqlite3.connect(db_path)
+
+    # add the integer date columns the queries filter on (only does work the first time); every
+    # command needs them, so a database that cannot be migrated is not opened at all
+    try:
+        migrate_date_columns(dbConn)
+    except sqlite3.Error:
+        dbConn.close()
+        raise
+
+    # fold any Ridership changes into the rollups; a read-only database just keeps using the raw table
+    try:
+        refresh_rollups(dbConn)
+    except sqlite3.Error as err:
+        print("**Could not refresh ridership rollups:", err)
+
+    # the general statistics header is computed once here and then kept current by triggers
+    try:
+        create_general_stats(dbConn)
+    except sqlite3.Error as err:
+        print("**Could not store general statistics:", err)
+    return dbConn
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CTA L ridership analysis")
+    parser.add_argument("--db", default=DEFAULT_DATABASE, help="path of the CTA database (default: %(default)s)")
+    parser.add_argument("--columnar", action="store_true", help="answer commands 2, 3, 6, 7 and 8 from numpy column arrays")
+    parser.add_argument("--batch", metavar="FILE", help="run the commands in FILE ('-' for stdin) without prompts")
+    parser.add_argument("--recompute-stats", action="store_true", help="recompute the general statistics in the background")
+    parser.add_argument("--timing", action="store_true", help="report the cold-start time and the query cache counters")
+    parser.add_argument("--cache-size", type=int, default=256, help="entries in the query result cache, 0 turns it off (default: %(default)s)")
+    parser.add_argument("--cache-ttl", type=float, help="seconds a cached result stays valid (default: until the database changes)")
+    parser.add_argument("--cache-file", help="also keep cached results in this SQLite file across runs")
+    parser.add_argument("--shards", action="store_true", help="split Ridership into per-year files and aggregate them in parallel")
+    parser.add_argument("--workers", type=int, help="worker processes for --shards and --plot-all (default: one per core)")
+    parser.add_argument("--monitor", action="store_true", help="time every query and enable the 'stats' command")
+    parser.add_argument("--slow-ms", type=float, default=100.0, help="queries taking this long are slow (default: %(default)s)")
+    parser.add_argument("--slow-log", help="append slow queries to this file (implies --monitor)")
+    parser.add_argument("--ingest", nargs="+", metavar="CSV", help="load daily ridership CSV files ('-' for stdin) and exit")
+    parser.add_argument("--compact", action="store_true", help="rebuild Ridership in the compact clustered layout and exit")
+    parser.add_argument("--plot-all", metavar="DIR", help="save the yearly chart of every station in DIR and exit")
+    parser.add_argument("--plot-format", choices=("png", "svg"), default="png", help="file format of --plot-all (default: %(default)s)")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", help="answer commands 1-9 as JSON over HTTP instead of prompting")
+    parser.add_argument("--pool-size", type=int, default=8, help="read-only connections of the server (default: %(default)s)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.serve:
+        if not os.path.exists(args.db):
+            print(f"**Database {args.db} not found...")
+            return 1
+        host, _, port = args.serve.rpartition(":")
+        if not port.isdigit():
+            print(f"**Error, --serve expects [HOST:]PORT, not '{args.serve}'")
+            return 1
+        return run_server(args.db, host or "127.0.0.1", int(port), max(args.pool_size, 1),
+                          args.cache_size, args.cache_ttl, args.columnar)
+
+    print('** Welcome to CTA L analysis app **')
+    print()
+
+    imported = time.perf_counter()
+    if not os.path.exists(args.db):
+        print(f"**Database {args.db} not found...")
+        return 1
+    try:
+        dbConn = open_database(args.db)
+    except sqlite3.Error as err:
+        print("**Could not add date columns to Ridership:", err)
+        return 1
+    if args.cache_size > 0:
+        enable_query_cache(dbConn, args.cache_size, args.cache_ttl, args.cache_file)
+    if args.ingest:
+        try:
+            ingest_files(dbConn, args.ingest)
+        except (OSError, sqlite3.Error) as err:
+            print("**Ingest failed:", err)
+            return 1
+        finally:
+            dbConn.close()
+        return 0
+    if args.compact:
+        try:
+            compacted = compact_ridership(dbConn)
+        except sqlite3.Error as err:
+            print("**Compaction failed:", err)
+            return 1
+        finally:
+            dbConn.close()
+        return 0 if compacted else 1
+    if args.plot_all:
+        try:
+            plot_all_stations(dbConn, args.plot_all, args.plot_format, args.workers)
+        except ImportError:
+            print("**Plotting needs matplotlib (pip install matplotlib)...")
+            return 1
+        except (OSError, sqlite3.Error) as err:
+            print("**Plotting failed:", err)
+            return 1
+        finally:
+            dbConn.close()
+        return 0
+    if args.monitor or args.slow_log:
+        enable_query_monitor(dbConn, args.slow_ms, args.slow_log)
+    opened = time.perf_counter()
+
+    if args.columnar:
+        enable_columnar(dbConn)
+    if args.shards:
+        enable_shards(dbConn, args.workers)
+
+    stats_thread = None
+    if args.recompute_stats:
+        stats_thread = recompute_general_stats_in_background(args.db)
+
+    print_stats(dbConn)
+    if args.timing:
+        ready = time.perf_counter()
+        print(f"\nStartup: imports {(imported - START_TIME) * 1000:.0f} ms, database {(opened - imported) * 1000:.0f} ms,",
+              f"ready after {(ready - START_TIME) * 1000:.0f} ms")
+
+    failures = 0
+    if args.batch:
+        try:
+            failures = run_batch(dbConn, args.batch)
+        except OSError as err:
+            print(f"**Error, could not read batch file {args.batch}: {err.strerror or err}")
+            failures = 1
     else:
-        print("**Error, unknown command, try again...")
+        run_interactive(dbConn)
+    if args.timing:
+        print_query_cache_stats(dbConn)
+    if stats_thread is not None:
+        stats_thread.join()
+    close_shards(dbConn)
+    dbConn.close()
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
 
 #
 # done
@@ -0,0 +1,189 @@
+#
+# Benchmark for the CTA L analysis app
+# Overview: Runs print_stats and commands 1-9 of "CTA project.py" without prompts against
+# synthetic databases of several sizes (see synthetic_db.py) and reports wall time, peak
+# Python memory and SQLite VM steps for each, compared with a stored baseline.
+#
+#   python benchmark.py --scales 1,10 --save-baseline     # record benchmark_baseline.json
+#   python benchmark.py --scales 1,10                     # compare with it
+#
+# VM steps are the number of SQLite virtual machine instructions run (counted with a
+# progress handler); they follow the number of rows a query scans and, unlike wall time,
+# do not depend on the machine. Python's sqlite3 has no per-statement scan counters.
+#
+
+
+import argparse
+import contextlib
+import json
+import os
+import runpy
+import statistics
+import sys
+import time
+import tracemalloc
+
+import synthetic_db
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(HERE, "CTA project.py")
+DEFAULT_DB_DIR = os.path.join(HERE, "bench_dbs")
+DEFAULT_BASELINE = os.path.join(HERE, "benchmark_baseline.json")
+
+# the progress handler is called every PROGRESS_STEPS VM instructions
+PROGRESS_STEPS = 100
+
+# differences below this many seconds are noise, whatever the ratio
+NOISE_SECONDS = 0.005
+
+# Loads the app's functions without running its main
+def load_app():
+    return runpy.run_path(APP_PATH)
+
+# Synthetic database of the scale in db_dir, generated on first use
+def scale_database(db_dir, scale, seed):
+    path = os.path.join(db_dir, f"cta_x{scale:g}_seed{seed}.db")
+    if not os.path.exists(path):
+        os.makedirs(db_dir, exist_ok=True)
+        print(f"Generating {path} ...", flush=True)
+        synthetic_db.generate_database(path, scale, seed=seed)
+    return path
+
+# (label, function, parameters) of print_stats and commands 1-9, with parameters that exist in this database
+def benchmark_commands(cta, dbConn):
+    catalog = cta["get_station_catalog"](dbConn)
+    station_ids = sorted(catalog["by_id"])
+    station_name = catalog["by_id"][station_ids[0]]
+    other_name = catalog["by_id"][station_ids[len(station_ids) // 2]]
+
+    stats = cta["read_general_stats"](dbConn)
+    if stats is None:
+        stats = (None, None, None) + dbConn.execute("SELECT MIN(Ride_Date), MAX(Ride_Date) FROM Ridership").fetchone()
+    first_year, last_year = int(stats[3][:4]), int(stats[4][:4])
+    year = str((first_year + last_year) // 2)
+
+    line_color, direction = dbConn.execute("""SELECT Lines.Color, Stops.Direction FROM Stops
+                                           JOIN StopDetails ON Stops.Stop_ID = StopDetails.Stop_ID
+                                           JOIN Lines ON StopDetails.Line_ID = Lines.Line_ID
+                                           ORDER BY Stops.Stop_ID LIMIT 1""").fetchone()
+    latitude, longitude = dbConn.execute("SELECT Latitude, Longitude FROM Stops WHERE Station_ID = ? LIMIT 1",
+                                         (station_ids[0],)).fetchone()
+
+    batch = {command: function for command, (function, _, _, _) in cta["BATCH_COMMANDS"].items()}
+    return [
+        ("stats", cta["print_stats"], ()),
+        ("1", batch["1"], (station_name[:4] + "%",)),
+        ("2", batch["2"], (station_name,)),
+        ("3", batch["3"], ()),
+        ("4", batch["4"], (line_color, direction)),
+        ("5", batch["5"], ()),
+        ("6", batch["6"], (station_name,)),
+        ("7", batch["7"], (station_name, year)),
+        ("8", batch["8"], (year, station_name, other_name)),
+        ("9", batch["9"], (str(latitude), str(longitude))),
+    ]
+
+# Best and median wall time over repeat runs, then one more run for peak memory and VM steps
+def measure(dbConn, function, params, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(dbConn, *params)
+        times.append(time.perf_counter() - start)
+
+    steps = [0]
+    def count_steps():
+        steps[0] += 1
+        return 0
+    dbConn.set_progress_handler(count_steps, PROGRESS_STEPS)
+    tracemalloc.start()
+    try:
+        function(dbConn, *params)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        dbConn.set_progress_handler(None, 0)
+    return {"seconds": min(times), "median_seconds": statistics.median(times),
+            "peak_kib": peak / 1024, "vm_steps": steps[0] * PROGRESS_STEPS}
+
+# Runs the whole suite on one database; returns its results
+def run_suite(cta, db_path, repeat, columnar):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        dbConn = cta["open_database"](db_path)
+        prepare_seconds = time.perf_counter() - start
+        if columnar:
+            cta["enable_columnar"](dbConn)
+        num_stations, num_rows = dbConn.execute("""SELECT (SELECT COUNT(*) FROM Stations),
+                                                (SELECT Num_Ride_Entries FROM GeneralStats)""").fetchone()
+        commands = {label: measure(dbConn, function, params, repeat)
+                    for label, function, params in benchmark_commands(cta, dbConn)}
+        dbConn.close()
+    return {"stations": num_stations, "rows": num_rows, "prepare_seconds": prepare_seconds, "commands": commands}
+
+# Prints the results of one database next to its baseline; returns the labels that got slower
+def print_results(name, results, baseline, threshold):
+    print(f"\n{name}: {results['stations']:,} stations, {results['rows']:,} Ridership rows",
+          f"(opened in {results['prepare_seconds']:.2f} s)")
+    print(f"  {'command':<8}{'best ms':>10}{'median ms':>11}{'peak KiB':>11}{'VM steps':>15}  vs baseline")
+    slower = []
+    for label, result in results["commands"].items():
+        line = (f"  {label:<8}{result['seconds'] * 1000:>10.1f}{result['median_seconds'] * 1000:>11.1f}"
+                f"{result['peak_kib']:>11,.0f}{result['vm_steps']:>15,}")
+        before = (baseline or {}).get("commands", {}).get(label)
+        if before:
+            ratio = result["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+            line += f"  {ratio:.2f}x time, {result['vm_steps'] - before['vm_steps']:+,} steps"
+            if ratio > threshold and result["seconds"] - before["seconds"] > NOISE_SECONDS:
+                line += "  SLOWER"
+                slower.append(label)
+        print(line)
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the CTA L analysis commands")
+    parser.add_argument("--scales", default="1", help="comma-separated database scales, 1 = real size (default: %(default)s)")
+    parser.add_argument("--db", action="append", help="benchmark this database instead of synthetic ones (repeatable)")
+    parser.add_argument("--db-dir", default=DEFAULT_DB_DIR, help="where synthetic databases are kept (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=341, help="seed of the synthetic databases (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per command (default: %(default)s)")
+    parser.add_argument("--columnar", action="store_true", help="answer commands from the numpy column store")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=1.25, help="time ratio reported as slower (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.db:
+        databases = [(os.path.basename(path), path) for path in args.db]
+    else:
+        databases = [(f"x{float(scale):g}", scale_database(args.db_dir, float(scale), args.seed))
+                     for scale in args.scales.split(",")]
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    cta = load_app()
+    slower = []
+    all_results = {}
+    for name, db_path in databases:
+        if args.columnar:
+            name += "+columnar"
+        results = run_suite(cta, db_path, max(args.repeat, 1), args.columnar)
+        all_results[name] = results
+        baseline = None if args.save_baseline else baselines.get(name)
+        slower += [f"{name} {label}" for label in print_results(name, results, baseline, args.threshold)]
+
+    if args.save_baseline:
+        baselines.update(all_results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif slower:
+        print(f"\nSlower than the baseline: {', '.join(slower)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
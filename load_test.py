@@ -0,0 +1,108 @@
+#
+# Load test for the CTA L analysis server
+# Overview: Sends a mix of command requests to a running server ("CTA project.py" --serve)
+# from several threads at once and reports throughput and p50/p99 latency.
+#
+#   python "CTA project.py" --serve 8080 &
+#   python load_test.py --url http://127.0.0.1:8080 --threads 16 --requests 2000
+#
+
+
+import argparse
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# One request of each command; --paths replaces them with the lines of a file
+DEFAULT_PATHS = [
+    "/stations?pattern=%25Lake",
+    "/percentages?station=Jackson",
+    "/weekday-ridership",
+    "/line-stops?color=Red&direction=N",
+    "/stops-per-line",
+    "/yearly?station=Jackson",
+    "/monthly?station=Monroe&year=2002",
+    "/daily?year=2002&station=Jackson&station=Monroe",
+    "/nearby?lat=41.88&lon=-87.63",
+]
+
+# Sends requests number next_request[0], ... until num_requests are done, recording (path, status, seconds)
+def worker(base_url, paths, num_requests, next_request, lock, results):
+    while True:
+        with lock:
+            request_num = next_request[0]
+            if request_num >= num_requests:
+                return
+            next_request[0] += 1
+        path = paths[request_num % len(paths)]
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(base_url + path, timeout=60) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as err:
+            err.read()
+            status = err.code
+        except OSError:
+            status = None
+        results.append((path, status, time.perf_counter() - start))
+
+# Value at percent (0-100) of a sorted list, nearest rank
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def print_report(results, elapsed):
+    latencies = sorted(seconds for _, _, seconds in results)
+    failed = sum(1 for _, status, _ in results if status is None or status >= 500)
+    print(f"{len(results)} requests in {elapsed:.2f} s: {len(results) / elapsed:,.0f} requests/s, {failed} failed")
+    print(f"  p50 {percentile(latencies, 50) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms,",
+          f"max {latencies[-1] * 1000:.1f} ms" if latencies else "")
+    print("Per path:")
+    by_path = {}
+    for path, status, seconds in results:
+        by_path.setdefault(path, []).append((status, seconds))
+    for path, rows in by_path.items():
+        path_latencies = sorted(seconds for _, seconds in rows)
+        statuses = sorted(set(str(status) for status, _ in rows))
+        print(f"  {path} : {len(rows)} x {'/'.join(statuses)},",
+              f"p50 {percentile(path_latencies, 50) * 1000:.1f} ms, p99 {percentile(path_latencies, 99) * 1000:.1f} ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="load test for the CTA L analysis server")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="base URL of the server (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent clients (default: %(default)s)")
+    parser.add_argument("--requests", type=int, default=1000, help="total number of requests (default: %(default)s)")
+    parser.add_argument("--warmup", type=int, default=0, help="requests sent before measuring (default: %(default)s)")
+    parser.add_argument("--paths", help="file with one request path per line, used instead of the default mix")
+    args = parser.parse_args(argv)
+
+    paths = DEFAULT_PATHS
+    if args.paths:
+        with open(args.paths) as paths_file:
+            paths = [line.strip() for line in paths_file if line.strip() and not line.startswith("#")]
+    base_url = args.url.rstrip("/")
+
+    lock = threading.Lock()
+    for num_requests in (args.warmup, args.requests):
+        next_request = [0]
+        results = []
+        threads = [threading.Thread(target=worker, args=(base_url, paths, num_requests, next_request, lock, results))
+                   for _ in range(max(args.threads, 1))]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    print(f"{base_url} with {len(threads)} threads")
+    print_report(results, elapsed)
+    return 1 if not results or any(status is None for _, status, _ in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
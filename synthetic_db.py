@@ -0,0 +1,164 @@
+#
+# Synthetic CTA database generator
+# Overview: Builds databases with the tables of CTA2_L_daily_ridership.db (Stations, Stops,
+# StopDetails, Lines, Ridership) filled with made-up but CTA-shaped data, for benchmarking.
+# Scale 1 is about the size of the real database (147 stations with daily ridership for
+# 2001-2021, about 1.1 million Ridership rows); scale 100 has 100 times as many stations,
+# stops and Ridership rows.
+#
+#   python synthetic_db.py --scale 10 cta_x10.db
+#
+
+
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import time
+
+SCHEMA = """
+CREATE TABLE Stations(Station_ID INTEGER PRIMARY KEY, Station_Name TEXT NOT NULL);
+CREATE TABLE Stops(Stop_ID INTEGER PRIMARY KEY, Station_ID INTEGER NOT NULL, Stop_Name TEXT NOT NULL,
+                   Direction TEXT NOT NULL, ADA INTEGER NOT NULL, Latitude REAL NOT NULL, Longitude REAL NOT NULL);
+CREATE TABLE Lines(Line_ID INTEGER PRIMARY KEY, Color TEXT NOT NULL);
+CREATE TABLE StopDetails(Stop_ID INTEGER NOT NULL, Line_ID INTEGER NOT NULL, PRIMARY KEY(Stop_ID, Line_ID));
+CREATE TABLE Ridership(Station_ID INTEGER NOT NULL, Ride_Date TEXT NOT NULL, Type_of_Day TEXT NOT NULL, Num_Riders INTEGER NOT NULL);
+"""
+
+REAL_STATIONS = 147
+LINE_COLORS = ["Red", "Blue", "Green", "Brown", "Purple", "Yellow", "Pink", "Orange"]
+STATION_NAMES = [
+    "Clark/Lake", "Jackson", "Washington/Wells", "UIC-Halsted", "O'Hare Airport", "Belmont-North Main",
+    "Belmont-O'Hare", "Monroe", "Lake", "Chicago/State", "Addison-North Main", "Harlem-Lake", "Fullerton",
+    "Howard", "95th/Dan Ryan", "Midway", "Roosevelt", "Grand/State", "Merchandise Mart", "Quincy/Wells",
+    "Library", "Adams/Wabash", "Randolph/Wabash", "State/Lake", "Sheridan", "Wilson", "Lawrence", "Argyle",
+    "Berwyn", "Bryn Mawr", "Thorndale", "Granville", "Loyola", "Morse", "Jarvis", "Kimball", "Kedzie",
+    "Western", "Damen", "California", "Logan Square", "Jefferson Park", "Cumberland", "Rosemont", "Forest Park",
+    "Cicero", "Pulaski", "Austin", "Oak Park", "Ashland", "Garfield", "Cottage Grove", "King Drive", "Halsted",
+    "Cermak-Chinatown", "Sox-35th", "47th", "63rd", "69th", "79th", "87th", "Linden", "Davis", "Dempster",
+    "Skokie", "Southport", "Paulina", "Irving Park", "Montrose", "Francisco", "Rockwell", "Diversey",
+    "Wellington", "Armitage", "Sedgwick", "Clinton", "LaSalle", "Harrison", "Polk", "18th", "54th/Cermak",
+]
+
+# Chicago area covered by the stops (the map of command 9 spans about the same box)
+LATITUDE_BOX = (41.70, 42.07)
+LONGITUDE_BOX = (-87.90, -87.60)
+
+# Riders on a Saturday and a Sunday/holiday relative to a weekday
+DAY_TYPE_FACTOR = {"W": 1.0, "A": 0.55, "U": 0.4}
+
+# Holidays ridden on a Sunday schedule (Type_of_Day 'U')
+def holidays(year):
+    def nth_weekday(month, weekday, n):
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last_monday_may = nth_weekday(5, 0, 5) if nth_weekday(5, 0, 5).month == 5 else nth_weekday(5, 0, 4)
+    return {datetime.date(year, 1, 1), last_monday_may, datetime.date(year, 7, 4),
+            nth_weekday(9, 0, 1), nth_weekday(11, 3, 4), datetime.date(year, 12, 25)}
+
+# (Ride_Date, Type_of_Day, ridership factor) of every day from first_year to last_year
+def calendar_days(first_year, last_year):
+    days = []
+    sunday_schedule = set().union(*(holidays(year) for year in range(first_year, last_year + 1)))
+    day = datetime.date(first_year, 1, 1)
+    end = datetime.date(last_year, 12, 31)
+    while day <= end:
+        if day in sunday_schedule or day.weekday() == 6:
+            day_type = "U"
+        elif day.weekday() == 5:
+            day_type = "A"
+        else:
+            day_type = "W"
+        # summer is a little busier, and ridership collapses in the spring of 2020
+        factor = DAY_TYPE_FACTOR[day_type] * (1.1 if 6 <= day.month <= 8 else 1.0)
+        if day >= datetime.date(2020, 3, 15):
+            factor *= 0.3
+        days.append((day.isoformat() + " 00:00:00.000", day_type, factor))
+        day += datetime.timedelta(days=1)
+    return days
+
+def station_names(num_stations):
+    names = []
+    for station_num in range(num_stations):
+        name = STATION_NAMES[station_num % len(STATION_NAMES)]
+        copy = station_num // len(STATION_NAMES)
+        names.append(name if copy == 0 else f"{name} {copy + 1}")
+    return names
+
+# Writes Stations, Lines, Stops and StopDetails; returns [(Station_ID, weekday riders, first day index)]
+def generate_stations(dbConn, num_stations, num_days, rng):
+    stations = []
+    stop_id = 30000
+    dbConn.executemany("INSERT INTO Lines VALUES (?, ?)", enumerate(LINE_COLORS, start=1))
+    for station_num, name in enumerate(station_names(num_stations)):
+        station_id = 40000 + station_num * 10
+        dbConn.execute("INSERT INTO Stations VALUES (?, ?)", (station_id, name))
+        latitude = rng.uniform(*LATITUDE_BOX)
+        longitude = rng.uniform(*LONGITUDE_BOX)
+        lines = rng.sample(range(1, len(LINE_COLORS) + 1), rng.choice((1, 1, 1, 2, 3)))
+        for direction in rng.choice(("NS", "EW")):
+            stop_id += 1
+            bound = {"N": "North", "S": "South", "E": "East", "W": "West"}[direction]
+            dbConn.execute("INSERT INTO Stops VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (stop_id, station_id, f"{name} ({bound}bound)", direction, int(rng.random() < 0.6),
+                            latitude + rng.uniform(-0.0005, 0.0005), longitude + rng.uniform(-0.0005, 0.0005)))
+            dbConn.executemany("INSERT INTO StopDetails VALUES (?, ?)", [(stop_id, line_id) for line_id in lines])
+        # a few stations open part way through the period
+        first_day = rng.randrange(num_days // 2) if rng.random() < 0.1 else 0
+        stations.append((station_id, int(rng.lognormvariate(7.5, 0.8)), first_day))
+    return stations
+
+# Ridership rows of one station
+def station_ridership(station, days, rng):
+    station_id, weekday_riders, first_day = station
+    random_factor = rng.random
+    return [(station_id, ride_date, day_type, int(weekday_riders * factor * (0.8 + 0.4 * random_factor())))
+            for ride_date, day_type, factor in days[first_day:]]
+
+# Builds a new database at path; returns (stations, Ridership rows)
+def generate_database(path, scale=1.0, first_year=2001, last_year=2021, seed=341, progress=None):
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    num_stations = max(int(round(REAL_STATIONS * scale)), 1)
+    days = calendar_days(first_year, last_year)
+
+    dbConn = sqlite3.connect(path)
+    dbConn.execute("PRAGMA journal_mode=OFF")
+    dbConn.execute("PRAGMA synchronous=OFF")
+    dbConn.executescript(SCHEMA)
+    with dbConn:
+        stations = generate_stations(dbConn, num_stations, len(days), rng)
+    num_rows = 0
+    for station_num, station in enumerate(stations, start=1):
+        rows = station_ridership(station, days, rng)
+        with dbConn:
+            dbConn.executemany("INSERT INTO Ridership VALUES (?, ?, ?, ?)", rows)
+        num_rows += len(rows)
+        if progress and station_num % 100 == 0:
+            progress(station_num, num_stations, num_rows)
+    dbConn.execute("PRAGMA journal_mode=DELETE")
+    dbConn.close()
+    return num_stations, num_rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="generate a synthetic CTA L ridership database")
+    parser.add_argument("path", help="database file to create (replaced if it exists)")
+    parser.add_argument("--scale", type=float, default=1.0, help="size relative to the real database (default: %(default)s)")
+    parser.add_argument("--first-year", type=int, default=2001, help="first year of ridership (default: %(default)s)")
+    parser.add_argument("--last-year", type=int, default=2021, help="last year of ridership (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=341, help="random seed (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    def progress(station_num, num_stations, num_rows):
+        print(f"  {station_num:,}/{num_stations:,} stations, {num_rows:,} rows", end="\r", flush=True)
+
+    start = time.perf_counter()
+    num_stations, num_rows = generate_database(args.path, args.scale, args.first_year, args.last_year, args.seed, progress)
+    print(f"{args.path}: {num_stations:,} stations, {num_rows:,} Ridership rows in {time.perf_counter() - start:.1f} s".ljust(60))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+#
+# Tests for --compact of "CTA project.py"
+# Overview: Compacts a synthetic database and checks that the Ridership view returns the same
+# rows and the commands the same output as before. Then runs the same randomized inserts,
+# updates, deletes and --ingest loads on a compact and a plain copy, and checks GeneralStats
+# and RidershipRollup against a full recompute and the two copies against each other.
+#
+#   python -m pytest test_compact.py
+#
+
+
+import random
+
+import pytest
+
+from test_ingest import (cta, synthetic_database, ridership_rows, check_general_stats, check_rollups,
+                         command_outputs, ingest_rows, write_csv_files)
+
+# every column of the Ridership view, in a fixed order
+def full_ridership(dbConn):
+    return dbConn.execute("""SELECT Station_ID, Ride_Date, Type_of_Day, Num_Riders, Ride_Day, Ride_Year, Ride_Month
+                          FROM Ridership ORDER BY Station_ID, Ride_Day""").fetchall()
+
+# A plain and a compacted database made from the same synthetic data
+def plain_and_compact(tmp_path, seed=341):
+    plainConn = synthetic_database(str(tmp_path / "plain.db"), seed)
+    compactConn = synthetic_database(str(tmp_path / "compact.db"), seed)
+    assert cta["compact_ridership"](compactConn) is not None
+    assert cta["ridership_is_compact"](compactConn) and not cta["ridership_is_compact"](plainConn)
+    return plainConn, compactConn
+
+# Runs the same randomized inserts, updates and deletes on both databases
+def random_writes(connections, rng):
+    keys = rng.sample(sorted(ridership_rows(connections[0])), 200)
+    first_new_day = cta["epoch_day"](2003)
+    station_ids = sorted({station_id for station_id, _ in keys})
+    statements = []
+    for station_id in station_ids[:4]:
+        for ride_day in range(first_new_day, first_new_day + 10):
+            statements.append(("INSERT INTO Ridership (Station_ID, Ride_Date, Type_of_Day, Num_Riders) VALUES (?, ?, ?, ?)",
+                               (station_id, cta["day_to_date"](ride_day) + " 00:00:00.000", rng.choice(cta["DAY_TYPES"]),
+                                rng.randint(0, 5000))))
+    for station_id, ride_day in keys[:60]:
+        statements.append(("UPDATE Ridership SET Num_Riders = Num_Riders + ? WHERE Station_ID = ? AND Ride_Day = ?",
+                           (rng.randint(-100, 100), station_id, ride_day)))
+    for station_id, ride_day in keys[60:90]:
+        statements.append(("UPDATE Ridership SET Type_of_Day = ? WHERE Station_ID = ? AND Ride_Day = ?",
+                           (rng.choice(cta["DAY_TYPES"]), station_id, ride_day)))
+    # moved to a day of 2004, which has no rows yet
+    for day_num, (station_id, ride_day) in enumerate(keys[90:110]):
+        statements.append(("UPDATE Ridership SET Ride_Date = ? WHERE Station_ID = ? AND Ride_Day = ?",
+                           (cta["day_to_date"](cta["epoch_day"](2004) + day_num) + " 00:00:00.000", station_id, ride_day)))
+    for station_id, ride_day in keys[110:150]:
+        statements.append(("DELETE FROM Ridership WHERE Station_ID = ? AND Ride_Day = ?", (station_id, ride_day)))
+    rng.shuffle(statements)
+    # the first and the last day go too, so the date range has to be recomputed
+    statements.append(("DELETE FROM Ridership WHERE Ride_Day IN ((SELECT MIN(Ride_Day) FROM Ridership), (SELECT MAX(Ride_Day) FROM Ridership))", ()))
+
+    for dbConn in connections:
+        with dbConn:
+            for sql, params in statements:
+                dbConn.execute(sql, params)
+
+def test_compact_keeps_rows_and_outputs(tmp_path, capsys):
+    dbConn = synthetic_database(str(tmp_path / "cta.db"))
+    rows = full_ridership(dbConn)
+    stats = cta["read_general_stats"](dbConn)
+    outputs = command_outputs(dbConn, capsys)
+
+    size_before, size_after = cta["compact_ridership"](dbConn)
+    assert cta["ridership_is_compact"](dbConn)
+    assert size_after < size_before
+    assert full_ridership(dbConn) == rows
+    assert cta["read_general_stats"](dbConn) == stats
+    check_general_stats(dbConn)
+    check_rollups(dbConn)
+    assert command_outputs(dbConn, capsys) == outputs
+
+    # a second run leaves the compact table alone
+    assert cta["compact_ridership"](dbConn) is not None
+    assert full_ridership(dbConn) == rows
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_writes_through_the_compact_view(tmp_path, capsys, seed):
+    plainConn, compactConn = plain_and_compact(tmp_path)
+    random_writes([plainConn, compactConn], random.Random(seed))
+    assert full_ridership(compactConn) == full_ridership(plainConn)
+    for dbConn in (plainConn, compactConn):
+        check_general_stats(dbConn)
+        check_rollups(dbConn)
+    assert command_outputs(compactConn, capsys) == command_outputs(plainConn, capsys)
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_ingest_into_the_compact_view(tmp_path, capsys, seed):
+    plainConn, compactConn = plain_and_compact(tmp_path)
+    rows, expected, _ = ingest_rows(plainConn, random.Random(seed))
+    paths = write_csv_files(str(tmp_path), rows)
+    plain_counts = cta["ingest_files"](plainConn, paths)
+    compact_counts = cta["ingest_files"](compactConn, paths)
+    for counts in (plain_counts, compact_counts):
+        counts.pop("seconds")
+    assert compact_counts == plain_counts
+    assert ridership_rows(compactConn) == expected
+    assert full_ridership(compactConn) == full_ridership(plainConn)
+    check_general_stats(compactConn)
+    check_rollups(compactConn)
+    assert command_outputs(compactConn, capsys) == command_outputs(plainConn, capsys)
+
+def test_compact_refuses_duplicate_days(tmp_path):
+    dbConn = synthetic_database(str(tmp_path / "cta.db"))
+    with dbConn:
+        dbConn.execute("INSERT INTO Ridership (Station_ID, Ride_Date, Type_of_Day, Num_Riders) SELECT Station_ID, Ride_Date, Type_of_Day, 1 FROM Ridership LIMIT 1")
+    rows = full_ridership(dbConn)
+    assert cta["compact_ridership"](dbConn) is None
+    assert not cta["ridership_is_compact"](dbConn)
+    assert full_ridership(dbConn) == rows
@@ -0,0 +1,194 @@
+#
+# Tests for --ingest of "CTA project.py"
+# Overview: Loads randomized CSV files (updates, unchanged rows, new days, a new station,
+# duplicates and bad rows, with and without a header) into a synthetic database and checks
+# Ridership against the expected rows, GeneralStats and RidershipRollup against a full
+# recompute, and the command outputs against a database built from scratch with the same rows.
+#
+#   python -m pytest test_ingest.py
+#
+
+
+import csv
+import datetime
+import os
+import random
+import runpy
+import shlex
+import sqlite3
+
+import pytest
+
+import synthetic_db
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CTA project.py")
+
+cta = runpy.run_path(APP_PATH)
+
+NEW_STATION = (99999, "Test Station")
+
+# batch lines whose output must not depend on how the rows got into the database
+BATCH_LINES = ["1 %", "2 %", "3", "4 Red N", "5", "6 {first}", "7 {first} 2003", "8 2002 {first} {second}",
+               "9 41.88 -87.63"]
+
+# A synthetic database with two years of ridership, opened like the app does
+def synthetic_database(path, seed=341):
+    synthetic_db.generate_database(path, scale=0.1, first_year=2001, last_year=2002, seed=seed)
+    return cta["open_database"](path)
+
+# {(Station_ID, Ride_Day): (Ride_Date, Type_of_Day, Num_Riders)} of Ridership
+def ridership_rows(dbConn):
+    return {(station_id, ride_day): (ride_date, day_type, riders) for station_id, ride_day, ride_date, day_type, riders
+            in dbConn.execute("SELECT Station_ID, Ride_Day, Ride_Date, Type_of_Day, Num_Riders FROM Ridership")}
+
+# Asserts that the GeneralStats row matches a full recompute (the date range only while it is not stale)
+def check_general_stats(dbConn):
+    stored = dbConn.execute("""SELECT Num_Stations, Num_Stops, Num_Ride_Entries, Total_Riders, Dates_Stale,
+                            Min_Ride_Date, Max_Ride_Date FROM GeneralStats""").fetchone()
+    expected = dbConn.execute("""SELECT (SELECT count(*) FROM Stations), (SELECT count(*) FROM Stops), count(*),
+                              COALESCE(SUM(Num_Riders), 0), MIN(Ride_Date), MAX(Ride_Date) FROM Ridership""").fetchone()
+    assert stored[:4] == expected[:4]
+    if not stored[4]:
+        assert stored[5:] == expected[4:]
+    assert cta["read_general_stats"](dbConn)[2:] == (expected[2], expected[4][:10], expected[5][:10], expected[3])
+
+# Asserts that the rollups, once refreshed, match a full recompute
+def check_rollups(dbConn):
+    cta["refresh_rollups"](dbConn)
+    assert cta["rollups_current"](dbConn)
+    stored = dbConn.execute("SELECT * FROM RidershipRollup ORDER BY 1, 2, 3, 4").fetchall()
+    expected = dbConn.execute("""SELECT Station_ID, Ride_Year, Ride_Month, Type_of_Day, SUM(Num_Riders) FROM Ridership
+                              GROUP BY 1, 2, 3, 4 ORDER BY 1, 2, 3, 4""").fetchall()
+    assert stored == expected
+
+# A database built from scratch with the Stations, Stops and Lines of dbConn and the given Ridership rows
+def rebuilt_database(dbConn, path, rows):
+    newConn = sqlite3.connect(path)
+    newConn.executescript(synthetic_db.SCHEMA)
+    for table in ("Stations", "Stops", "Lines", "StopDetails"):
+        table_rows = dbConn.execute(f"SELECT * FROM {table}").fetchall()
+        newConn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(table_rows[0]))})", table_rows)
+    newConn.executemany("INSERT INTO Ridership VALUES (?, ?, ?, ?)",
+                        [(station_id, ride_date, day_type, riders) for (station_id, _), (ride_date, day_type, riders)
+                         in sorted(rows.items())])
+    newConn.commit()
+    newConn.close()
+    return cta["open_database"](path)
+
+# Output of the batch lines, for two station names of the database
+def command_outputs(dbConn, capsys):
+    first, second = [shlex.quote(name) for name, in dbConn.execute("SELECT Station_Name FROM Stations ORDER BY Station_ID LIMIT 2")]
+    capsys.readouterr()
+    cta["run_batch_lines"](dbConn, [line.format(first=first, second=second) + "\n" for line in BATCH_LINES])
+    return capsys.readouterr().out
+
+# Randomized CSV rows for the database: [(station_id, station name, date text, day type, riders)], plus
+# the Ridership rows expected after loading them and the expected counts
+def ingest_rows(dbConn, rng):
+    before = ridership_rows(dbConn)
+    names = dict(dbConn.execute("SELECT Station_ID, Station_Name FROM Stations"))
+    expected = dict(before)
+    rows = []
+    counts = {"read": 0, "skipped": 0, "inserted": 0, "updated": 0, "unchanged": 0, "duplicates": 0, "new_stations": 1}
+
+    def date_text(ride_day):
+        date = datetime.date.fromordinal(ride_day + cta["EPOCH_ORDINAL"])
+        return date.strftime("%m/%d/%Y") if rng.random() < 0.5 else date.isoformat()
+
+    def add(station_id, ride_day, day_type, riders):
+        rows.append((station_id, names.get(station_id, NEW_STATION[1]), date_text(ride_day), day_type, riders))
+        expected[station_id, ride_day] = (datetime.date.fromordinal(ride_day + cta["EPOCH_ORDINAL"]).isoformat()
+                                           + " 00:00:00.000", day_type, riders)
+
+    keys = rng.sample(sorted(before), 300)
+    for station_id, ride_day in keys[:150]:
+        _, day_type, riders = before[station_id, ride_day]
+        if rng.random() < 0.3:
+            day_type = rng.choice([other for other in cta["DAY_TYPES"] if other != day_type])
+        else:
+            riders += rng.randint(1, 500)
+        add(station_id, ride_day, day_type, riders)
+    counts["updated"] += 150
+    for station_id, ride_day in keys[150:250]:
+        _, day_type, riders = before[station_id, ride_day]
+        add(station_id, ride_day, day_type, riders)
+    counts["unchanged"] += 100
+
+    # new days (2003) for existing stations and for a station that is not in Stations yet
+    first_new_day = cta["epoch_day"](2003)
+    for station_id in sorted(names)[:5] + [NEW_STATION[0]]:
+        for ride_day in range(first_new_day, first_new_day + 20):
+            add(station_id, ride_day, rng.choice(cta["DAY_TYPES"]), rng.randint(0, 5000))
+    counts["inserted"] += 6 * 20
+
+    rng.shuffle(rows)
+
+    # the same station and day at the start of the first file and at the end of the second: the last row wins
+    for station_id, ride_day in keys[250:270]:
+        add(station_id, ride_day, "W", rng.randint(0, 5000))
+        rows.insert(0, rows.pop())
+        add(station_id, ride_day, "A", rng.randint(0, 5000))
+        counts["updated" if before[station_id, ride_day][1:] != expected[station_id, ride_day][1:] else "unchanged"] += 1
+    counts["duplicates"] += 20
+
+    counts["read"] = len(rows)
+    return rows, expected, counts
+
+# Writes the rows as CSV files: the first part with a header (columns in another order), the rest without
+def write_csv_files(directory, rows):
+    split = len(rows) // 2
+    header_path = os.path.join(directory, "with_header.csv")
+    with open(header_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["date", "rides", "station_id", "daytype", "stationname"])
+        writer.writerows([ride_date, riders, station_id, day_type, name] for station_id, name, ride_date, day_type, riders in rows[:split])
+        writer.writerow(["01/01/2003", "many", "40000", "W", "Clark/Lake"])
+    plain_path = os.path.join(directory, "without_header.csv")
+    with open(plain_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerows(rows[split:])
+        writer.writerow(["40000", "Clark/Lake", "01/01/2003", "X", "10"])
+    return [header_path, plain_path]
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_ingest_matches_full_recompute(tmp_path, capsys, seed):
+    rng = random.Random(seed)
+    dbConn = synthetic_database(str(tmp_path / "cta.db"))
+    rows, expected, expected_counts = ingest_rows(dbConn, rng)
+    paths = write_csv_files(str(tmp_path), rows)
+    check_general_stats(dbConn)
+
+    counts = cta["ingest_files"](dbConn, paths, batch_size=64)
+    expected_counts["read"] += 2
+    expected_counts["skipped"] += 2
+    assert {name: counts[name] for name in expected_counts} == expected_counts
+    assert ridership_rows(dbConn) == expected
+    assert dbConn.execute("SELECT Station_Name FROM Stations WHERE Station_ID = ?", (NEW_STATION[0],)).fetchone() == (NEW_STATION[1],)
+    assert dbConn.execute("""SELECT COUNT(*) FROM Ridership WHERE Ride_Day IS NOT CAST(julianday(date(Ride_Date)) - 2440587.5 AS INTEGER)
+                          OR Ride_Year IS NOT CAST(strftime('%Y', Ride_Date) AS INTEGER)
+                          OR Ride_Month IS NOT CAST(strftime('%m', Ride_Date) AS INTEGER)""").fetchone() == (0,)
+    check_general_stats(dbConn)
+    check_rollups(dbConn)
+
+    ingested = command_outputs(dbConn, capsys)
+    rebuilt = command_outputs(rebuilt_database(dbConn, str(tmp_path / "rebuilt.db"), expected), capsys)
+    assert ingested == rebuilt
+    assert "Test Station" in ingested
+
+    # loading the same files again changes nothing
+    counts = cta["ingest_files"](dbConn, paths)
+    assert (counts["inserted"], counts["updated"]) == (0, 0)
+    assert ridership_rows(dbConn) == expected
+    check_general_stats(dbConn)
+    check_rollups(dbConn)
+
+def test_ingest_reports_line_numbers(tmp_path, capsys):
+    dbConn = synthetic_database(str(tmp_path / "cta.db"))
+    plain_path = tmp_path / "without_header.csv"
+    plain_path.write_text("40000,Clark/Lake,01/01/2003,W,10\nbad,Clark/Lake,01/02/2003,W,10\n")
+    header_path = tmp_path / "with_header.csv"
+    header_path.write_text("station_id,stationname,date,daytype,rides\n40000,Clark/Lake,01/03/2003,W,10\n40000,Clark/Lake,01/04/2003,W,?\n")
+    cta["ingest_files"](dbConn, [str(plain_path), str(header_path)])
+    out = capsys.readouterr().out
+    assert f"Skipping {plain_path} line 2:" in out
+    assert f"Skipping {header_path} line 3:" in out
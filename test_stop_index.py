@@ -0,0 +1,115 @@
+#
+# Tests for the stop spatial index of "CTA project.py"
+# Overview: Checks stations_within and nearest_stations against a brute-force haversine
+# search over every stop, for Chicago-sized radii as well as points far from the network,
+# radii of thousands of miles and points near the poles and the 180th meridian.
+#
+#   python -m pytest test_stop_index.py
+#
+
+
+import os
+import random
+import runpy
+import sqlite3
+
+import pytest
+
+import synthetic_db
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CTA project.py")
+
+cta = runpy.run_path(APP_PATH)
+
+# (latitude, longitude) of the search points
+POINTS = [
+    (41.88, -87.63),     # the Loop
+    (41.95, -87.75),
+    (51.5, -0.1),        # London, thousands of miles from every stop
+    (-33.9, 151.2),      # Sydney
+    (89.5, 10.0),        # next to the North Pole
+    (-89.9, -170.0),     # next to the South Pole
+    (0.0, 179.99),       # on the 180th meridian
+]
+RADII = [0.5, 1.0, 10.0, 100.0, 1000.0, 5000.0, 13000.0]
+
+# A stop index over the stations and stops of a synthetic database
+def synthetic_index(num_stations, seed=341):
+    dbConn = sqlite3.connect(":memory:")
+    dbConn.executescript(synthetic_db.SCHEMA)
+    synthetic_db.generate_stations(dbConn, num_stations, 365, random.Random(seed))
+    try:
+        return cta["build_stop_index"](dbConn)
+    finally:
+        dbConn.close()
+
+# A stop index over stops at the given (latitude, longitude) points, named "Stop NNN" unless names are given
+def point_index(points, names=None):
+    dbConn = sqlite3.connect(":memory:")
+    dbConn.executescript(synthetic_db.SCHEMA)
+    for stop_num, (latitude, longitude) in enumerate(points):
+        name = names[stop_num] if names else f"Stop {stop_num:03d}"
+        dbConn.execute("INSERT INTO Stations VALUES (?, ?)", (stop_num, name))
+        dbConn.execute("INSERT INTO Stops VALUES (?, ?, ?, 'N', 0, ?, ?)",
+                       (stop_num, stop_num, name, latitude, longitude))
+    try:
+        return cta["build_stop_index"](dbConn)
+    finally:
+        dbConn.close()
+
+def brute_force(stop_index, latitude, longitude):
+    haversine = cta["haversine_miles"]
+    return [(name, stop_lat, stop_lon, haversine(latitude, longitude, stop_lat, stop_lon))
+            for name, stop_lat, stop_lon in stop_index["stops"]]
+
+@pytest.fixture(scope="module")
+def chicago_index():
+    return synthetic_index(44)
+
+@pytest.fixture(scope="module")
+def world_index():
+    rng = random.Random(7)
+    return point_index([(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(60)] +
+                       [(89.95, 0.0), (-89.95, 90.0), (10.0, 179.995), (10.0, -179.995)])
+
+@pytest.mark.parametrize("index_name", ["chicago_index", "world_index"])
+@pytest.mark.parametrize("latitude, longitude", POINTS)
+def test_stations_within_matches_brute_force(request, index_name, latitude, longitude):
+    stop_index = request.getfixturevalue(index_name)
+    everything = brute_force(stop_index, latitude, longitude)
+    for radius in RADII:
+        found = cta["stations_within"](stop_index, latitude, longitude, radius)
+        assert found == sorted(stop for stop in everything if stop[3] <= radius)
+
+@pytest.mark.parametrize("index_name", ["chicago_index", "world_index"])
+@pytest.mark.parametrize("latitude, longitude", POINTS)
+def test_nearest_stations_matches_brute_force(request, index_name, latitude, longitude):
+    stop_index = request.getfixturevalue(index_name)
+    # the closest stop of every station, nearest station first
+    everything = []
+    for stop in sorted(brute_force(stop_index, latitude, longitude), key=lambda stop: (stop[3], stop[0], stop[1], stop[2])):
+        if stop[0] not in [station[0] for station in everything]:
+            everything.append(stop)
+    for k in (1, 3, len(everything) - 1, len(everything) + 5):
+        found = cta["nearest_stations"](stop_index, latitude, longitude, k)
+        assert found == everything[:k]
+
+def test_nearest_stations_are_distinct():
+    # two stops of Stop A (both directions) closer than Stop B
+    stop_index = point_index([(41.880, -87.630), (41.8801, -87.6301), (41.890, -87.630)], ["Stop A", "Stop A", "Stop B"])
+    found = cta["nearest_stations"](stop_index, 41.88, -87.63, 2)
+    assert [stop[0] for stop in found] == ["Stop A", "Stop B"]
+    assert found[0][1:3] == (41.880, -87.630)
+
+def test_search_box_bounded_by_occupied_cells(chicago_index):
+    search_box = cta["search_box"]
+    # circles reaching a pole, and radii whose box has more cells than are occupied, check every stop
+    assert search_box(chicago_index, 89.5, 10.0, 1.0) is None
+    assert search_box(chicago_index, 41.88, -87.63, 13000.0) is None
+    lat_cells, lon_cells = search_box(chicago_index, 41.88, -87.63, 1.0)
+    assert len(lat_cells) * len(lon_cells) <= len(chicago_index["cells"])
+
+def test_empty_index():
+    stop_index = point_index([])
+    assert cta["stations_within"](stop_index, 41.88, -87.63, 1000.0) == []
+    assert cta["nearest_stations"](stop_index, 41.88, -87.63, 3) == []